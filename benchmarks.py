@@ -0,0 +1,1067 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from codec import CODECS, MESSAGE_TYPES
+from protocol import (COMPRESSION_LEVEL, COMPRESSION_METHODS, HEADER, FrameReader, decode_message, encode_message,
+                      encode_payload, frame_payload, iter_messages, send_message)
+from server import HISTORY_PAGE_MAX, ClientConnection, MessengerServer
+from storage import STORAGE_BACKENDS, JsonStorage, pack_message, private_chat_name, unpack_message, write_snapshot
+
+
+class NullConnection(ClientConnection):
+    """Соединение без сокета: кадры только подсчитываются"""
+
+    def __init__(self, username):
+        super().__init__(None, ('127.0.0.1', 0))
+        self.username = username
+        self.frames = 0
+        self.bytes = 0
+        self.count_lock = threading.Lock()
+
+    def queue_frame(self, frame, position=None):
+        """Учет кадра (сжатого, если клиент согласовал сжатие); возвращает отправленный кадр"""
+        with self.count_lock:
+            self.frames += 1
+            self.bytes += len(frame)
+        if position is not None:
+            self.delivered(*position)  # кадр считается записанным сразу
+        return frame
+
+    def close(self):
+        self.closed = True
+
+
+def make_server(storage):
+    """Сервер во временной папке, без сети и без вывода в консоль"""
+    os.chdir(tempfile.mkdtemp())
+    logging.disable(logging.INFO)
+    return MessengerServer(port=0, fsync_policy='never', storage=storage)
+
+
+def group_texts(storage, group_name):
+    """Тексты всех сообщений группы в порядке seq"""
+    return [msg['text'] for msg in storage.history_page('group', group_name)[0]]
+
+
+def bench_group_fanout(sizes, rounds, storage):
+    """Стоимость рассылки одного группового сообщения в зависимости от размера группы"""
+    print("Рассылка группового сообщения")
+    print(f"{'участников':>12} {'JSON на каждого, мкс':>22} {'один кадр, мкс':>16} {'ускорение':>10} {'process_message, мкс':>22}")
+
+    for size in sizes:
+        server = make_server(storage)
+        members = [f"user{i}" for i in range(size)]
+        server.commit({'op': 'create_group', 'group': 'bench', 'creator': members[0]})
+        for username in members[1:]:
+            server.commit({'op': 'join_group', 'group': 'bench', 'username': username})
+        for username in members:
+            server.clients[username] = NullConnection(username)
+        sender = server.clients[members[0]]
+        message = {'type': 'group_message', 'from': members[0], 'group': 'bench', 'text': 'x' * 200}
+
+        connections = [server.clients[username] for username in members]
+        forward_msg = dict(message, local_ip='1.1.1.1', server_ip='127.0.0.1', seq=1)
+
+        # Прежний способ: отдельный JSON для каждого участника
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for conn in connections:
+                conn.send_frame(encode_message(forward_msg))
+        per_member = (time.perf_counter() - started) / rounds
+
+        # Сериализация один раз и общий кадр для всех
+        started = time.perf_counter()
+        for _ in range(rounds):
+            frame = encode_message(forward_msg)
+            for conn in connections:
+                conn.send_frame(frame)
+        once = (time.perf_counter() - started) / rounds
+
+        # Полный путь сервера: проверки, запись в журнал и рассылка
+        started = time.perf_counter()
+        for _ in range(rounds):
+            server.process_message(sender, message)
+        current = (time.perf_counter() - started) / rounds
+
+        print(f"{size:>12} {per_member * 1e6:>22.1f} {once * 1e6:>16.1f} {per_member / once:>9.1f}x {current * 1e6:>22.1f}")
+        server.storage.close()
+
+
+def deep_size(messages):
+    """Объем списка сообщений вместе со всеми объектами, на которые они ссылаются (общие - один раз)"""
+    seen = set()
+    total = sys.getsizeof(messages)
+    for msg in messages:
+        if isinstance(msg, dict):
+            parts = [msg, *msg.keys(), *msg.values()]
+        else:
+            parts = [msg, *(getattr(msg, field) for field in msg.__slots__)]
+        for obj in parts:
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                total += sys.getsizeof(obj)
+    return total
+
+
+def bench_message_memory(count):
+    """Память под историю: словари сообщений против компактных записей (StoredMessage).
+
+    Сообщения строятся так же, как при чтении истории с диска: каждое
+    разбирается из своей строки JSON, поэтому без интернирования имена
+    и IP-адреса - отдельные строки в каждом сообщении.
+    """
+    print(f"Память под {count} сообщений")
+    users = [(f"user{i}", f"192.168.{i // 250}.{i % 250 + 1}", f"10.0.0.{i % 250 + 1}") for i in range(200)]
+    started_at = datetime(2024, 1, 1)
+
+    def message_lines():
+        for i in range(count):
+            sender, local_ip, server_ip = users[i % len(users)]
+            yield encode_payload({
+                'from': sender,
+                'local_ip': local_ip,
+                'server_ip': server_ip,
+                'text': f"Сообщение номер {i}",
+                'timestamp': (started_at + timedelta(seconds=i, microseconds=i % 997)).isoformat()
+            })
+
+    results = {}
+    for name, convert in (('словари', lambda msg: msg), ('StoredMessage', pack_message)):
+        started = time.perf_counter()
+        messages = [convert(json.loads(line)) for line in message_lines()]
+        elapsed = time.perf_counter() - started
+        size = deep_size(messages)
+        results[name] = (messages, size)
+        print(f"  {name:>14}: {size / 1024 / 1024:8.1f} МБ, {size / count:6.1f} байт на сообщение, "
+              f"построение {elapsed:.1f} с")
+
+    plain, plain_size = results['словари']
+    packed, packed_size = results['StoredMessage']
+    same = all(unpack_message(msg) == original for msg, original in zip(packed, plain))
+    print(f"  экономия {plain_size / packed_size:.1f}x, обратное преобразование: {'OK' if same else 'ОШИБКА'}")
+    return same
+
+
+def bench_startup(sizes):
+    """Время запуска хранилища json в зависимости от объема истории.
+
+    Прежний формат - вся история внутри server_data.json; новый - снимок
+    только с описанием чатов (индекс) и куски истории в server_data.history,
+    которые читаются через mmap при первом обращении к чату.
+    """
+    print("Запуск хранилища json")
+    print(f"{'сообщений':>10} {'весь снимок, с':>15} {'индекс, с':>10} {'первая страница, мс':>20} "
+          f"{'снимок, МБ':>11} {'индекс, КБ':>11}")
+    logger = logging.getLogger('benchmarks')
+
+    for size in sizes:
+        os.chdir(tempfile.mkdtemp())
+        logging.disable(logging.INFO)
+        users = [f"user{i}" for i in range(200)]
+        chats = [tuple(sorted((users[i], users[(i * 7 + 1) % len(users)]))) for i in range(len(users))]
+        private_chats = {private_chat_name(chat): [] for chat in dict.fromkeys(chats)}
+        group_chats = {f"group{i}": {'creator': users[i], 'members': users[i:i + 20], 'messages': []}
+                       for i in range(50)}
+        histories = list(private_chats.values()) + [group['messages'] for group in group_chats.values()]
+        for i in range(size):
+            histories[i % len(histories)].append({
+                'from': users[i % len(users)],
+                'local_ip': '192.168.0.10',
+                'server_ip': '127.0.0.1',
+                'text': f"Сообщение номер {i}",
+                'timestamp': '2024-01-01T12:00:00.123456'
+            })
+        write_snapshot('server_data.json', {'private_chats': private_chats, 'group_chats': group_chats,
+                                            'user_data': {}, 'wal_lsn': 0})
+        full_size = os.path.getsize('server_data.json')
+        del private_chats, group_chats, histories
+
+        started = time.perf_counter()
+        storage = JsonStorage(logger, fsync='never')
+        storage.load()
+        full = time.perf_counter() - started
+        # Первая контрольная точка переводит данные в новый формат
+        storage.checkpoint()
+        storage.close()
+        index_size = os.path.getsize('server_data.json')
+
+        started = time.perf_counter()
+        storage = JsonStorage(logger, fsync='never')
+        storage.load()
+        indexed = time.perf_counter() - started
+        started = time.perf_counter()
+        storage.history_page('group', 'group0', 50)
+        first_page = time.perf_counter() - started
+        storage.close()
+
+        print(f"{size:>10} {full:>15.3f} {indexed:>10.3f} {first_page * 1000:>20.1f} "
+              f"{full_size / 1024 / 1024:>11.1f} {index_size / 1024:>11.1f}")
+
+
+def load_process(port, first, count, seconds, results):
+    """Процесс нагрузки: пары клиентов шлют друг другу личные сообщения.
+
+    Каждый клиент отправляет следующее сообщение после подтверждения
+    сервером предыдущего (message_sent) и считает доставленные ему.
+    """
+    counts = [None] * count
+    started = []
+
+    def all_registered():
+        # Пауза, чтобы о входе клиентов узнали все процессы сервера
+        time.sleep(0.5)
+        started.append(time.perf_counter())
+
+    # Все клиенты входят до начала отправки, иначе первые сообщения уходят еще не вошедшим
+    registered = threading.Barrier(count, action=all_registered)
+
+    def client(index):
+        user = first + index
+        peer = user ^ 1  # пары соседних номеров; собеседник часто подключен к другому процессу
+        sock = socket.create_connection(('127.0.0.1', port))
+        messages = iter_messages(sock)
+        send_message(sock, {'type': 'register', 'username': f"user{user}", 'local_ip': '127.0.0.1'})
+        registered.wait()
+        sent = delivered = 0
+        while time.perf_counter() < started[0] + seconds:
+            send_message(sock, {'type': 'private_message', 'from': f"user{user}", 'to': f"user{peer}",
+                                'text': 'x' * 100, 'message_id': sent})
+            for msg in messages:
+                if msg.get('type') == 'private_message':
+                    delivered += 1
+                elif msg.get('type') == 'message_sent':
+                    break
+            sent += 1
+        # Дочитываем сообщения, отправленные собеседником до конца замера
+        sock.settimeout(1)
+        try:
+            for msg in messages:
+                if msg.get('type') == 'private_message':
+                    delivered += 1
+        except OSError:
+            pass
+        sock.close()
+        counts[index] = (sent, delivered)
+
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(counts)
+
+
+def bench_workers(counts, clients, seconds, load_processes=4):
+    """Пропускная способность сервера из нескольких процессов (--workers) на личных сообщениях"""
+    print(f"Сервер из нескольких процессов: {clients} клиентов, {seconds} с на замер, ядер: {os.cpu_count()}")
+    print(f"{'процессов':>10} {'сообщений/с':>12} {'доставлено':>11}")
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+    for workers in counts:
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        command = [sys.executable, server_path, '--port', str(port), '--storage', 'sqlite', '--fsync', 'never',
+                   '--mode', 'eventloop', '--workers', str(workers)]
+        server = subprocess.Popen(command, cwd=tempfile.mkdtemp(), stdin=subprocess.PIPE,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            # Ждем, пока все процессы начнут слушать порт
+            for _ in range(100):
+                try:
+                    socket.create_connection(('127.0.0.1', port)).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            time.sleep(1)
+
+            results = multiprocessing.Queue()
+            per_process = clients // load_processes
+            loaders = [multiprocessing.Process(target=load_process,
+                                               args=(port, i * per_process, per_process, seconds, results))
+                       for i in range(load_processes)]
+            for loader in loaders:
+                loader.start()
+            counts_by_client = [pair for _ in loaders for pair in results.get()]
+            for loader in loaders:
+                loader.join()
+        finally:
+            server.communicate(b'stop\n', timeout=60)
+
+        sent = sum(pair[0] for pair in counts_by_client)
+        delivered = sum(pair[1] for pair in counts_by_client)
+        print(f"{workers:>10} {sent / seconds:>12.0f} {delivered / max(sent, 1):>10.1%}")
+
+
+class CaptureConnection(NullConnection):
+    """Соединение без сокета, запоминающее полученные сообщения"""
+
+    def __init__(self, username):
+        super().__init__(username)
+        self.messages = []
+        self.sent = []
+
+    def queue_frame(self, frame, position=None):
+        frame = super().queue_frame(frame, position)
+        self.sent.append(frame)
+        self.messages.append(decode_message(frame_payload(frame)))
+
+    def texts(self, msg_type):
+        return [msg['text'] for msg in self.messages if msg.get('type') == msg_type]
+
+
+def wait_for(condition, timeout=5):
+    """Ожидание, пока сообщения шины дойдут до узлов"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def check_federation():
+    """Проверка федерации: три узла на общей базе SQLite и шина в одном процессе.
+
+    Сообщения должны пересылаться только узлу получателя; после падения узла
+    или разделения сети маршруты к его пользователям удаляются, а после
+    повторного входа пользователя или восстановления связи - появляются снова.
+    """
+    from workers import LocalBroker
+
+    os.chdir(tempfile.mkdtemp())
+    logging.disable(logging.WARNING)
+    broker = LocalBroker()
+    nodes = {}
+    bus_kinds = {}  # узел -> виды полученных им сообщений шины
+    for name in ('a', 'b', 'c'):
+        server = MessengerServer(port=0, fsync_policy='never', storage='sqlite', node_id=name)
+        server.node_timeout = 0.3
+        bus_kinds[name] = []
+
+        def handler(meta, body, server=server, kinds=bus_kinds[name]):
+            kinds.append(meta['kind'])
+            server.on_bus_message(meta, body)
+
+        server.bus = broker.connect(name, handler, server.logger, server.on_bus_closed, server.on_bus_connected)
+        nodes[name] = server
+
+    def login(node, username):
+        conn = CaptureConnection(username)
+        nodes[node].process_message(conn, {'type': 'register', 'username': username, 'local_ip': '127.0.0.1'})
+        return conn
+
+    def send(node, sender, to, text):
+        nodes[node].process_message(nodes[node].clients[sender],
+                                    {'type': 'private_message', 'from': sender, 'to': to, 'text': text})
+
+    def routes(node):
+        return dict(nodes[node].remote_users)
+
+    def tick(seconds):
+        # Сигналы "жив" от всех узлов; кто их не получает, теряет маршруты к замолчавшим
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for server in nodes.values():
+                server.heartbeat()
+            time.sleep(0.05)
+
+    checks = {}
+    for server in nodes.values():
+        server.heartbeat()
+    alice, dave = login('a', 'alice'), login('a', 'dave')
+    bob = login('b', 'bob')
+    carol = login('c', 'carol')
+    checks['таблица маршрутов'] = wait_for(
+        lambda: routes('a') == {'bob': 'b', 'carol': 'c'} and routes('c') == {'alice': 'a', 'dave': 'a', 'bob': 'b'})
+
+    bus_kinds['c'].clear()
+    send('a', 'alice', 'bob', 'привет')
+    checks['личное сообщение'] = wait_for(lambda: bob.texts('private_message') == ['привет'])
+    # Курсор доставки сдвигает узел получателя
+    checks['курсор доставки'] = wait_for(lambda: bob.cursors.get(('private', ('alice', 'bob'))) == 1)
+
+    nodes['a'].process_message(alice, {'type': 'create_group', 'group_name': 'g', 'creator': 'alice'})
+    for conn in (bob, dave):
+        node = 'b' if conn is bob else 'a'
+        nodes[node].process_message(conn, {'type': 'join_group', 'group_name': 'g', 'username': conn.username})
+    time.sleep(0.2)
+    frames_to_a = bus_kinds['a'].count('frame')
+    nodes['b'].process_message(bob, {'type': 'group_message', 'from': 'bob', 'group': 'g', 'text': 'всем'})
+    checks['групповое сообщение'] = wait_for(
+        lambda: alice.texts('group_message') == ['всем'] and dave.texts('group_message') == ['всем'])
+    time.sleep(0.2)
+    # Узел a получает один кадр на двух своих участников, узел c (без участников) - ни одного
+    checks['адресная пересылка'] = bus_kinds['a'].count('frame') == frames_to_a + 1 and 'frame' not in bus_kinds['c']
+
+    # Падение узла b: маршрут к bob удаляется, сообщение для него только сохраняется
+    broker.disconnect('b')
+    checks['падение узла'] = wait_for(lambda: 'bob' not in routes('a') and 'bob' not in routes('c'))
+    send('a', 'alice', 'bob', 'ты где?')
+    stored = nodes['a'].storage.history_page('private', ('alice', 'bob'))[0]
+    checks['сохранено без получателя'] = [msg['text'] for msg in stored][-1] == 'ты где?'
+
+    # bob входит через узел c - маршрут следует за ним
+    bob_on_c = login('c', 'bob')
+    checks['повторный вход'] = wait_for(lambda: routes('a').get('bob') == 'c')
+    send('a', 'alice', 'bob', 'нашелся')
+    checks['доставка после повторного входа'] = wait_for(lambda: bob_on_c.texts('private_message') == ['нашелся'])
+
+    # Разделение сети: узлы a и c друг о друге не знают, пока не пропадут сигналы "жив"
+    broker.partition('c')
+    tick(0.6)
+    checks['разделение сети'] = 'bob' not in routes('a') and 'carol' not in routes('a') and not routes('c')
+    broker.heal('c')
+    tick(0.2)
+    checks['восстановление связи'] = wait_for(
+        lambda: routes('a') == {'bob': 'c', 'carol': 'c'} and routes('c') == {'alice': 'a', 'dave': 'a'})
+    send('c', 'carol', 'alice', 'снова вместе')
+    checks['доставка после восстановления'] = wait_for(lambda: alice.texts('private_message') == ['снова вместе'])
+
+    for server in nodes.values():
+        server.bus.close()
+        server.storage.close()
+    logging.disable(logging.NOTSET)
+
+    print("Федерация узлов (3 узла, общая база SQLite)")
+    for name, ok in checks.items():
+        print(f"  {name}: {'OK' if ok else 'ОШИБКА'}")
+    return all(checks.values())
+
+
+def bench_compression(storage, rounds=200):
+    """Размер и время ответов сервера без сжатия и со сжатием (zlib, согласуется при входе)"""
+    server = make_server(storage)
+    peers = [f"сотрудник{i}" for i in range(100)]
+    text = "Добрый день! Отправляю обновленный отчет по продажам за квартал, посмотрите, пожалуйста"
+
+    def user(local_ip):
+        return {'local_ip': local_ip, 'server_ip': '10.0.0.5', 'last_seen': datetime.now().isoformat()}
+
+    def message(sender, i):
+        return {'from': sender, 'local_ip': '192.168.1.10', 'server_ip': '10.0.0.5',
+                'text': f"{text} ({i})", 'timestamp': datetime.now().isoformat()}
+
+    server.commit({'op': 'register', 'username': 'alice', 'user': user('192.168.1.10')})
+    server.commit({'op': 'create_group', 'group': 'отдел продаж', 'creator': 'alice'})
+    for i, peer in enumerate(peers):
+        server.commit({'op': 'register', 'username': peer, 'user': user(f"192.168.1.{i + 20}")})
+        server.commit({'op': 'join_group', 'group': 'отдел продаж', 'username': peer})
+        for j in range(60 if i == 0 else 1):
+            server.commit({'op': 'private_message', 'chat': sorted(['alice', peer]), 'message': message(peer, j)})
+    for j in range(60):
+        server.commit({'op': 'group_message', 'group': 'отдел продаж', 'message': message(peers[j], j)})
+
+    requests = [
+        ('вход (chats_update)', {'type': 'register', 'username': 'alice', 'local_ip': '192.168.1.10'}),
+        ('chat_history личный', {'type': 'get_chat_history', 'chat_type': 'private', 'chat_id': peers[0],
+                                 'username': 'alice'}),
+        ('chat_history группы', {'type': 'get_chat_history', 'chat_type': 'group', 'chat_id': 'отдел продаж',
+                                 'username': 'alice'}),
+        ('group_members', {'type': 'get_group_members', 'group_name': 'отдел продаж', 'username': 'alice'}),
+    ]
+    results = {}
+    received = {}
+    for compressed in (False, True):
+        conn = CaptureConnection('alice')
+        offer = {'compression': list(COMPRESSION_METHODS)} if compressed else {}
+        for name, request in requests:
+            if request['type'] == 'register':
+                request = dict(request, **offer)
+            sent = conn.bytes
+            conn.messages.clear()
+            server.process_message(conn, request)
+            size = conn.bytes - sent
+            received[name, compressed] = [msg for msg in conn.messages if msg['type'] != 'server_ip_assigned']
+            started = time.perf_counter()
+            for _ in range(rounds):
+                server.process_message(conn, request)
+            results[name, compressed] = (size, (time.perf_counter() - started) / rounds)
+            conn.messages.clear()
+
+        # Сжатые кадры должны разбираться обычным приемником кадров
+        reader = FrameReader()
+        reader.feed(b''.join(conn.sent))
+        decoded = [decode_message(payload) for payload in reader.frames()]
+        if decoded != [decode_message(frame_payload(frame)) for frame in conn.sent]:
+            print("ОШИБКА: кадры не совпадают после приема")
+            return False
+
+    stats = server.compressor.stats()
+    server.storage.close()
+    print(f"Сжатие ответов (zlib, порог {server.compressor.threshold} байт)")
+    print(f"{'ответ':>22} {'без сжатия, Б':>14} {'со сжатием, Б':>14} {'экономия':>9} "
+          f"{'без сжатия, мкс':>16} {'со сжатием, мкс':>16}")
+    for name, _ in requests:
+        (raw, raw_time), (packed, packed_time) = results[name, False], results[name, True]
+        print(f"{name:>22} {raw:>14} {packed:>14} {1 - packed / raw:>9.0%} "
+              f"{raw_time * 1e6:>16.0f} {packed_time * 1e6:>16.0f}")
+    print(f"Счетчики сервера: сжато кадров {stats['compressed']} из {stats['frames']}, "
+          f"{stats['bytes_in']} -> {stats['bytes_out']} байт")
+    same = all(received[name, False] == received[name, True] for name, _ in requests)
+    print(f"Ответы со сжатием совпадают с исходными: {'OK' if same else 'ОШИБКА'}")
+    return same
+
+
+def bench_reconnect(sizes, storage, missed=60):
+    """Стоимость повторного входа: досылка пропущенных сообщений против загрузки полной истории.
+
+    У пользователя 10 личных чатов и группа; пока он не в сети, в них приходит
+    missed сообщений. При входе сервер должен дослать ровно их - сколько бы
+    ни было истории до этого, в том числе после перезапуска сервера.
+    """
+    print(f"Повторный вход после {missed} пропущенных сообщений")
+    print(f"{'история':>10} {'досылка: кадров':>16} {'КБ':>8} {'мс':>8} {'полная история: КБ':>19} {'мс':>8} {'проверка':>9}")
+    ok = True
+    for size in sizes:
+        server = make_server(storage)
+        peers = [f"peer{i}" for i in range(10)]
+        server.commit({'op': 'create_group', 'group': 'team', 'creator': 'alice'})
+        for peer in peers:
+            server.commit({'op': 'join_group', 'group': 'team', 'username': peer})
+
+        def write(i, text):
+            # Поровну в личные чаты и в группу
+            peer = peers[i % len(peers)]
+            if i % 2:
+                server.process_message(NullConnection(peer), {'type': 'private_message', 'from': peer,
+                                                              'to': 'alice', 'text': text})
+            else:
+                server.process_message(NullConnection(peer), {'type': 'group_message', 'from': peer,
+                                                              'group': 'team', 'text': text})
+
+        for i in range(size):
+            write(i, f"старое сообщение {i}")
+        login = {'type': 'register', 'username': 'alice', 'local_ip': '127.0.0.1'}
+        # Первый вход досылает накопленное (в пределах лимитов), при отключении курсоры сохраняются
+        conn = CaptureConnection('alice')
+        server.process_message(conn, login)
+        server.disconnect_client(conn)
+
+        def reconnect(count, prefix):
+            for i in range(count):
+                write(i, f"{prefix} {i}")
+            conn = CaptureConnection('alice')
+            started = time.perf_counter()
+            server.process_message(conn, login)
+            elapsed = time.perf_counter() - started
+            frames = [msg for msg in conn.messages if msg['type'] == 'missed_messages']
+            texts = sorted(msg['text'] for frame in frames for msg in frame['messages'])
+            server.disconnect_client(conn)
+            return conn, frames, elapsed, texts == sorted(f"{prefix} {i}" for i in range(count))
+
+        conn, frames, elapsed, same = reconnect(missed, "пропущено")
+        missed_bytes = sum(len(encode_message(frame)) for frame in frames)
+
+        # Без курсоров клиенту пришлось бы загрузить историю всех чатов
+        fetch = CaptureConnection('alice')
+        server.clients['alice'] = fetch
+        started = time.perf_counter()
+        for peer in peers:
+            server.process_message(fetch, {'type': 'get_chat_history', 'chat_type': 'private', 'chat_id': peer,
+                                           'username': 'alice', 'limit': HISTORY_PAGE_MAX})
+        server.process_message(fetch, {'type': 'get_chat_history', 'chat_type': 'group', 'chat_id': 'team',
+                                       'username': 'alice', 'limit': HISTORY_PAGE_MAX})
+        full_elapsed = time.perf_counter() - started
+        del server.clients['alice']
+
+        # Курсоры переживают перезапуск сервера
+        server.storage.close()
+        server = MessengerServer(port=0, fsync_policy='never', storage=storage)
+        _, _, _, restarted = reconnect(7, "после перезапуска")
+        server.storage.close()
+
+        passed = same and restarted
+        ok = ok and passed
+        print(f"{size:>10} {len(frames):>16} {missed_bytes / 1024:>8.1f} {elapsed * 1000:>8.2f} "
+              f"{fetch.bytes / 1024:>19.1f} {full_elapsed * 1000:>8.2f} {'OK' if passed else 'ОШИБКА':>9}")
+    return ok
+
+
+def codec_samples():
+    """По одному типичному сообщению каждого типа протокола"""
+    now = datetime.now()
+
+    def stamp(minutes):
+        return (now - timedelta(minutes=minutes, microseconds=minutes + 1)).isoformat()
+
+    def message(i):
+        return {'from': f"сотрудник{i % 7}", 'local_ip': '192.168.1.10', 'server_ip': '10.0.0.5',
+                'text': f"Добрый день! Отправляю обновленный отчет по продажам ({i})", 'timestamp': stamp(i),
+                'seq': 1000 + i}
+
+    last = {key: value for key, value in message(1).items() if key != 'seq'}
+    page = [message(i) for i in range(50)]
+    private_chats = [{'user': f"сотрудник{i}", 'local_ip': f"192.168.1.{i % 250}", 'server_ip': '10.0.0.5',
+                      'last_message': last} for i in range(100)]
+    group_chats = [{'group_name': f"отдел {i}", 'creator': 'alice', 'last_message': last} for i in range(20)]
+    members = [{'username': f"сотрудник{i}", 'local_ip': f"192.168.1.{i % 250}", 'server_ip': '10.0.0.5',
+                'last_seen': stamp(i)} for i in range(100)]
+    return {
+        'register': {'type': 'register', 'username': 'alice', 'local_ip': '192.168.1.10',
+                     'compression': ['zlib'], 'codecs': ['binary', 'json']},
+        'private_message': {'type': 'private_message', 'to': 'bob', 'message_id': 'alice_1712345678.123', **message(1)},
+        'group_message': {'type': 'group_message', 'group': 'отдел продаж', **message(2)},
+        'create_group': {'type': 'create_group', 'group_name': 'отдел продаж', 'creator': 'alice'},
+        'join_group': {'type': 'join_group', 'group_name': 'отдел продаж', 'username': 'alice'},
+        'leave_group': {'type': 'leave_group', 'group_name': 'отдел продаж', 'username': 'alice'},
+        'rename_group': {'type': 'rename_group', 'group_name': 'отдел продаж', 'new_name': 'продажи',
+                         'username': 'alice'},
+        'delete_group': {'type': 'delete_group', 'group_name': 'продажи', 'username': 'alice'},
+        'get_chat_history': {'type': 'get_chat_history', 'chat_type': 'group', 'chat_id': 'отдел продаж',
+                             'username': 'alice', 'before': 1050, 'limit': 50},
+        'get_group_members': {'type': 'get_group_members', 'group_name': 'отдел продаж', 'username': 'alice'},
+        'get_chats': {'type': 'get_chats'},
+        'server_ip_assigned': {'type': 'server_ip_assigned', 'server_ip': '10.0.0.5', 'compression': 'zlib',
+                               'codec': 'binary'},
+        'message_sent': {'type': 'message_sent', 'message_id': 'alice_1712345678.123', 'timestamp': stamp(0),
+                         'seq': 1001},
+        'chats_update': {'type': 'chats_update', 'private_chats': private_chats,
+                         'group_chats': group_chats},
+        'chat_added': {'type': 'chat_added', 'kind': 'group', 'chat': group_chats[0]},
+        'chat_removed': {'type': 'chat_removed', 'kind': 'group', 'group_name': 'отдел 1'},
+        'chat_renamed': {'type': 'chat_renamed', 'kind': 'group', 'old_name': 'отдел 2',
+                         'new_name': 'отдел два'},
+        'last_message_changed': {'type': 'last_message_changed', 'kind': 'private',
+                                 'user': 'сотрудник1', 'last_message': last},
+        'chat_history': {'type': 'chat_history', 'chat_type': 'group', 'chat_id': 'отдел продаж', 'history': page,
+                         'next_before': 1000, 'next_after': None},
+        'group_members': {'type': 'group_members', 'group_name': 'отдел продаж', 'members': members},
+        'group_created': {'type': 'group_created', 'group_name': 'отдел продаж'},
+        'group_joined': {'type': 'group_joined', 'group_name': 'отдел продаж'},
+        'missed_messages': {'type': 'missed_messages', 'chat_type': 'private', 'chat_id': 'bob',
+                            'messages': page, 'skipped': 0},
+    }
+
+
+def bench_codecs(storage, rounds=2000):
+    """Размер и время кодирования и разбора сообщений каждого типа во всех доступных кодеках"""
+    samples = codec_samples()
+    missing = [name for name in MESSAGE_TYPES if name not in samples]
+    if missing:
+        print(f"ОШИБКА: нет примеров для типов {', '.join(missing)}")
+        return False
+
+    ok = True
+    results = {}
+    for codec in CODECS.values():
+        for name, message in samples.items():
+            payload = codec.encode(message)
+            expected = json.loads(json.dumps(message))
+            if decode_message(payload) != expected or \
+                    decode_message(codec.with_version(payload, 7)) != dict(expected, version=7):
+                print(f"ОШИБКА: {codec.name} искажает сообщение {name}")
+                ok = False
+            # Крупные сообщения кодируются реже - меньше повторов, чтобы замер не затягивался
+            count = max(rounds * 200 // len(payload), 10) if len(payload) > 200 else rounds
+            started = time.perf_counter()
+            for _ in range(count):
+                codec.encode(message)
+            encode_time = (time.perf_counter() - started) / count
+            started = time.perf_counter()
+            for _ in range(count):
+                codec.decode(payload)
+            decode_time = (time.perf_counter() - started) / count
+            results[codec.name, name] = (len(payload), len(zlib.compress(payload, COMPRESSION_LEVEL)),
+                                         encode_time, decode_time)
+
+    print(f"Кодеки сообщений: {', '.join(CODECS)} (размер, байт / сжатый zlib; кодирование / разбор, мкс)")
+    print(f"{'тип':>22}" + ''.join(f" {name:>28}" for name in CODECS))
+    for name in samples:
+        cells = []
+        for codec_name in CODECS:
+            size, packed, encode_time, decode_time = results[codec_name, name]
+            cells.append(f"{size:>6}/{packed:<6} {encode_time * 1e6:>6.1f}/{decode_time * 1e6:<6.1f}")
+        print(f"{name:>22}" + ''.join(f" {cell:>28}" for cell in cells))
+    totals = {codec_name: sum(results[codec_name, name][0] for name in samples) for codec_name in CODECS}
+    print("Всего байт: " + ", ".join(f"{name} {total} ({total / totals['json']:.0%})"
+                                     for name, total in totals.items()))
+
+    # Сквозная проверка: сервер отвечает в согласованном кодеке, а ответы совпадают с JSON
+    requests = [samples['register'], samples['get_chat_history'], samples['get_group_members'],
+                dict(samples['group_message'], **{'from': 'alice'})]
+    received = {}
+    for codec_name in CODECS:
+        server = make_server(storage)
+        server.commit({'op': 'register', 'username': 'alice', 'user': {'local_ip': '192.168.1.10'}})
+        server.commit({'op': 'create_group', 'group': 'отдел продаж', 'creator': 'alice'})
+        for message in samples['chat_history']['history'][:20]:
+            server.commit({'op': 'group_message', 'group': 'отдел продаж', 'message': dict(message)})
+        conn = CaptureConnection('alice')
+        for request in requests:
+            if request['type'] == 'register':
+                request = dict(request, codecs=[codec_name], compression=[])
+            server.process_message(conn, request)
+        markers = {frame[HEADER.size] for frame in conn.sent[1:]}
+        if conn.codec.name != codec_name or markers != {encode_payload({}, conn.codec)[0]}:
+            print(f"ОШИБКА: сервер не перешел на кодек {codec_name}")
+            ok = False
+        # Время нового сообщения у каждого прогона свое - его не сравниваем
+        received[codec_name] = [dict(msg, timestamp=None) if msg['type'] == 'group_message' else msg
+                                for msg in conn.messages if msg['type'] != 'server_ip_assigned']
+        server.storage.close()
+    same = all(messages == received['json'] for messages in received.values())
+    print(f"Ответы сервера во всех кодеках совпадают с JSON: {'OK' if same else 'ОШИБКА'}")
+    return ok and same
+
+
+def chat_list_update(count, bumped=()):
+    """Полный список чатов (chats_update) из count чатов; bumped - чаты с самым новым сообщением"""
+    start = datetime(2026, 1, 1)
+    private_chats, group_chats = [], []
+    for i in range(count):
+        when = start + timedelta(minutes=count + 1 if i in bumped else i)
+        last_message = {'from': f"user{i}", 'text': 'привет', 'timestamp': when.isoformat()}
+        if i % 2:
+            group_chats.append({'group_name': f"group{i}", 'creator': 'bench', 'last_message': last_message})
+        else:
+            private_chats.append({'user': f"user{i}", 'local_ip': '127.0.0.1', 'server_ip': '127.0.0.1',
+                                  'last_message': last_message})
+    return {'type': 'chats_update', 'version': 1, 'private_chats': private_chats, 'group_chats': group_chats}
+
+
+def bench_chat_list(counts, updates=100):
+    """Список чатов клиента: сверка с полным списком против пересоздания всех виджетов и поиск.
+
+    Нужен дисплей (Tk). Клиент подключается к слушающему сокету без сервера,
+    списки чатов подаются ему напрямую. Счетчики widget_stats показывают,
+    сколько виджетов создано, удалено, переставлено, показано и скрыто на каждом шаге.
+    """
+    import tkinter
+    from client import MessengerClient
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    print(f"Список чатов клиента, {updates} обновлений на замер")
+    print(f"{'чатов':>7} {'шаг':<34} {'мс':>9} {'создано':>8} {'удалено':>8} {'перемещено':>11} "
+          f"{'показано':>9} {'скрыто':>7}")
+    ok = True
+    for count in counts:
+        try:
+            client = MessengerClient(cache_dir=None, port=listener.getsockname()[1])
+        except tkinter.TclError as e:
+            print(f"Нужен дисплей для Tk: {e}")
+            return True
+        client.root.withdraw()
+        client.username = 'bench'
+
+        def step(title, apply, repeat=1):
+            stats = dict(client.widget_stats)
+            started = time.perf_counter()
+            for i in range(repeat):
+                apply(i)
+                client.root.update_idletasks()  # перестановка чатов выполняется в after_idle
+            elapsed = (time.perf_counter() - started) / repeat
+            delta = {key: (client.widget_stats[key] - stats[key]) / repeat for key in stats}
+            print(f"{count:>7} {title:<34} {elapsed * 1000:>9.2f} {delta['created']:>8.0f} "
+                  f"{delta['destroyed']:>8.0f} {delta['moved']:>11.1f} {delta['shown']:>9.1f} {delta['hidden']:>7.1f}")
+            return delta
+
+        full = chat_list_update(count)
+        step("первый список", lambda i: client.update_chats_list(full))
+        # Так обрабатывался каждый полный список раньше: все виджеты удалялись и создавались заново
+        empty = chat_list_update(0)
+        rebuild = step("пересоздание всех виджетов",
+                       lambda i: (client.update_chats_list(empty), client.update_chats_list(full)))
+        same = step("сверка: тот же список", lambda i: client.update_chats_list(full), updates)
+        lists = [chat_list_update(count, bumped={(i * 7919) % count}) for i in range(updates)]
+        bumped = step("сверка: новое сообщение в чате", lambda i: client.update_chats_list(lists[i]), updates)
+        client.chats_version = 0
+        event = step("событие last_message_changed",
+                     lambda i: client.handle_server_message({
+                         'type': 'last_message_changed', 'version': i + 1, 'kind': 'private',
+                         'user': f"user{(i * 7919 * 2) % count}",
+                         'last_message': {'timestamp': (datetime(2027, 1, 1) + timedelta(seconds=i)).isoformat()}}),
+                     updates)
+
+        def search(query):
+            client.search_entry.delete(0, tkinter.END)
+            client.search_entry.insert(0, query)
+            client.apply_search()
+
+        # Поиск применяется на каждую букву (без задержки ввода): каждая следующая скрывает часть чатов
+        query = "group1"
+        step(f"поиск '{query}' по буквам", lambda i: search(query[:i + 1]), len(query))
+        found = len(client.chat_order) - len(client.hidden_chats)
+        expected = sum(query in name.lower() for name in client.chat_order)
+        step("сброс поиска", lambda i: search(""))
+
+        # Без изменений ни один виджет не трогается; новое сообщение переставляет только свой чат
+        # (и в сверке - чат, поднятый на предыдущем шаге, который возвращается на место)
+        order = [client.chat_time(name) for name in client.chat_order]
+        passed = (rebuild['created'] == count and same['created'] == same['destroyed'] == same['moved'] == 0
+                  and bumped['created'] == 0 and bumped['moved'] <= 2 and event['moved'] <= 1
+                  and order == sorted(order, reverse=True) and found == expected and not client.hidden_chats)
+        ok = ok and passed
+        print(f"{count:>7} {'проверка':<34} {'OK' if passed else 'ОШИБКА':>9}")
+        client.socket.close()
+        client.root.destroy()
+    listener.close()
+    return ok
+
+
+def check_client_logic(chats=2000, seed=1):
+    """Проверка логики клиента, не требующей дисплея.
+
+    Сверка списка чатов (unmoved_chats) сравнивается с перебором, поиск
+    ChatSearchIndex - с проверкой подстроки по всем чатам при вводе по буквам
+    и изменении чатов, кэш MessageCache - с ожидаемым содержимым после
+    ограничений размера, coalesce_inbox - с ожидаемой пачкой.
+    """
+    import random
+    from client import ChatSearchIndex, MessengerClient, unmoved_chats
+    from client_cache import MessageCache
+
+    rng = random.Random(seed)
+    checks = {}
+
+    # unmoved_chats: наибольший набор чатов, сохраняющий взаимный порядок
+    def longest_kept(order, desired):
+        position = [order.index(name) for name in desired]
+        lengths = [1] * len(position)
+        for i in range(len(position)):
+            for j in range(i):
+                if position[j] < position[i]:
+                    lengths[i] = max(lengths[i], lengths[j] + 1)
+        return max(lengths, default=0)
+
+    def kept_in_order(order, desired, unmoved):
+        kept = [name for name in desired if name in unmoved]
+        return kept == [name for name in order if name in unmoved]
+
+    names = [f"chat{i}" for i in range(chats)]
+    bumped = names[:500] + names[501:]
+    bumped.insert(0, names[500])
+    ok = unmoved_chats(names, names) == set(names) and unmoved_chats([], []) == set()
+    ok = ok and unmoved_chats(names, bumped) == set(names) - {names[500]}
+    ok = ok and len(unmoved_chats(names, names[::-1])) == 1
+    for _ in range(50):
+        order = names[:rng.randint(1, 60)]
+        desired = rng.sample(order, len(order))
+        unmoved = unmoved_chats(order, desired)
+        ok = ok and len(unmoved) == longest_kept(order, desired) and kept_in_order(order, desired, unmoved)
+    checks['unmoved_chats'] = ok
+
+    # ChatSearchIndex: результат совпадает с проверкой подстроки по всем чатам
+    words = ['отдел', 'продаж', 'group', 'привет', 'user', 'бухгалтерия', 'a', 'ab']
+    index, texts = ChatSearchIndex(), {}
+
+    def random_text():
+        return ' '.join(rng.choice(words) + str(rng.randint(0, 30)) for _ in range(rng.randint(1, 4)))
+
+    for name in names:
+        texts[name] = random_text()
+        index.update(name, texts[name])
+    ok = True
+    for step in range(200):
+        if step % 3 == 0:
+            name = rng.choice(names)
+            if rng.random() < 0.2:
+                index.remove(name)
+                texts.pop(name, None)
+            else:
+                texts[name] = random_text()
+                index.update(name, texts[name])
+        query = (rng.choice(words) + str(rng.randint(0, 30)))[:rng.randint(1, 8)]
+        for length in range(len(query) + 1):  # ввод по буквам
+            if rng.random() < 0.3:
+                # Чат меняется во время ввода: новый текст подходит под продолжение запроса
+                name = rng.choice(names)
+                texts[name] = f"{random_text()} {query}"
+                index.update(name, texts[name])
+            typed = query[:length].upper() if step % 2 else query[:length]
+            expected = {name for name, text in texts.items() if typed.lower() in text.lower()}
+            ok = ok and index.search(typed) == expected
+    checks['ChatSearchIndex'] = ok
+
+    # MessageCache: хвост истории каждого чата и вытеснение давно открывавшихся чатов
+    directory = tempfile.mkdtemp()
+    cache = MessageCache(os.path.join(directory, 'cache.db'), chat_limit=10, total_limit=35)
+
+    def messages(first, last):
+        return [{'seq': seq, 'text': f"m{seq}"} for seq in range(first, last + 1)]
+
+    cache.add('group_a', messages(1, 30) + [{'text': 'без seq'}])
+    cache.commit()
+    ok = [msg['seq'] for msg in cache.load('group_a')] == list(range(21, 31)) and cache.count == 10
+    cache.commit()  # открытие чата записывается как использование
+    for chat_key in ('group_b', 'group_c', 'group_d'):
+        time.sleep(0.01)  # время использования чатов различается
+        cache.add(chat_key, messages(1, 10))
+        cache.commit()
+    # В кэше 40 сообщений при пределе 35: вытесняется чат, открывавшийся давнее всех (group_a)
+    ok = ok and cache.load('group_a') == [] and cache.count == 30
+    time.sleep(0.01)
+    cache.load('group_b')
+    cache.add('group_e', messages(5, 14))
+    cache.commit()
+    ok = ok and cache.load('group_c') == [] and len(cache.load('group_b')) == 10
+    cache.rename('group_d', 'group_f')
+    cache.commit()
+    rows = cache.db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+    ok = ok and cache.load('group_d') == [] and len(cache.load('group_f')) == 10
+    ok = ok and cache.count == rows == 30 and cache.stats() == {'messages': 30, 'chats': 3}
+    cache.close()
+    checks['MessageCache'] = ok
+
+    # coalesce_inbox: изменения списка чатов до полного списка отбрасываются
+    message = {'type': 'private_message', 'text': 'x'}
+    added = {'type': 'chat_added', 'version': 1}
+    full = {'type': 'chats_update', 'version': 2}
+    changed = {'type': 'last_message_changed', 'version': 3}
+    batch = [message, added, full, changed, None, message]
+    checks['coalesce_inbox'] = (
+        MessengerClient.coalesce_inbox(batch) == [message, full, changed, None, message] and
+        MessengerClient.coalesce_inbox([added, message, full, full]) == [message, full] and
+        MessengerClient.coalesce_inbox([full, added]) == [full, added] and
+        MessengerClient.coalesce_inbox([message, added]) == [message, added])
+
+    print("Логика клиента без дисплея")
+    for name, ok in checks.items():
+        print(f"  {name}: {'OK' if ok else 'ОШИБКА'}")
+    return all(checks.values())
+
+
+def stress_group(senders, messages, storage):
+    """Нагрузочная проверка: много потоков пишут в одну группу одновременно.
+
+    Параллельно идут контрольные точки и вступление/выход других участников.
+    Проверяется, что ни одно сообщение не потеряно и не задвоено ни в памяти,
+    ни после перезапуска из снимка и журнала.
+    """
+    print(f"Нагрузка на одну группу: {senders} потоков по {messages} сообщений")
+    server = make_server(storage)
+    names = [f"sender{i}" for i in range(senders)]
+    server.commit({'op': 'create_group', 'group': 'stress', 'creator': 'owner'})
+    for username in names + ['reader']:
+        server.commit({'op': 'join_group', 'group': 'stress', 'username': username})
+        server.clients[username] = NullConnection(username)
+
+    def send_all(username):
+        conn = server.clients[username]
+        for i in range(messages):
+            server.process_message(conn, {'type': 'group_message', 'from': username, 'group': 'stress',
+                                          'text': f"{username}:{i}"})
+
+    done = threading.Event()
+
+    def background():
+        # Изменения состава группы и снимки во время рассылки
+        i = 0
+        while not done.is_set():
+            guest = f"guest{i % 10}"
+            server.commit({'op': 'join_group', 'group': 'stress', 'username': guest})
+            server.commit({'op': 'leave_group', 'group': 'stress', 'username': guest})
+            if i % 20 == 0:
+                server.checkpoint()
+            i += 1
+
+    threads = [threading.Thread(target=send_all, args=(username,)) for username in names]
+    noise = threading.Thread(target=background)
+    started = time.perf_counter()
+    noise.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    noise.join()
+    elapsed = time.perf_counter() - started
+
+    expected = senders * messages
+    stored = group_texts(server.storage, 'stress')
+    delivered = server.clients['reader'].frames
+    server.storage.close()
+
+    # Перезапуск: сохраненные данные должны дать ту же историю
+    restarted = MessengerServer(port=0, storage=storage)
+    restored = group_texts(restarted.storage, 'stress')
+    restarted.storage.close()
+
+    in_order = all(
+        [text for text in stored if text.startswith(f"{username}:")] ==
+        [f"{username}:{i}" for i in range(messages)]
+        for username in names)
+    checks = {
+        'сохранено': len(stored) == expected and len(set(stored)) == expected,
+        'порядок отправителей': in_order,
+        'доставлено': delivered == expected,
+        'после перезапуска': restored == stored,
+    }
+    print(f"  {expected / elapsed:.0f} сообщений/с, сохранено {len(stored)}, "
+          f"доставлено {delivered}, после перезапуска {len(restored)}")
+    for name, ok in checks.items():
+        print(f"  {name}: {'OK' if ok else 'ОШИБКА'}")
+    return all(checks.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замеры производительности сервера мессенджера")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 500, 2000],
+                        help="Размеры групп для замера рассылки")
+    parser.add_argument('--rounds', type=int, default=200, help="Сообщений на каждый размер группы")
+    parser.add_argument('--storage', choices=STORAGE_BACKENDS, default='json', help="Хранилище данных сервера")
+    parser.add_argument('--stress', action='store_true',
+                        help="Нагрузочная проверка одной группы вместо замера рассылки")
+    parser.add_argument('--threads', type=int, default=32, help="Потоков-отправителей для --stress")
+    parser.add_argument('--messages', type=int, default=500, help="Сообщений от каждого потока для --stress")
+    parser.add_argument('--memory', action='store_true',
+                        help="Замер памяти под историю: словари против компактных записей")
+    parser.add_argument('--count', type=int, default=1000000, help="Сообщений для --memory")
+    parser.add_argument('--workers', type=int, nargs='*',
+                        help="Замер сервера из указанного числа процессов (по умолчанию 1 2 4 8)")
+    parser.add_argument('--clients', type=int, default=64, help="Клиентов для --workers")
+    parser.add_argument('--seconds', type=float, default=5, help="Длительность одного замера --workers")
+    parser.add_argument('--compression', action='store_true',
+                        help="Размер и время больших ответов (история, список чатов) со сжатием и без")
+    parser.add_argument('--reconnect', type=int, nargs='*',
+                        help="Стоимость повторного входа для историй указанного объема (по умолчанию 1000 10000 100000)")
+    parser.add_argument('--codecs', action='store_true',
+                        help="Размер и скорость кодеков сообщений для каждого типа сообщения протокола")
+    parser.add_argument('--federation', action='store_true',
+                        help="Проверка маршрутизации между узлами (падение узла, разделение сети)")
+    parser.add_argument('--chat-list', type=int, nargs='*',
+                        help="Список чатов клиента указанного размера: сверка против пересоздания "
+                             "(по умолчанию 1000 5000, нужен дисплей)")
+    parser.add_argument('--client-logic', action='store_true',
+                        help="Проверка логики клиента без дисплея: сверка списка чатов, поиск, локальный кэш")
+    parser.add_argument('--startup', type=int, nargs='*',
+                        help="Замер времени запуска для историй указанного объема (по умолчанию 10000 100000 500000)")
+    args = parser.parse_args()
+
+    if args.workers is not None:
+        bench_workers(args.workers or [1, 2, 4, 8], args.clients, args.seconds)
+        sys.exit(0)
+    if args.reconnect is not None:
+        sys.exit(0 if bench_reconnect(args.reconnect or [1000, 10000, 100000], args.storage) else 1)
+    if args.chat_list is not None:
+        sys.exit(0 if bench_chat_list(args.chat_list or [1000, 5000]) else 1)
+    if args.startup is not None:
+        bench_startup(args.startup or [10000, 100000, 500000])
+        sys.exit(0)
+
+    if args.compression:
+        sys.exit(0 if bench_compression(args.storage) else 1)
+    if args.codecs:
+        sys.exit(0 if bench_codecs(args.storage) else 1)
+    if args.federation:
+        sys.exit(0 if check_federation() else 1)
+    if args.client_logic:
+        sys.exit(0 if check_client_logic() else 1)
+    if args.memory:
+        sys.exit(0 if bench_message_memory(args.count) else 1)
+    if args.stress:
+        sys.exit(0 if stress_group(args.threads, args.messages, args.storage) else 1)
+    bench_group_fanout(args.sizes, args.rounds, args.storage)
@@ -1,16 +1,275 @@
+import argparse
+import bisect
 import socket
 import threading
-import json
+import queue
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog
 from datetime import datetime
 import time
 import sys
+import os
+from urllib.parse import quote
+
+from client_cache import CACHE_CHAT_LIMIT, CACHE_TOTAL_LIMIT, MessageCache
+from codec import CODEC_NAMES, JSON_CODEC, get_codec
+from protocol import COMPRESSION_METHODS, FrameReader, decode_message, send_message
+
+
+HISTORY_PAGE_SIZE = 50  # сообщений в одной странице истории
+SYNC_PAGE_SIZE = 500  # сообщений в одной странице догрузки после последнего известного
+# Кодеки сообщений в порядке предпочтения, предлагаемые серверу при входе. Компактные
+# (msgpack, binary) экономят около трети трафика, но медленнее JSON на стороне Python
+CLIENT_CODECS = ('json',)
+INBOX_INTERVAL = 30  # мс между разборами входящих сообщений в потоке интерфейса
+INBOX_BATCH_SIZE = 500  # сообщений за один разбор; остальные - на следующем такте
+# Изменения списка чатов: полный список перекрывает все, что пришло до него
+CHAT_LIST_TYPES = ('chats_update', 'chat_added', 'chat_removed', 'chat_renamed', 'last_message_changed')
+RENDER_WINDOW = 200  # сообщений, показываемых при открытии чата
+RENDER_PAGE = 200  # сообщений, добавляемых сверху при прокрутке к началу
+RENDER_LIMIT = 1000  # сообщений в области, после которых самые старые из нее убираются
+SEARCH_DELAY = 150  # мс после последнего нажатия клавиши до применения поиска по чатам
+
+
+def unmoved_chats(order, desired):
+    """Чаты, которые можно не перемещать при переходе от order к desired.
+
+    Это наибольшая подпоследовательность desired, идущая в том же порядке,
+    что и в order: остальные чаты переставляются относительно нее. Когда
+    новое сообщение поднимает один чат наверх, перемещается только он.
+    """
+    position = {name: index for index, name in enumerate(order)}
+    tails, tail_names, links = [], [], {}  # наибольшая возрастающая подпоследовательность позиций
+    for name in desired:
+        index = position[name]
+        length = bisect.bisect_left(tails, index)
+        links[name] = tail_names[length - 1] if length else None
+        if length == len(tails):
+            tails.append(index)
+            tail_names.append(name)
+        else:
+            tails[length] = index
+            tail_names[length] = name
+    unmoved = set()
+    name = tail_names[-1] if tail_names else None
+    while name is not None:
+        unmoved.add(name)
+        name = links[name]
+    return unmoved
 
 
-class MessengerClient:
+class ChatSearchIndex:
+    """Индекс поиска по чатам: подстрока (в том числе начало) в тексте чата.
+
+    Текст чата - имя, участники и последнее сообщение, в нижнем регистре.
+    Кандидаты для запроса от трех символов берутся из индекса триграмм,
+    для более коротких проверяются все чаты. Запрос, содержащий предыдущий
+    (ввод по букве), проверяется только на результатах предыдущего.
+    """
+
     def __init__(self):
+        self.texts = {}  # chat_name -> текст для поиска
+        self.trigrams = {}  # триграмма -> множество chat_name, в тексте которых она есть
+        self.last_query = None  # последний запрос и его результат
+        self.last_result = None
+
+    @staticmethod
+    def grams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def update(self, chat_name, text):
+        """Индексация текста чата; False - текст не изменился"""
+        text = text.lower()
+        if self.texts.get(chat_name) == text:
+            return False
+        self.remove(chat_name)
+        self.texts[chat_name] = text
+        self.last_query = self.last_result = None
+        for gram in self.grams(text):
+            self.trigrams.setdefault(gram, set()).add(chat_name)
+        return True
+
+    def remove(self, chat_name):
+        text = self.texts.pop(chat_name, None)
+        if text is None:
+            return
+        self.last_query = self.last_result = None
+        for gram in self.grams(text):
+            names = self.trigrams[gram]
+            names.discard(chat_name)
+            if not names:
+                del self.trigrams[gram]
+
+    def matches(self, chat_name, query):
+        return query in self.texts.get(chat_name, '')
+
+    def search(self, query):
+        """Множество чатов, в тексте которых есть query"""
+        query = query.lower()
+        if self.last_query is not None and self.last_query in query:
+            candidates = self.last_result
+        elif len(query) >= 3:
+            # Пересекаем множества триграмм запроса, начиная с самого маленького
+            postings = sorted((self.trigrams.get(gram, ()) for gram in self.grams(query)), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+        else:
+            candidates = self.texts
+        result = {name for name in candidates if query in self.texts[name]}
+        self.last_query, self.last_result = query, result
+        return result
+
+
+class ChatPane:
+    """Область сообщений открытого чата.
+
+    Строки сообщений форматируются один раз и хранятся по чатам, поэтому
+    повторное открытие чата их не форматирует. В виджет вставляется только
+    окно последних RENDER_WINDOW сообщений: более старые добавляются сверху
+    страницами при прокрутке к началу, новые - в конец без перерисовки.
+    """
+
+    def __init__(self, area, histories):
+        self.area = area
+        self.histories = histories  # chat_key -> список сообщений (общий с клиентом)
+        # chat_key -> [номер первого отформатированного сообщения истории, строки с него до конца]
+        self.cache = {}
+        self.chat_key = None  # чат, показанный в области
+        self.shown_from = 0  # номер первого показанного сообщения в истории чата
+        self.placeholder = False  # вместо сообщений показана надпись "Нет сообщений"
+        self.pending = []  # строки новых сообщений, ожидающие вставки в конец (см. flush)
+
+    @staticmethod
+    def format_message(msg):
+        """Строка сообщения для области сообщений"""
+        timestamp = msg.get('timestamp') or datetime.now().isoformat()
+        if len(timestamp) >= 16 and timestamp[10] == 'T':
+            time_str = timestamp[11:16]  # часы и минуты из isoformat без разбора даты
+        else:
+            time_str = datetime.fromisoformat(timestamp).strftime("%H:%M")
+        # Для всех сообщений показываем оба IP
+        ip_info = f"локальный: {msg.get('local_ip', 'Неизвестно')}, серверный: {msg.get('server_ip', 'Неизвестно')}"
+        return f"[{time_str}] {msg['from']} ({ip_info}): {msg['text']}\n"
+
+    def formatted(self, chat_key, start):
+        """Кэш строк чата, в котором отформатированы все сообщения начиная со start"""
+        history = self.histories.get(chat_key, [])
+        entry = self.cache.get(chat_key)
+        if entry is None or len(entry[1]) != len(history) - entry[0]:
+            # Чат еще не показывался или история изменилась в обход ChatPane
+            entry = self.cache[chat_key] = [len(history), []]
+        if start < entry[0]:
+            entry[1][:0] = [self.format_message(msg) for msg in history[start:entry[0]]]
+            entry[0] = start
+        return entry
+
+    def lines(self, start, end):
+        """Строки сообщений показанного чата с номерами от start до end"""
+        offset, lines = self.formatted(self.chat_key, start)
+        return lines[start - offset:end - offset]
+
+    def show(self, chat_key):
+        """Показ чата: окно последних сообщений из кэша строк"""
+        self.chat_key = chat_key
+        self.pending.clear()
+        count = len(self.histories.get(chat_key, []))
+        self.shown_from = max(count - RENDER_WINDOW, 0)
+        self.placeholder = not count
+
+        self.area.config(state=tk.NORMAL)
+        self.area.delete(1.0, tk.END)
+        self.area.insert(tk.END, ''.join(self.lines(self.shown_from, count)) if count else "Нет сообщений\n")
+        self.area.see(tk.END)
+        self.area.config(state=tk.DISABLED)
+
+    def clear(self):
+        """Очистка области: ни один чат не показан"""
+        self.chat_key = None
+        self.pending.clear()
+        self.placeholder = False
+        self.area.config(state=tk.NORMAL)
+        self.area.delete(1.0, tk.END)
+        self.area.config(state=tk.DISABLED)
+
+    def appended(self, chat_key, messages, flush=True):
+        """Сообщения, уже добавленные в конец истории чата (flush=False - вставить позже одним куском)"""
+        entry = self.cache.get(chat_key)
+        if entry is None and chat_key != self.chat_key:
+            return
+        lines = [self.format_message(msg) for msg in messages]
+        if entry is not None:
+            entry[1].extend(lines)
+        if chat_key == self.chat_key:
+            self.pending.extend(lines)
+            if flush:
+                self.flush()
+
+    def flush(self):
+        """Вставка накопленных новых строк одним insert и одной прокруткой"""
+        if not self.pending:
+            return
+        self.area.config(state=tk.NORMAL)
+        if self.placeholder:
+            self.area.delete(1.0, tk.END)
+            self.placeholder = False
+        self.area.insert(tk.END, ''.join(self.pending))
+        self.pending.clear()
+        self.trim()
+        self.area.see(tk.END)
+        self.area.config(state=tk.DISABLED)
+
+    def trim(self):
+        """Удаление из виджета самых старых сообщений, когда их больше RENDER_LIMIT"""
+        count = len(self.histories.get(self.chat_key, []))
+        if count - self.shown_from <= RENDER_LIMIT:
+            return
+        start = count - RENDER_WINDOW
+        # Сообщение может занимать несколько строк виджета
+        rows = sum(line.count('\n') for line in self.lines(self.shown_from, start))
+        self.area.delete('1.0', f"{rows + 1}.0")
+        self.shown_from = start
+
+    def reveal_older(self):
+        """Показ сверху следующей страницы уже загруженных сообщений. False - показывать больше нечего"""
+        if self.chat_key is None or self.shown_from == 0:
+            return False
+        start = max(self.shown_from - RENDER_PAGE, 0)
+        page = self.lines(start, self.shown_from)
+        self.shown_from = start
+
+        self.area.config(state=tk.NORMAL)
+        self.area.insert('1.0', ''.join(page))
+        # Оставляем на месте сообщение, которое было верхним до вставки
+        self.area.yview(f"{sum(line.count(chr(10)) for line in page) + 1}.0")
+        self.area.config(state=tk.DISABLED)
+        return True
+
+    def prepended(self, chat_key, messages):
+        """Более старые сообщения, уже добавленные в начало истории чата"""
+        entry = self.cache.get(chat_key)
+        if entry is not None:
+            entry[0] += len(messages)
+        if chat_key == self.chat_key and messages:
+            self.shown_from += len(messages)
+            self.reveal_older()
+
+    def reset(self, chat_key):
+        """История чата заменена целиком: строки будут отформатированы заново"""
+        self.cache.pop(chat_key, None)
+
+    def rename(self, old_key, new_key):
+        if old_key in self.cache:
+            self.cache[new_key] = self.cache.pop(old_key)
+        if self.chat_key == old_key:
+            self.chat_key = new_key
+
+
+class MessengerClient:
+    def __init__(self, codecs=CLIENT_CODECS, cache_dir='.', cache_chat_limit=CACHE_CHAT_LIMIT,
+                 cache_total_limit=CACHE_TOTAL_LIMIT, host='localhost', port=5000):
         self.socket = None
+        self.server_address = (host, port)
+        self.codecs = [name for name in codecs if name in CODEC_NAMES]  # без недоступных здесь кодеков
+        self.codec = JSON_CODEC  # кодек отправки, согласованный с сервером
         self.username = None
         self.user_ip = self.get_local_ip()
         self.server_ip = None  # IP, который видит серверы
@@ -23,9 +282,33 @@ class MessengerClient:
         self.user_server_ips = {}  # username -> серверные IP
         self.group_members = {}  # group_name -> list of members with IPs
         self.pending_member_requests = set()  # group_name для которых запрошены участники
+        self.send_lock = threading.Lock()  # отправка идет и из GUI, и из потока приема
+        self.loading_older = set()  # chat_key, для которых уже запрошена более старая страница
+        # Локальный кэш сообщений (None - без кэша); открывается при входе, файл на пользователя
+        self.cache_dir = cache_dir
+        self.cache_limits = (cache_chat_limit, cache_total_limit)
+        self.cache = None
+        self.synced = set()  # chat_key, догруженные с сервера в этом сеансе (дальше их пополняют новые сообщения)
+        self.syncing = set()  # chat_key, для которых ждем ответа на догрузку
+        self.chats_version = None  # версия списка чатов; None - ждем полный список
+        self.last_messages = {}  # chat_name -> последнее сообщение чата
+        self.chat_order = []  # chat_name в порядке показа: чаты с более новым последним сообщением выше
+        self.chat_order_dirty = False  # порядок пересчитывается один раз, когда Tk освободится
+        self.search_index = ChatSearchIndex()
+        self.search_query = ''  # примененный поисковый запрос в нижнем регистре
+        self.search_job = None  # отложенное применение поиска (after)
+        self.hidden_chats = set()  # chat_name, скрытые поиском
+        # Счетчики операций с виджетами списка чатов (для замеров)
+        self.widget_stats = {'created': 0, 'destroyed': 0, 'renamed': 0, 'moved': 0, 'shown': 0, 'hidden': 0}
+        # Поток приема только разбирает кадры в эту очередь, виджеты меняет главный поток Tk
+        self.inbox = queue.Queue()
+        self.receive_error = None  # ошибка, на которой остановился поток приема
+        self.draining = False  # идет разбор пачки входящих сообщений
+        self.pending_status = None  # последнее уведомление пачки для строки состояния
 
         self.setup_gui()
         self.connect_to_server()
+        self.root.after(INBOX_INTERVAL, self.process_inbox)
 
     def get_local_ip(self):
         try:
@@ -156,11 +439,12 @@ class MessengerClient:
         self.chat_area = tk.Text(messages_frame, state=tk.DISABLED, font=('Arial', 10), 
                                 bg=self.colors['light'], fg=self.colors['dark'],
                                 relief='flat', padx=10, pady=10)
-        scrollbar_messages = ttk.Scrollbar(messages_frame, orient=tk.VERTICAL, command=self.chat_area.yview)
-        self.chat_area.config(yscrollcommand=scrollbar_messages.set)
+        self.scrollbar_messages = ttk.Scrollbar(messages_frame, orient=tk.VERTICAL, command=self.chat_area.yview)
+        self.chat_area.config(yscrollcommand=self.on_chat_scroll)
 
         self.chat_area.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        scrollbar_messages.pack(side=tk.RIGHT, fill=tk.Y)
+        self.chat_pane = ChatPane(self.chat_area, self.chat_history)
+        self.scrollbar_messages.pack(side=tk.RIGHT, fill=tk.Y)
 
         # Панель ввода сообщения
         input_frame = ttk.Frame(right_frame, style='TFrame')
@@ -193,11 +477,21 @@ class MessengerClient:
         chat_frame = ttk.Frame(self.chat_scrollable_frame, style='TFrame')
         chat_frame.pack(fill=tk.X, padx=5, pady=2)
 
+        # Кнопки берут имя, данные и создателя из widget_info: их можно менять без пересоздания виджета
+        widget_info = {
+            'frame': chat_frame,
+            'name': chat_name,
+            'type': chat_type,
+            'data': chat_data,
+            'creator': creator,
+            'shown': True  # виджет показан (не скрыт поиском)
+        }
+
         # Основная кнопка чата
         chat_button = ttk.Button(
             chat_frame,
             text=chat_name,
-            command=lambda: self.select_chat(chat_name, chat_type, chat_data),
+            command=lambda: self.select_chat(widget_info['name'], widget_info['type'], widget_info['data']),
             width=30,
             style='TButton'
         )
@@ -205,21 +499,20 @@ class MessengerClient:
 
         # Кнопка меню (три точки)
         menu_button = ttk.Button(chat_frame, text="⋯", width=2,
-                                 command=lambda: self.show_chat_menu(chat_name, chat_type, chat_data, menu_button,
-                                                                     creator))
+                                 command=lambda: self.show_chat_menu(widget_info['name'], widget_info['type'],
+                                                                     widget_info['data'], menu_button,
+                                                                     widget_info['creator']))
         menu_button.pack(side=tk.RIGHT)
 
-        self.chat_widgets[chat_name] = {
-            'frame': chat_frame,
-            'button': chat_button,
-            'menu_button': menu_button,
-            'type': chat_type,
-            'data': chat_data
-        }
+        widget_info['button'] = chat_button
+        widget_info['menu_button'] = menu_button
+        self.chat_widgets[chat_name] = widget_info
+        self.widget_stats['created'] += 1
 
-        # Для личных чатов сразу запрашиваем историю
-        if chat_type == 'private':
-            self.request_chat_history('private', chat_data)
+        # Новый чат встает в конец списка; его место по последнему сообщению определит reorder_chats
+        self.chat_order.append(chat_name)
+        self.request_reorder()
+        self.refresh_search(chat_name)
 
     def show_chat_menu(self, chat_name, chat_type, chat_data, menu_button, creator=None):
         """Показать меню для чата/группы"""
@@ -383,7 +676,7 @@ class MessengerClient:
             'username': self.username
         }
         try:
-            self.socket.send(json.dumps(message).encode('utf-8'))
+            self.send_to_server(message)
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось запросить список участников: {e}")
 
@@ -401,38 +694,87 @@ class MessengerClient:
             user_local_ip = self.user_ips.get(chat_data, 'Неизвестно')
             user_server_ip = self.user_server_ips.get(chat_data, 'Неизвестно')
             self.chat_title.config(text=f"Личный чат с {chat_data} (локальный: {user_local_ip}, серверный: {user_server_ip})")
-            # Для личных чатов используем локальную историю
-            self.display_local_chat_history(chat_data)
         else:
             self.current_chat_type = 'group'
             self.current_chat_id = chat_data
             self.chat_title.config(text=f"Группа: {chat_data}")
-            self.request_chat_history('group', chat_data)
-
-    def display_local_chat_history(self, user_id):
-        """Отображение локальной истории личного чата"""
-        chat_key = f"private_{user_id}"
-        history = self.chat_history.get(chat_key, [])
-
-        self.chat_area.config(state=tk.NORMAL)
-        self.chat_area.delete(1.0, tk.END)
 
-        if history:
-            for msg in history:
-                timestamp = datetime.fromisoformat(msg['timestamp']).strftime("%H:%M")
-                sender = msg['from']
-                local_ip = msg.get('local_ip', 'Неизвестно')
-                server_ip = msg.get('server_ip', 'Неизвестно')
-
-                # Для всех сообщений показываем оба IP
-                ip_info = f"локальный: {local_ip}, серверный: {server_ip}"
-
-                self.chat_area.insert(tk.END, f"[{timestamp}] {sender} ({ip_info}): {msg['text']}\n")
+        # Сразу показываем историю из памяти или локального кэша, с сервера догружаем только новое
+        chat_key = f"{chat_type}_{chat_data}"
+        if self.load_cached(chat_key) or chat_type == 'private':
+            self.chat_pane.show(chat_key)
         else:
-            self.chat_area.insert(tk.END, "Нет сообщений\n")
-
-        self.chat_area.see(tk.END)
-        self.chat_area.config(state=tk.DISABLED)
+            self.chat_pane.clear()
+        if chat_key not in self.synced:
+            self.sync_chat(chat_type, chat_data)
+
+    def load_cached(self, chat_key):
+        """Загрузка истории чата из локального кэша, если ее еще нет в памяти. True - история есть"""
+        if chat_key not in self.chat_history and self.cache is not None:
+            history = self.cache.load(chat_key)
+            if history:
+                self.chat_history[chat_key] = history
+        return chat_key in self.chat_history
+
+    def top_seq(self, chat_key):
+        """Номер последнего сообщения чата, полученного от сервера (0 - таких нет)"""
+        for msg in reversed(self.chat_history.get(chat_key, ())):
+            if msg.get('seq') is not None:
+                return msg['seq']
+        return 0
+
+    def oldest_seq(self, chat_key):
+        """Номер первого сообщения истории в памяти - курсор для более старой страницы (None - старше нет)"""
+        history = self.chat_history.get(chat_key)
+        if history and (history[0].get('seq') or 0) > 1:
+            return history[0]['seq']
+        return None
+
+    def sync_chat(self, chat_type, chat_id):
+        """Догрузка с сервера сообщений новее последнего известного (без истории - последней страницы)"""
+        chat_key = f"{chat_type}_{chat_id}"
+        if chat_key in self.syncing:
+            return
+        self.syncing.add(chat_key)
+        self.request_chat_history(chat_type, chat_id, after=self.top_seq(chat_key) or None)
+
+    def append_history(self, chat_key, messages):
+        """Добавление новых сообщений в конец истории чата (и в область сообщений, если он открыт)"""
+        self.chat_history.setdefault(chat_key, []).extend(messages)
+        if self.cache is not None:
+            self.cache.add(chat_key, messages)
+        self.chat_pane.appended(chat_key, messages, flush=not self.draining)
+
+    def merge_history(self, chat_key, messages):
+        """Добавление сообщений сервера (по возрастанию seq) в историю чата.
+
+        Уже известные сообщения пропускаются. False - между историей и
+        сообщениями пропуск: сообщения не добавлены, чат нужно догрузить.
+        """
+        top = self.top_seq(chat_key)
+        fresh = [msg for msg in messages if msg['seq'] > top]
+        late = [msg for msg in messages if msg['seq'] <= top]
+        if late:
+            # Сообщение, обогнанное более новым (редко): вставляем на свое место
+            known = {msg.get('seq') for msg in self.chat_history[chat_key]}
+            late = [msg for msg in late if msg['seq'] not in known]
+            if late:
+                self.chat_history[chat_key].extend(late)
+                if self.cache is not None:
+                    self.cache.add(chat_key, late)
+                self.sort_history(chat_key)
+        if fresh and top and fresh[0]['seq'] != top + 1:
+            return False
+        if fresh:
+            self.append_history(chat_key, fresh)
+        return True
+
+    def sort_history(self, chat_key):
+        """Упорядочивание истории чата по seq (неподтвержденные свои сообщения - в конце)"""
+        self.chat_history[chat_key].sort(key=lambda msg: msg.get('seq') or float('inf'))
+        self.chat_pane.reset(chat_key)
+        if self.chat_pane.chat_key == chat_key:
+            self.chat_pane.show(chat_key)
 
     def rename_group(self, chat_name, group_name):
         """Переименование группы"""
@@ -446,7 +788,7 @@ class MessengerClient:
                 'new_name': new_name,
                 'username': self.username
             }
-            self.socket.send(json.dumps(message, ensure_ascii=False).encode('utf-8'))
+            self.send_to_server(message)
 
     def delete_group(self, chat_name, group_name):
         """Удаление группы"""
@@ -457,7 +799,7 @@ class MessengerClient:
                 'group_name': group_name,
                 'username': self.username
             }
-            self.socket.send(json.dumps(message).encode('utf-8'))
+            self.send_to_server(message)
 
     def leave_group(self, chat_name, group_name):
         """Покинуть группу"""
@@ -468,7 +810,7 @@ class MessengerClient:
                 'group_name': group_name,
                 'username': self.username
             }
-            self.socket.send(json.dumps(message).encode('utf-8'))
+            self.send_to_server(message)
 
     def delete_private_chat(self, chat_name, username):
         """Удаление личного чата"""
@@ -481,6 +823,10 @@ class MessengerClient:
             chat_key = f"private_{username}"
             if chat_key in self.chat_history:
                 del self.chat_history[chat_key]
+            self.chat_pane.reset(chat_key)
+            self.synced.discard(chat_key)
+            if self.cache is not None:
+                self.cache.forget(chat_key)
 
             # Если этот чат был выбран, сбрасываем выбор
             if self.current_chat == chat_name:
@@ -491,6 +837,10 @@ class MessengerClient:
         if chat_name in self.chat_widgets:
             self.chat_widgets[chat_name]['frame'].destroy()
             del self.chat_widgets[chat_name]
+            self.chat_order.remove(chat_name)
+            self.hidden_chats.discard(chat_name)
+            self.search_index.remove(chat_name)
+            self.widget_stats['destroyed'] += 1
 
             # Также удаляем из внутренних словарей
             if chat_name in self.private_chats:
@@ -501,20 +851,133 @@ class MessengerClient:
                     del self.group_creators[chat_name]
 
     def filter_chats(self, event):
-        """Фильтрация чатов по поисковому запросу"""
-        search_text = self.search_entry.get().lower()
-
-        # Показываем/скрываем чаты в зависимости от поискового запроса
-        for chat_name, widget_info in self.chat_widgets.items():
-            if search_text in chat_name.lower():
-                widget_info['frame'].pack(fill=tk.X, padx=5, pady=2)
-            else:
-                widget_info['frame'].pack_forget()
+        """Фильтрация чатов по поисковому запросу: применяется через SEARCH_DELAY мс после последнего нажатия"""
+        if self.search_job is not None:
+            self.root.after_cancel(self.search_job)
+        self.search_job = self.root.after(SEARCH_DELAY, self.apply_search)
+
+    def apply_search(self):
+        """Показ чатов, подходящих под запрос; меняются только виджеты, у которых меняется видимость"""
+        self.search_job = None
+        self.search_query = self.search_entry.get().strip().lower()
+        if self.search_query:
+            hidden = self.chat_widgets.keys() - self.search_index.search(self.search_query)
+        else:
+            hidden = set()
+
+        for chat_name in hidden - self.hidden_chats:
+            self.set_chat_shown(chat_name, False)
+        shown = self.hidden_chats - hidden
+        if shown:
+            # Снизу вверх: показанный чат встает перед следующим показанным, и порядок списка сохраняется
+            position = {chat_name: index for index, chat_name in enumerate(self.chat_order)}
+            for chat_name in sorted(shown, key=position.get, reverse=True):
+                self.set_chat_shown(chat_name, True, position[chat_name])
+
+    def set_chat_shown(self, chat_name, shown, index=None):
+        """Показ или скрытие виджета чата (поиском)"""
+        widget_info = self.chat_widgets[chat_name]
+        if widget_info['shown'] == shown:
+            return
+        widget_info['shown'] = shown
+        self.widget_stats['shown' if shown else 'hidden'] += 1
+        if shown:
+            self.hidden_chats.discard(chat_name)
+            self.place_chat_widget(self.chat_order.index(chat_name) if index is None else index)
+        else:
+            self.hidden_chats.add(chat_name)
+            widget_info['frame'].pack_forget()
+
+    def search_text(self, chat_name):
+        """Текст чата для поиска: имя, участники группы (если загружены) и последнее сообщение"""
+        widget_info = self.chat_widgets[chat_name]
+        fields = [chat_name]
+        if widget_info['type'] == 'group':
+            fields.extend(member['username'] for member in self.group_members.get(widget_info['data'], []))
+        last_message = self.last_messages.get(chat_name)
+        if last_message and last_message.get('text'):
+            fields.append(last_message['text'])
+        # Перевод строки не встречается в запросе: совпадение не захватывает два поля сразу
+        return '\n'.join(fields)
+
+    def refresh_search(self, chat_name):
+        """Переиндексация чата после изменения его текста; при активном поиске - обновление его видимости"""
+        if chat_name in self.chat_widgets and self.search_index.update(chat_name, self.search_text(chat_name)):
+            if self.search_query:
+                self.set_chat_shown(chat_name, self.search_index.matches(chat_name, self.search_query))
+
+    def set_last_message(self, chat_name, message):
+        """Последнее сообщение чата: от него зависят место чата в списке и поиск по тексту"""
+        self.last_messages[chat_name] = message
+        if chat_name in self.chat_widgets:
+            self.refresh_search(chat_name)
+            self.request_reorder()
+
+    def chat_time(self, chat_name):
+        """Время последнего сообщения чата ('' - сообщений нет)"""
+        return (self.last_messages.get(chat_name) or {}).get('timestamp') or ''
+
+    def request_reorder(self):
+        """Пересчет порядка чатов после текущей работы Tk: изменения пачки сообщений или полного списка - одним проходом"""
+        if not self.chat_order_dirty:
+            self.chat_order_dirty = True
+            self.root.after_idle(self.reorder_chats)
+
+    def reorder_chats(self):
+        """Расстановка чатов по времени последнего сообщения (новые выше) с минимумом перемещений"""
+        if not self.chat_order_dirty:
+            return
+        self.chat_order_dirty = False
+        # Сортировка устойчива: чаты без сообщений и с равным временем сохраняют взаимный порядок
+        desired = sorted(self.chat_order, key=self.chat_time, reverse=True)
+        if desired == self.chat_order:
+            return
+        unmoved = unmoved_chats(self.chat_order, desired)
+        self.chat_order = desired
+        # Снизу вверх: к моменту перемещения чата все чаты ниже него уже на своих местах
+        for index in range(len(desired) - 1, -1, -1):
+            if desired[index] not in unmoved:
+                self.place_chat_widget(index)
+                self.widget_stats['moved'] += 1
+
+    def place_chat_widget(self, index):
+        """Установка показанного виджета chat_order[index] перед следующим показанным чатом списка"""
+        frame = self.chat_widgets[self.chat_order[index]]['frame']
+        if not self.chat_widgets[self.chat_order[index]]['shown']:
+            return
+        for below in range(index + 1, len(self.chat_order)):
+            widget_info = self.chat_widgets[self.chat_order[below]]
+            if widget_info['shown']:
+                frame.pack(fill=tk.X, padx=5, pady=2, before=widget_info['frame'])
+                return
+        # Ниже показанных чатов нет: в конец списка
+        frame.pack_forget()
+        frame.pack(fill=tk.X, padx=5, pady=2)
+
+    def rename_chat_widget(self, old_chat, new_chat, chat_data):
+        """Переименование виджета чата без пересоздания"""
+        widget_info = self.chat_widgets.pop(old_chat)
+        widget_info['name'] = new_chat
+        widget_info['data'] = chat_data
+        widget_info['button'].config(text=new_chat)
+        self.chat_widgets[new_chat] = widget_info
+        self.chat_order[self.chat_order.index(old_chat)] = new_chat
+        if old_chat in self.hidden_chats:
+            self.hidden_chats.discard(old_chat)
+            self.hidden_chats.add(new_chat)
+        self.search_index.remove(old_chat)
+        self.refresh_search(new_chat)
+        self.widget_stats['renamed'] += 1
+
+    def send_to_server(self, message):
+        """Отправка сообщения серверу целым кадром"""
+        with self.send_lock:
+            send_message(self.socket, message, self.codec)
 
     def connect_to_server(self):
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect(('localhost', 5000))
+            self.socket.connect(self.server_address)
             self.status_var.set("Подключено к серверу")
 
             # Запускаем поток для приема сообщений
@@ -532,10 +995,15 @@ class MessengerClient:
             register_msg = {
                 'type': 'register',
                 'username': username,
-                'local_ip': self.user_ip  # Отправляем локальный IP
+                'local_ip': self.user_ip,  # Отправляем локальный IP
+                'compression': list(COMPRESSION_METHODS),  # Большие ответы сервер может присылать сжатыми
+                'codecs': self.codecs  # Ответы в любом кодеке разбираются по первому байту кадра
             }
+            # Вход всегда в JSON: его понимает любой сервер
+            self.codec = JSON_CODEC
             try:
-                self.socket.send(json.dumps(register_msg).encode('utf-8'))
+                self.send_to_server(register_msg)
+                self.open_cache()
 
                 self.login_frame.pack_forget()
                 self.main_frame.pack(fill=tk.BOTH, expand=True)
@@ -548,6 +1016,18 @@ class MessengerClient:
             except Exception as e:
                 messagebox.showerror("Ошибка", f"Не удалось зарегистрироваться: {e}")
 
+    def open_cache(self):
+        """Открытие локального кэша сообщений пользователя"""
+        if self.cache_dir is None or self.cache is not None:
+            return
+        path = os.path.join(self.cache_dir, f"client_cache_{quote(self.username, safe='')}.db")
+        try:
+            self.cache = MessageCache(path, *self.cache_limits)
+        except Exception as e:
+            # Без кэша клиент работает как раньше: история запрашивается у сервера
+            self.cache = None
+            self.status_var.set(f"Локальный кэш недоступен: {e}")
+
     def get_server_ip(self):
         """Получение серверного IP пользователя"""
         # В реальном приложении сервер должен отправлять IP пользователя
@@ -571,7 +1051,7 @@ class MessengerClient:
             if chat_name not in self.chat_widgets:
                 self.create_chat_widget(chat_name, 'private', username)
                 self.private_chats[chat_name] = username
-                # История будет запрошена автоматически в create_chat_widget
+                # История загрузится при открытии чата: из локального кэша и новое с сервера (select_chat)
 
     def create_group(self):
         group_name = simpledialog.askstring("Создать группу", "Введите название группы:")
@@ -581,7 +1061,7 @@ class MessengerClient:
                 'group_name': group_name,
                 'creator': self.username
             }
-            self.socket.send(json.dumps(create_msg).encode('utf-8'))
+            self.send_to_server(create_msg)
 
     def join_group(self):
         group_name = simpledialog.askstring("Вступить в группу", "Введите название группы:")
@@ -591,7 +1071,7 @@ class MessengerClient:
                 'group_name': group_name,
                 'username': self.username
             }
-            self.socket.send(json.dumps(join_msg).encode('utf-8'))
+            self.send_to_server(join_msg)
 
     def deselect_chat(self):
         """Сброс выбора чата"""
@@ -605,44 +1085,39 @@ class MessengerClient:
         self.message_entry.delete(0, tk.END)
 
         # Очищаем область сообщений
-        self.chat_area.config(state=tk.NORMAL)
-        self.chat_area.delete(1.0, tk.END)
-        self.chat_area.config(state=tk.DISABLED)
+        self.chat_pane.clear()
 
         # Сбрасываем заголовок
         self.chat_title.config(text="Выберите чат")
 
-    def request_chat_history(self, chat_type, chat_id):
-        """Запрос истории чата у сервера"""
+    def request_chat_history(self, chat_type, chat_id, before=None, after=None):
+        """Запрос страницы истории чата у сервера (before - старше, after - новее, без них - самой последней)"""
         message = {
             'type': 'get_chat_history',
             'chat_type': chat_type,
             'chat_id': chat_id,
-            'username': self.username
+            'username': self.username,
+            'limit': HISTORY_PAGE_SIZE if after is None else SYNC_PAGE_SIZE,
+            'before': before
         }
-        self.socket.send(json.dumps(message).encode('utf-8'))
-
-    def display_chat_history(self, history):
-        """Отображение истории чата (для групп)"""
-        self.chat_area.config(state=tk.NORMAL)
-        self.chat_area.delete(1.0, tk.END)
-
-        if history:
-            for msg in history:
-                timestamp = datetime.fromisoformat(msg['timestamp']).strftime("%H:%M")
-                sender = msg['from']
-                local_ip = msg.get('local_ip', 'Неизвестно')
-                server_ip = msg.get('server_ip', 'Неизвестно')
+        if after is not None:
+            message['after'] = after
+        self.send_to_server(message)
 
-                # Для всех сообщений показываем оба IP
-                ip_info = f"локальный: {local_ip}, серверный: {server_ip}"
-
-                self.chat_area.insert(tk.END, f"[{timestamp}] {sender} ({ip_info}): {msg['text']}\n")
-        else:
-            self.chat_area.insert(tk.END, "Нет сообщений\n")
+    def on_chat_scroll(self, first, last):
+        """Прокрутка области сообщений: у верхнего края подгружаем более старые сообщения"""
+        self.scrollbar_messages.set(first, last)
 
-        self.chat_area.see(tk.END)
-        self.chat_area.config(state=tk.DISABLED)
+        if float(first) > 0 or not self.current_chat_type:
+            return
+        # Сначала показываем уже загруженные сообщения, потом запрашиваем у сервера более старые
+        if self.chat_pane.reveal_older():
+            return
+        chat_key = f"{self.current_chat_type}_{self.current_chat_id}"
+        before = self.oldest_seq(chat_key)
+        if before is not None and chat_key not in self.loading_older:
+            self.loading_older.add(chat_key)
+            self.request_chat_history(self.current_chat_type, self.current_chat_id, before=before)
 
     def generate_message_id(self):
         """Генерация уникального ID для сообщения"""
@@ -673,11 +1148,7 @@ class MessengerClient:
                 'server_ip': self.server_ip
             }
 
-            # Сохраняем сообщение в локальной истории
-            chat_key = f"private_{target_user}"
-            if chat_key not in self.chat_history:
-                self.chat_history[chat_key] = []
-
+            # Сохраняем сообщение в локальной истории (если чат открыт, оно сразу отображается)
             msg_data = {
                 'from': self.username,
                 'local_ip': self.user_ip,
@@ -685,12 +1156,9 @@ class MessengerClient:
                 'text': message_text,
                 'timestamp': datetime.now().isoformat()
             }
-            self.chat_history[chat_key].append(msg_data)
-
-            # Если чат открыт, сразу отображаем сообщение
-            if (self.current_chat_type == 'private' and
-                    self.current_chat_id == target_user):
-                self.display_message(self.username, self.user_ip, self.server_ip, message_text)
+            self.append_history(f"private_{target_user}", [msg_data])
+            sent_copy = (f"private_{target_user}", msg_data)
+            self.set_last_message(self.current_chat, msg_data)
 
         else:
             # Групповое сообщение
@@ -705,206 +1173,414 @@ class MessengerClient:
                     'local_ip': self.user_ip,
                     'server_ip': self.server_ip
                 }
+                sent_copy = None  # свое сообщение в группе сервер присылает обратно
             else:
                 messagebox.showerror("Ошибка", "Группа не найдена")
                 return
 
         try:
-            self.socket.send(json.dumps(message, ensure_ascii=False).encode('utf-8'))
+            self.send_to_server(message)
             self.message_entry.delete(0, tk.END)
 
             # Сохраняем сообщение как ожидающее подтверждения
             self.pending_messages[message_id] = {
                 'type': self.current_chat_type,
                 'text': message_text,
-                'timestamp': datetime.now().isoformat()
+                'timestamp': datetime.now().isoformat(),
+                'copy': sent_copy  # (chat_key, сообщение в локальной истории), получит seq при подтверждении
             }
 
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось отправить сообщение: {e}")
 
-    def display_message(self, sender, local_ip, server_ip, text, timestamp=None):
-        """Отображение нового сообщения"""
-        if timestamp is None:
-            timestamp = datetime.now().isoformat()
-
-        time_str = datetime.fromisoformat(timestamp).strftime("%H:%M")
-
-        # Для всех сообщений показываем оба IP
-        ip_info = f"локальный: {local_ip}, серверный: {server_ip}"
-
-        self.chat_area.config(state=tk.NORMAL)
-        self.chat_area.insert(tk.END, f"[{time_str}] {sender} ({ip_info}): {text}\n")
-        self.chat_area.see(tk.END)
-        self.chat_area.config(state=tk.DISABLED)
+    def set_status(self, text):
+        """Уведомление в строке состояния (из пачки сообщений показывается последнее)"""
+        if self.draining:
+            self.pending_status = text
+        else:
+            self.status_var.set(text)
 
     def receive_messages(self):
-        while True:
+        """Поток приема: только разбор кадров в очередь, без обращения к виджетам Tk"""
+        reader = FrameReader()
+        try:
+            while reader.recv_from(self.socket):
+                # За одно чтение может прийти несколько кадров
+                for payload in reader.frames():
+                    self.inbox.put(decode_message(payload))
+        except Exception as e:
+            self.receive_error = e
+        self.inbox.put(None)  # прием остановлен
+
+    def process_inbox(self):
+        """Разбор накопившихся входящих сообщений в главном потоке Tk, пачками.
+
+        Работа, которую делает ненужной более позднее сообщение той же пачки,
+        пропускается: из нескольких полных списков чатов применяется последний,
+        строки открытого чата вставляются одним insert с одной прокруткой,
+        из уведомлений в строке состояния показывается последнее.
+        """
+        batch = []
+        while len(batch) < INBOX_BATCH_SIZE:
             try:
-                data = self.socket.recv(1024).decode('utf-8')
-                if not data:
-                    break
-
-                message = json.loads(data)
-                msg_type = message.get('type')
-
-                if msg_type == 'private_message':
-                    sender = message['from']
-                    local_ip = message.get('local_ip', 'Неизвестно')
-                    server_ip = message.get('server_ip', 'Неизвестно')
-                    text = message['text']
-                    timestamp = message.get('timestamp')
-
-                    # Сохраняем IP отправителя
-                    self.user_ips[sender] = local_ip
-                    self.user_server_ips[sender] = server_ip
-
-                    # Сохраняем сообщение в локальной истории
-                    chat_key = f"private_{sender}"
-                    if chat_key not in self.chat_history:
-                        self.chat_history[chat_key] = []
-
-                    msg_data = {
-                        'from': sender,
-                        'local_ip': local_ip,
-                        'server_ip': server_ip,
-                        'text': text,
-                        'timestamp': timestamp
-                    }
-                    self.chat_history[chat_key].append(msg_data)
-
-                    # Проверяем, есть ли уже чат с этим пользователем
-                    chat_name = f"Личный: {sender}"
-                    if chat_name not in self.private_chats:
-                        # Автоматически создаем чат с новым пользователем
-                        self.private_chats[chat_name] = sender
-                        self.create_chat_widget(chat_name, 'private', sender)
-
-                    # Проверяем, открыт ли сейчас этот личный чат
-                    if (self.current_chat_type == 'private' and
-                            self.current_chat_id == sender):
-                        # Если чат открыт, сразу отображаем сообщение
-                        self.display_message(sender, local_ip, server_ip, text, timestamp)
-                    else:
-                        # Уведомление о новом сообщении
-                        self.status_var.set(f"Новое сообщение от {sender}")
-
-                elif msg_type == 'group_message':
-                    sender = message['from']
-                    local_ip = message.get('local_ip', 'Неизвестно')
-                    server_ip = message.get('server_ip', 'Неизвестно')
-                    group_name = message['group']
-                    text = message['text']
-                    timestamp = message.get('timestamp')
-
-                    # Сохраняем IP отправителя
-                    self.user_ips[sender] = local_ip
-                    self.user_server_ips[sender] = server_ip
-
-                    # Проверяем, открыта ли сейчас эта группа
-                    if (self.current_chat_type == 'group' and
-                            self.current_chat_id == group_name):
-                        self.display_message(sender, local_ip, server_ip, text, timestamp)
-                    else:
-                        # Уведомление о новом сообщении в группе
-                        self.status_var.set(f"Новое сообщение в {group_name} от {sender}")
-
-                elif msg_type == 'message_sent':
-                    # Подтверждение отправки сообщения
-                    message_id = message.get('message_id')
-                    if message_id in self.pending_messages:
-                        # Удаляем из ожидающих подтверждения
-                        del self.pending_messages[message_id]
-
-                elif msg_type == 'chats_update':
-                    # Обновление списка чатов
-                    self.update_chats_list(message)
-
-                elif msg_type == 'chat_history':
-                    # Получение истории чата от сервера
-                    chat_type = message['chat_type']
-                    chat_id = message['chat_id']
-                    history = message['history']
-
-                    if chat_type == 'private':
-                        # Для личных чатов сохраняем историю локально
-                        chat_key = f"private_{chat_id}"
-                        self.chat_history[chat_key] = history
-
-                        # Если чат открыт, обновляем отображение
-                        if (self.current_chat_type == 'private' and
-                                self.current_chat_id == chat_id):
-                            self.display_local_chat_history(chat_id)
-                    else:
-                        # Для групп просто отображаем историю
-                        if (self.current_chat_type == 'group' and
-                                self.current_chat_id == chat_id):
-                            self.display_chat_history(history)
-
-                elif msg_type == 'group_created':
-                    group_name = message['group_name']
-                    chat_name = f"Группа: {group_name}"
-                    if chat_name not in self.chat_widgets:
-                        # Создатель - текущий пользователь
-                        self.create_chat_widget(chat_name, 'group', group_name, self.username)
-                        self.group_chats[chat_name] = group_name
-                        self.group_creators[chat_name] = self.username
-
-                elif msg_type == 'group_joined':
-                    group_name = message['group_name']
-                    chat_name = f"Группа: {group_name}"
-                    if chat_name not in self.chat_widgets:
-                        # При присоединении создатель неизвестен, будет обновлено в chats_update
-                        self.create_chat_widget(chat_name, 'group', group_name)
-                        self.group_chats[chat_name] = group_name
-
-                elif msg_type == 'group_members':
-                    # Получение списка участников группы
-                    group_name = message['group_name']
-                    members = message['members']
-                    self.group_members[group_name] = members
-                    
-                    # Убираем группу из ожидающих запросов
-                    if group_name in self.pending_member_requests:
-                        self.pending_member_requests.remove(group_name)
-                    
-                    self.status_var.set(f"Получен список участников группы {group_name}")
-
-                elif msg_type == 'server_ip_assigned':
-                    # Получение серверного IP от сервера
-                    self.server_ip = message['server_ip']
-                    self.user_label.config(text=f"{self.username} (локальный: {self.user_ip}, серверный: {self.server_ip})")
+                batch.append(self.inbox.get_nowait())
+            except queue.Empty:
+                break
 
+        self.draining = True
+        try:
+            for message in self.coalesce_inbox(batch):
+                if message is None:
+                    if self.receive_error is not None:
+                        self.set_status(f"Ошибка получения сообщения: {self.receive_error}")
+                    continue
+                try:
+                    self.handle_server_message(message)
+                except Exception as e:
+                    self.set_status(f"Ошибка обработки сообщения {message.get('type')}: {e}")
+        finally:
+            self.draining = False
+        self.chat_pane.flush()
+        self.reorder_chats()
+        if self.cache is not None:
+            try:
+                self.cache.commit()
             except Exception as e:
-                self.status_var.set(f"Ошибка получения сообщения: {e}")
-                break
+                self.set_status(f"Ошибка записи локального кэша: {e}")
+        if self.pending_status is not None:
+            self.status_var.set(self.pending_status)
+            self.pending_status = None
+
+        # Если очередь не разобрана целиком, продолжаем сразу после обработки событий окна
+        self.root.after(1 if not self.inbox.empty() else INBOX_INTERVAL, self.process_inbox)
+
+    @staticmethod
+    def coalesce_inbox(batch):
+        """Сообщения пачки без изменений списка чатов, перекрытых более поздним полным списком"""
+        last_full = None
+        for index, message in enumerate(batch):
+            if message is not None and message.get('type') == 'chats_update':
+                last_full = index
+        if not last_full:
+            return batch
+        return [message for index, message in enumerate(batch)
+                if index >= last_full or message is None or message.get('type') not in CHAT_LIST_TYPES]
+
+    def handle_server_message(self, message):
+        """Обработка одного сообщения от сервера"""
+        msg_type = message.get('type')
+
+        if msg_type == 'private_message':
+            sender = message['from']
+            local_ip = message.get('local_ip', 'Неизвестно')
+            server_ip = message.get('server_ip', 'Неизвестно')
+            text = message['text']
+            timestamp = message.get('timestamp')
+
+            # Сохраняем IP отправителя
+            self.user_ips[sender] = local_ip
+            self.user_server_ips[sender] = server_ip
+
+            # Сохраняем сообщение в локальной истории (если чат открыт, оно сразу отображается)
+            chat_key = f"private_{sender}"
+            msg_data = {
+                'from': sender,
+                'local_ip': local_ip,
+                'server_ip': server_ip,
+                'text': text,
+                'timestamp': timestamp,
+                'seq': message.get('seq')
+            }
+            if not self.load_cached(chat_key) or msg_data['seq'] is None:
+                self.append_history(chat_key, [msg_data])
+            elif not self.merge_history(chat_key, [msg_data]):
+                # Перед этим сообщением есть неизвестные клиенту - догружаем их вместе с ним
+                self.sync_chat('private', sender)
+
+            # Проверяем, есть ли уже чат с этим пользователем
+            chat_name = f"Личный: {sender}"
+            if chat_name not in self.private_chats:
+                # Автоматически создаем чат с новым пользователем
+                self.private_chats[chat_name] = sender
+                self.create_chat_widget(chat_name, 'private', sender)
+            self.set_last_message(chat_name, msg_data)
+
+            # Уведомление о новом сообщении, если чат не открыт
+            if not (self.current_chat_type == 'private' and
+                    self.current_chat_id == sender):
+                # Уведомление о новом сообщении
+                self.set_status(f"Новое сообщение от {sender}")
+
+        elif msg_type == 'group_message':
+            sender = message['from']
+            local_ip = message.get('local_ip', 'Неизвестно')
+            server_ip = message.get('server_ip', 'Неизвестно')
+            group_name = message['group']
+            text = message['text']
+            timestamp = message.get('timestamp')
+
+            # Сохраняем IP отправителя
+            self.user_ips[sender] = local_ip
+            self.user_server_ips[sender] = server_ip
+
+            # Дописываем в уже загруженную (или сохраненную в кэше) историю группы
+            chat_key = f"group_{group_name}"
+            if self.load_cached(chat_key):
+                msg_data = {
+                    'from': sender,
+                    'local_ip': local_ip,
+                    'server_ip': server_ip,
+                    'text': text,
+                    'timestamp': timestamp,
+                    'seq': message.get('seq')
+                }
+                if msg_data['seq'] is None:
+                    self.append_history(chat_key, [msg_data])
+                elif not self.merge_history(chat_key, [msg_data]):
+                    self.sync_chat('group', group_name)
+
+            # Группа с новым сообщением поднимается в списке чатов
+            if f"Группа: {group_name}" in self.chat_widgets:
+                self.set_last_message(f"Группа: {group_name}", {'from': sender, 'text': text, 'timestamp': timestamp})
+
+            # Уведомление о новом сообщении в группе, если она не открыта
+            if not (self.current_chat_type == 'group' and
+                    self.current_chat_id == group_name):
+                # Уведомление о новом сообщении в группе
+                self.set_status(f"Новое сообщение в {group_name} от {sender}")
+
+        elif msg_type == 'missed_messages':
+            # Сообщения, пришедшие, пока клиент был не в сети: сервер досылает их пачками при входе
+            chat_type = message['chat_type']
+            chat_id = message['chat_id']
+            chat_key = f"{chat_type}_{chat_id}"
+            if not self.load_cached(chat_key) and chat_type == 'private':
+                # Личные чаты храним локально всегда, группы - только уже загруженные
+                self.chat_history[chat_key] = []
+            top = self.top_seq(chat_key)
+            missed = [msg for msg in message['messages'] if msg['seq'] > top]
+            for msg in missed:
+                self.user_ips[msg['from']] = msg.get('local_ip', 'Неизвестно')
+                self.user_server_ips[msg['from']] = msg.get('server_ip', 'Неизвестно')
+            if chat_key in self.chat_history and not self.merge_history(chat_key, message['messages']):
+                # Сервер прислал не все пропущенные (или кэш отстал) - догружаем после последнего известного
+                self.sync_chat(chat_type, chat_id)
+
+            if missed and not (self.current_chat_type == chat_type and self.current_chat_id == chat_id):
+                self.set_status(f"Пропущенные сообщения в {chat_id}: {len(missed) + message.get('skipped', 0)}")
+
+        elif msg_type == 'message_sent':
+            # Подтверждение отправки сообщения
+            message_id = message.get('message_id')
+            if message_id in self.pending_messages:
+                # Удаляем из ожидающих подтверждения
+                sent = self.pending_messages.pop(message_id)
+                if sent.get('copy') is not None and message.get('seq') is not None:
+                    self.confirm_sent(*sent['copy'], message['seq'])
+
+        elif msg_type == 'chats_update':
+            # Полный список чатов
+            self.chats_version = message.get('version')
+            self.update_chats_list(message)
+
+        elif msg_type in ('chat_added', 'chat_removed', 'chat_renamed', 'last_message_changed'):
+            # Изменение списка чатов применяется, только если не пропущено ни одно предыдущее
+            if self.chats_version is not None and message.get('version') == self.chats_version + 1:
+                self.chats_version = message['version']
+                self.apply_chat_event(message)
+            elif self.chats_version is not None:
+                # Пропуск в версиях - запрашиваем полный список один раз
+                self.chats_version = None
+                self.send_to_server({'type': 'get_chats'})
+
+        elif msg_type == 'chat_history':
+            # Получение истории чата от сервера
+            chat_type = message['chat_type']
+            chat_id = message['chat_id']
+            history = message['history']
+            chat_key = f"{chat_type}_{chat_id}"
+            is_current = (self.current_chat_type == chat_type and
+                          self.current_chat_id == chat_id)
+
+            if message.get('before') is not None:
+                # Более старая страница, запрошенная при прокрутке вверх
+                self.loading_older.discard(chat_key)
+                self.chat_history[chat_key] = history + self.chat_history.get(chat_key, [])
+                if self.cache is not None:
+                    self.cache.add(chat_key, history)
+                self.chat_pane.prepended(chat_key, history)
+
+            elif message.get('after') is not None:
+                # Догрузка после последнего известного сообщения: продолжаем, пока сервер не отдаст все
+                self.load_cached(chat_key)
+                self.chat_history.setdefault(chat_key, [])
+                if not self.merge_history(chat_key, history):
+                    self.request_chat_history(chat_type, chat_id, after=self.top_seq(chat_key))
+                elif message.get('next_after') is not None:
+                    self.request_chat_history(chat_type, chat_id, after=message['next_after'])
+                else:
+                    self.syncing.discard(chat_key)
+                    self.synced.add(chat_key)
 
-    def update_chats_list(self, message):
-        """Обновление списка чатов"""
-        # Очищаем текущие чаты
-        for widget in self.chat_widgets.values():
-            widget['frame'].destroy()
-        self.chat_widgets.clear()
-        self.private_chats.clear()
-        self.group_chats.clear()
-        self.group_creators.clear()
-
-        # Добавляем личные чаты с IP
-        for chat in message.get('private_chats', []):
-            chat_name = f"Личный: {chat['user']}"
+            else:
+                # Последняя страница: личные чаты храним локально, у групп старые
+                # сообщения подгрузятся при прокрутке. Если чат открыт, обновляем отображение
+                self.chat_history[chat_key] = history
+                if self.cache is not None:
+                    self.cache.replace(chat_key, history)
+                self.chat_pane.reset(chat_key)
+                if is_current:
+                    self.chat_pane.show(chat_key)
+                self.syncing.discard(chat_key)
+                self.synced.add(chat_key)
+
+        elif msg_type == 'group_created':
+            group_name = message['group_name']
+            chat_name = f"Группа: {group_name}"
+            if chat_name not in self.chat_widgets:
+                # Создатель - текущий пользователь
+                self.create_chat_widget(chat_name, 'group', group_name, self.username)
+                self.group_chats[chat_name] = group_name
+                self.group_creators[chat_name] = self.username
+
+        elif msg_type == 'group_joined':
+            group_name = message['group_name']
+            chat_name = f"Группа: {group_name}"
+            if chat_name not in self.chat_widgets:
+                # При присоединении создатель неизвестен, будет обновлено в chats_update
+                self.create_chat_widget(chat_name, 'group', group_name)
+                self.group_chats[chat_name] = group_name
+
+        elif msg_type == 'group_members':
+            # Получение списка участников группы
+            group_name = message['group_name']
+            members = message['members']
+            self.group_members[group_name] = members
+            self.refresh_search(f"Группа: {group_name}")  # участники ищутся поиском по чатам
+
+            # Убираем группу из ожидающих запросов
+            if group_name in self.pending_member_requests:
+                self.pending_member_requests.remove(group_name)
+
+            self.set_status(f"Получен список участников группы {group_name}")
+
+        elif msg_type == 'server_ip_assigned':
+            # Получение серверного IP от сервера
+            self.server_ip = message['server_ip']
+            # Дальше отправляем в кодеке, выбранном сервером (старый сервер кодек не сообщает)
+            self.codec = get_codec(message.get('codec'))
+            self.user_label.config(text=f"{self.username} (локальный: {self.user_ip}, серверный: {self.server_ip})")
+
+    def confirm_sent(self, chat_key, msg_data, seq):
+        """Свое сообщение подтверждено сервером: получает seq и попадает в кэш"""
+        if chat_key not in self.chat_history:
+            return  # чат удален до подтверждения
+        msg_data['seq'] = seq
+        if self.cache is not None:
+            self.cache.add(chat_key, [msg_data])
+        if self.top_seq(chat_key) != seq:
+            # Пока сообщение ждало подтверждения, после него пришли другие
+            self.sort_history(chat_key)
+
+    def add_private_chat_entry(self, chat):
+        """Добавление личного чата из описания сервера"""
+        chat_name = f"Личный: {chat['user']}"
+        # Сохраняем IP пользователя
+        self.user_ips[chat['user']] = chat.get('local_ip', 'Неизвестно')
+        self.user_server_ips[chat['user']] = chat.get('server_ip', 'Неизвестно')
+        self.last_messages[chat_name] = chat.get('last_message')  # новый чат сразу индексируется с ним
+        if chat_name not in self.chat_widgets:
             self.create_chat_widget(chat_name, 'private', chat['user'])
             self.private_chats[chat_name] = chat['user']
-            # Сохраняем IP пользователя
-            self.user_ips[chat['user']] = chat.get('local_ip', 'Неизвестно')
-            self.user_server_ips[chat['user']] = chat.get('server_ip', 'Неизвестно')
-
-        # Добавляем групповые чаты
-        for chat in message.get('group_chats', []):
-            chat_name = f"Группа: {chat['group_name']}"
-            creator = chat.get('creator', 'Неизвестно')
+        self.set_last_message(chat_name, chat.get('last_message'))
+
+    def add_group_chat_entry(self, chat):
+        """Добавление группы из описания сервера"""
+        chat_name = f"Группа: {chat['group_name']}"
+        creator = chat.get('creator', 'Неизвестно')
+        self.group_chats[chat_name] = chat['group_name']
+        self.group_creators[chat_name] = creator
+        self.last_messages[chat_name] = chat.get('last_message')  # новый чат сразу индексируется с ним
+        if chat_name in self.chat_widgets:
+            # Меню группы зависит от создателя: он мог стать известен только сейчас
+            self.chat_widgets[chat_name]['creator'] = creator
+        else:
             self.create_chat_widget(chat_name, 'group', chat['group_name'], creator)
-            self.group_chats[chat_name] = chat['group_name']
-            self.group_creators[chat_name] = creator
+        self.set_last_message(chat_name, chat.get('last_message'))
+
+    def apply_chat_event(self, message):
+        """Применение одного изменения списка чатов"""
+        msg_type = message['type']
+
+        if msg_type == 'chat_added':
+            if message['kind'] == 'private':
+                self.add_private_chat_entry(message['chat'])
+            else:
+                self.add_group_chat_entry(message['chat'])
+
+        elif msg_type == 'last_message_changed':
+            self.set_last_message(f"Личный: {message['user']}", message.get('last_message'))
+
+        elif msg_type == 'chat_removed':
+            chat_name = f"Группа: {message['group_name']}"
+            self.remove_chat_widget(chat_name)
+            self.last_messages.pop(chat_name, None)
+            if self.current_chat == chat_name:
+                self.deselect_chat()
+
+        elif msg_type == 'chat_renamed':
+            old_name = message['old_name']
+            new_name = message['new_name']
+            old_chat = f"Группа: {old_name}"
+            new_chat = f"Группа: {new_name}"
+            creator = self.group_creators.pop(old_chat, 'Неизвестно')
+            self.last_messages[new_chat] = self.last_messages.pop(old_chat, None)
+            if old_chat in self.chat_widgets:
+                self.rename_chat_widget(old_chat, new_chat, new_name)
+            elif new_chat not in self.chat_widgets:
+                self.create_chat_widget(new_chat, 'group', new_name, creator)
+            self.group_chats.pop(old_chat, None)
+            self.group_chats[new_chat] = new_name
+            self.group_creators[new_chat] = creator
+
+            # Переносим загруженную историю, кэш и строки области сообщений на новое имя
+            old_key, new_key = f"group_{old_name}", f"group_{new_name}"
+            if old_key in self.chat_history:
+                self.chat_history[new_key] = self.chat_history.pop(old_key)
+            for keys in (self.synced, self.syncing):
+                if old_key in keys:
+                    keys.discard(old_key)
+                    keys.add(new_key)
+            if self.cache is not None:
+                self.cache.rename(old_key, new_key)
+            self.chat_pane.rename(old_key, new_key)
+
+            if self.current_chat == old_chat:
+                self.current_chat = new_chat
+                self.current_chat_id = new_name
+                self.chat_title.config(text=f"Группа: {new_name}")
+
+    def update_chats_list(self, message):
+        """Сверка списка чатов с полным списком сервера: пересоздаются только изменившиеся виджеты"""
+        private_chats = message.get('private_chats', [])
+        group_chats = message.get('group_chats', [])
+        listed = {f"Личный: {chat['user']}" for chat in private_chats}
+        listed.update(f"Группа: {chat['group_name']}" for chat in group_chats)
+
+        # Удаляем чаты, которых больше нет в списке
+        for chat_name in [name for name in self.chat_widgets if name not in listed]:
+            self.remove_chat_widget(chat_name)
+        self.last_messages.clear()
+
+        # Добавляем новые чаты и обновляем существующие (личные - с IP). Новые создаются
+        # сразу в порядке последних сообщений, чтобы потом их не переставлять
+        for kind, chat in sorted(
+                [('private', chat) for chat in private_chats] + [('group', chat) for chat in group_chats],
+                key=lambda entry: (entry[1].get('last_message') or {}).get('timestamp') or '', reverse=True):
+            if kind == 'private':
+                self.add_private_chat_entry(chat)
+            else:
+                self.add_group_chat_entry(chat)
 
         # Если текущий чат был удален, сбрасываем выбор
         if (self.current_chat and
@@ -924,6 +1600,11 @@ class MessengerClient:
                 self.socket.close()
         except:
             pass
+        try:
+            if self.cache is not None:
+                self.cache.close()
+        except:
+            pass
         self.root.destroy()
         sys.exit()
 
@@ -932,7 +1613,18 @@ class MessengerClient:
 
 
 if __name__ == "__main__":
-    client = MessengerClient()
+    parser = argparse.ArgumentParser(description="Клиент мессенджера")
+    parser.add_argument('--cache-dir', default='.',
+                        help="Папка локального кэша сообщений (файл client_cache_<имя>.db на пользователя)")
+    parser.add_argument('--no-cache', action='store_true', help="Не хранить сообщения локально")
+    parser.add_argument('--cache-chat-limit', type=int, default=CACHE_CHAT_LIMIT,
+                        help="Сколько последних сообщений одного чата хранить в кэше")
+    parser.add_argument('--cache-total-limit', type=int, default=CACHE_TOTAL_LIMIT,
+                        help="Сколько сообщений хранить в кэше всего; сверх этого удаляются давно открывавшиеся чаты")
+    args = parser.parse_args()
+
+    client = MessengerClient(cache_dir=None if args.no_cache else args.cache_dir,
+                             cache_chat_limit=args.cache_chat_limit, cache_total_limit=args.cache_total_limit)
 
     client.run()
 
@@ -0,0 +1,109 @@
+import json
+import sqlite3
+import time
+
+
+CACHE_CHAT_LIMIT = 5000  # последних сообщений одного чата в кэше
+CACHE_TOTAL_LIMIT = 200000  # сообщений во всем кэше; сверх этого удаляются давно открывавшиеся чаты
+
+
+class MessageCache:
+    """Локальный кэш сообщений клиента: файл SQLite на пользователя.
+
+    Хранит сообщения, полученные от сервера (с номером seq), по чатам
+    (chat_key клиента: private_<user>, group_<name>). Для каждого чата
+    лежит непрерывный хвост истории: при повторном входе клиент показывает
+    его сразу и запрашивает у сервера только сообщения новее последнего.
+    Изменения копятся в транзакции и записываются в commit().
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            chat_key TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (chat_key, seq)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_key TEXT PRIMARY KEY,
+            used REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path, chat_limit=CACHE_CHAT_LIMIT, total_limit=CACHE_TOTAL_LIMIT):
+        self.path = path
+        self.chat_limit = chat_limit
+        self.total_limit = total_limit
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')  # кэш можно догрузить с сервера, fsync на каждую запись не нужен
+        self.db.executescript(self.SCHEMA)
+        self.count = self.db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        self.touched = set()  # чаты, измененные или открытые после последнего commit
+
+    def load(self, chat_key):
+        """Сообщения чата из кэша по возрастанию seq"""
+        rows = self.db.execute('SELECT data FROM messages WHERE chat_key = ? ORDER BY seq', (chat_key,))
+        history = [json.loads(data) for (data,) in rows]
+        if history:
+            self.touched.add(chat_key)
+        return history
+
+    def add(self, chat_key, messages):
+        """Сохранение сообщений чата; сообщения без seq (еще не подтвержденные сервером) пропускаются"""
+        rows = [(chat_key, msg['seq'], json.dumps(msg, ensure_ascii=False))
+                for msg in messages if msg.get('seq') is not None]
+        if rows:
+            self.count += self.db.executemany('INSERT OR IGNORE INTO messages VALUES (?, ?, ?)', rows).rowcount
+            self.touched.add(chat_key)
+
+    def replace(self, chat_key, messages):
+        """Замена кэша чата новым хвостом истории"""
+        self.forget(chat_key)
+        self.add(chat_key, messages)
+
+    def forget(self, chat_key):
+        self.count -= self.db.execute('DELETE FROM messages WHERE chat_key = ?', (chat_key,)).rowcount
+        self.db.execute('DELETE FROM chats WHERE chat_key = ?', (chat_key,))
+        self.touched.discard(chat_key)
+
+    def rename(self, old_key, new_key):
+        self.forget(new_key)
+        self.db.execute('UPDATE messages SET chat_key = ? WHERE chat_key = ?', (new_key, old_key))
+        self.db.execute('UPDATE chats SET chat_key = ? WHERE chat_key = ?', (new_key, old_key))
+        if old_key in self.touched:
+            self.touched.discard(old_key)
+            self.touched.add(new_key)
+
+    def commit(self):
+        """Запись накопленных изменений с применением ограничений размера"""
+        if not self.touched and not self.db.in_transaction:
+            return
+        now = time.time()
+        for chat_key in self.touched:
+            self.db.execute('INSERT OR REPLACE INTO chats VALUES (?, ?)', (chat_key, now))
+            # Оставляем chat_limit последних сообщений чата
+            self.count -= self.db.execute(
+                'DELETE FROM messages WHERE chat_key = ? AND seq <= '
+                '(SELECT seq FROM messages WHERE chat_key = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)',
+                (chat_key, chat_key, self.chat_limit)).rowcount
+        self.touched.clear()
+        self.evict()
+        self.db.commit()
+
+    def evict(self):
+        """Удаление чатов, которые открывались давнее остальных, пока кэш больше total_limit"""
+        if self.count <= self.total_limit:
+            return
+        for (chat_key,) in self.db.execute('SELECT chat_key FROM chats ORDER BY used').fetchall():
+            self.forget(chat_key)
+            if self.count <= self.total_limit:
+                break
+
+    def stats(self):
+        chats = self.db.execute('SELECT COUNT(*) FROM chats').fetchone()[0]
+        return {'messages': self.count, 'chats': chats}
+
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -0,0 +1,335 @@
+import json
+import struct
+from datetime import datetime, timedelta
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Номера типов сообщений и полей для компактных кодеков: номер - позиция в списке плюс один.
+# Списки только дополняются в конец, иначе клиенты и серверы разных версий перестанут понимать друг друга
+MESSAGE_TYPES = (
+    'register', 'private_message', 'group_message', 'create_group', 'join_group', 'leave_group',
+    'rename_group', 'delete_group', 'get_chat_history', 'get_group_members', 'get_chats',
+    'server_ip_assigned', 'message_sent', 'chats_update', 'chat_added', 'chat_removed', 'chat_renamed',
+    'last_message_changed', 'chat_history', 'group_members', 'group_created', 'group_joined',
+    'missed_messages',
+)
+FIELDS = (
+    'type', 'from', 'to', 'text', 'timestamp', 'seq', 'local_ip', 'server_ip', 'username', 'group',
+    'group_name', 'chat_type', 'chat_id', 'history', 'messages', 'before', 'after', 'next_before',
+    'next_after', 'limit', 'version', 'kind', 'chat', 'user', 'last_message', 'private_chats',
+    'group_chats', 'creator', 'members', 'message_id', 'new_name', 'old_name', 'skipped', 'compression',
+    'codec', 'codecs', 'last_seen',
+)
+TYPE_IDS = {name: number for number, name in enumerate(MESSAGE_TYPES, 1)}
+FIELD_IDS = {name: number for number, name in enumerate(FIELDS, 1)}
+# Поля с временем в формате datetime.isoformat(): передаются числом микросекунд
+TIME_FIELDS = frozenset(('timestamp', 'last_seen'))
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+class CodecError(ValueError):
+    """Ошибка сериализации или разбора сообщения"""
+
+
+def time_to_micros(value):
+    """Время isoformat() в микросекундах от эпохи или None, если строка не восстановится точно"""
+    # isoformat() без микросекунд и с часовым поясом дает строку другой длины - такие оставляем строкой
+    if len(value) != 26 or value[10] != 'T' or value[19] != '.':
+        return None
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if moment.microsecond == 0 or moment.tzinfo is not None:
+        return None
+    return (moment - EPOCH) // MICROSECOND
+
+
+def micros_to_time(micros):
+    return (EPOCH + timedelta(0, 0, micros)).isoformat()
+
+
+class JsonCodec:
+    """JSON в UTF-8 - кодек по умолчанию, его понимают все клиенты"""
+
+    name = 'json'
+
+    def encode(self, message):
+        try:
+            return json.dumps(message, ensure_ascii=False).encode('utf-8')
+        except (TypeError, ValueError) as e:
+            raise CodecError(f"Сообщение не сериализуется в JSON: {e}")
+
+    def decode(self, payload):
+        try:
+            return json.loads(payload)
+        except ValueError as e:
+            raise CodecError(f"Некорректный JSON: {e}")
+
+    def with_version(self, payload, version):
+        """Вставка номера версии в уже сериализованное событие (в начало объекта)"""
+        return b'{"version":%d,' % version + payload[1:]
+
+
+# Бинарный формат: байт-маркер, затем значение-словарь. Значение - байт тега и данные
+# (числа little-endian); ключ словаря - байт номера поля (0 - далее имя поля строкой)
+BINARY_MARKER = 0x01
+TAG_NONE, TAG_TRUE, TAG_FALSE, TAG_UINT8, TAG_INT32, TAG_INT64, TAG_FLOAT, TAG_STR8, TAG_STR32, \
+    TAG_TIME, TAG_LIST, TAG_MAP, TAG_TYPE = range(13)
+
+_TAG_UINT8 = struct.Struct('<BB')
+_TAG_INT32 = struct.Struct('<Bi')
+_TAG_INT64 = struct.Struct('<Bq')
+_TAG_FLOAT = struct.Struct('<Bd')
+_TAG_UINT32 = struct.Struct('<BI')
+_INT32 = struct.Struct('<i')
+_INT64 = struct.Struct('<q')
+_UINT32 = struct.Struct('<I')
+_FLOAT = struct.Struct('<d')
+_INT32_MIN, _INT32_MAX = -2 ** 31, 2 ** 31 - 1
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def _binary_encode(out, value, key=None):
+    kind = type(value)
+    if kind is str:
+        if key in TIME_FIELDS:
+            micros = time_to_micros(value)
+            if micros is not None:
+                out += _TAG_INT64.pack(TAG_TIME, micros)
+                return
+        data = value.encode('utf-8')
+        if len(data) < 256:
+            out += _TAG_UINT8.pack(TAG_STR8, len(data))
+        else:
+            out += _TAG_UINT32.pack(TAG_STR32, len(data))
+        out += data
+    elif kind is dict:
+        out += _TAG_UINT32.pack(TAG_MAP, len(value))
+        for field, item in value.items():
+            if type(field) is not str:
+                field = str(field)  # как в JSON: ключи объекта - строки
+            number = FIELD_IDS.get(field)
+            if number is not None:
+                out.append(number)
+            else:
+                out.append(0)
+                _binary_encode(out, field)
+            if number == 1 and type(item) is str and item in TYPE_IDS:
+                out += _TAG_UINT8.pack(TAG_TYPE, TYPE_IDS[item])
+            else:
+                _binary_encode(out, item, field)
+    elif kind is int:
+        if 0 <= value < 256:
+            out += _TAG_UINT8.pack(TAG_UINT8, value)
+        elif _INT32_MIN <= value <= _INT32_MAX:
+            out += _TAG_INT32.pack(TAG_INT32, value)
+        elif _INT64_MIN <= value <= _INT64_MAX:
+            out += _TAG_INT64.pack(TAG_INT64, value)
+        else:
+            raise CodecError(f"Слишком большое число: {value}")
+    elif kind is list or kind is tuple:
+        out += _TAG_UINT32.pack(TAG_LIST, len(value))
+        for item in value:
+            _binary_encode(out, item)
+    elif value is None:
+        out.append(TAG_NONE)
+    elif kind is bool:
+        out.append(TAG_TRUE if value else TAG_FALSE)
+    elif kind is float:
+        out += _TAG_FLOAT.pack(TAG_FLOAT, value)
+    else:
+        raise CodecError(f"Значение типа {kind.__name__} не сериализуется")
+
+
+def _binary_decode(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == TAG_STR8:
+        end = pos + 1 + data[pos]
+        return data[pos + 1:end].decode('utf-8'), end
+    if tag == TAG_MAP:
+        (count,) = _UINT32.unpack_from(data, pos)
+        pos += 4
+        result = {}
+        for _ in range(count):
+            number = data[pos]
+            pos += 1
+            if number:
+                # Поле из более новой версии протокола сохраняем под условным именем
+                field = FIELDS[number - 1] if number <= len(FIELDS) else f'#{number}'
+            else:
+                field, pos = _binary_decode(data, pos)
+            result[field], pos = _binary_decode(data, pos)
+        return result, pos
+    if tag == TAG_UINT8:
+        return data[pos], pos + 1
+    if tag == TAG_TIME:
+        return micros_to_time(_INT64.unpack_from(data, pos)[0]), pos + 8
+    if tag == TAG_TYPE:
+        number = data[pos]
+        return (MESSAGE_TYPES[number - 1] if number <= len(MESSAGE_TYPES) else f'#{number}'), pos + 1
+    if tag == TAG_LIST:
+        (count,) = _UINT32.unpack_from(data, pos)
+        pos += 4
+        result = []
+        for _ in range(count):
+            item, pos = _binary_decode(data, pos)
+            result.append(item)
+        return result, pos
+    if tag == TAG_INT32:
+        return _INT32.unpack_from(data, pos)[0], pos + 4
+    if tag == TAG_NONE:
+        return None, pos
+    if tag == TAG_TRUE:
+        return True, pos
+    if tag == TAG_FALSE:
+        return False, pos
+    if tag == TAG_STR32:
+        (length,) = _UINT32.unpack_from(data, pos)
+        end = pos + 4 + length
+        return data[pos + 4:end].decode('utf-8'), end
+    if tag == TAG_INT64:
+        return _INT64.unpack_from(data, pos)[0], pos + 8
+    if tag == TAG_FLOAT:
+        return _FLOAT.unpack_from(data, pos)[0], pos + 8
+    raise CodecError(f"Неизвестный тег значения: {tag}")
+
+
+class BinaryCodec:
+    """Компактный бинарный формат на struct: номера типов и полей вместо строк,
+    время - числом микросекунд. Работает без сторонних библиотек.
+    """
+
+    name = 'binary'
+    marker = BINARY_MARKER
+
+    def encode(self, message):
+        out = bytearray((BINARY_MARKER,))
+        _binary_encode(out, message)
+        return bytes(out)
+
+    def decode(self, payload):
+        try:
+            message, end = _binary_decode(payload, 1)
+        except (IndexError, struct.error, UnicodeDecodeError) as e:
+            raise CodecError(f"Поврежденное бинарное сообщение: {e}")
+        if end != len(payload):
+            raise CodecError(f"Лишние байты в конце бинарного сообщения: {len(payload) - end}")
+        return message
+
+    def with_version(self, payload, version):
+        """Номер версии добавляется первым полем: меняется только счетчик полей словаря"""
+        (count,) = _UINT32.unpack_from(payload, 2)
+        out = bytearray(payload[:2])
+        out += _UINT32.pack(count + 1)
+        out.append(FIELD_IDS['version'])
+        _binary_encode(out, version)
+        out += memoryview(payload)[6:]
+        return bytes(out)
+
+
+# Тот же формат номеров поверх msgpack (расширения: 1 - время, 2 - тип сообщения)
+MSGPACK_MARKER = 0x02
+EXT_TIME = 1
+EXT_TYPE = 2
+
+
+def _compact(value, key=None):
+    """Замена имен полей и типов номерами перед упаковкой в msgpack"""
+    kind = type(value)
+    if kind is dict:
+        result = {}
+        for field, item in value.items():
+            if type(field) is not str:
+                field = str(field)
+            if field == 'type' and type(item) is str and item in TYPE_IDS:
+                result[1] = msgpack.ExtType(EXT_TYPE, bytes((TYPE_IDS[item],)))
+            else:
+                result[FIELD_IDS.get(field, field)] = _compact(item, field)
+        return result
+    if kind is list or kind is tuple:
+        return [_compact(item) for item in value]
+    if kind is str and key in TIME_FIELDS:
+        micros = time_to_micros(value)
+        if micros is not None:
+            return msgpack.ExtType(EXT_TIME, _INT64.pack(micros))
+    return value
+
+
+def _field_names(fields):
+    """Обратная замена номеров полей именами (вызывается msgpack для каждого словаря)"""
+    return {(FIELDS[field - 1] if field <= len(FIELDS) else f'#{field}') if type(field) is int else field: item
+            for field, item in fields.items()}
+
+
+def _ext_hook(code, data):
+    if code == EXT_TIME:
+        return micros_to_time(_INT64.unpack(data)[0])
+    if code == EXT_TYPE:
+        return MESSAGE_TYPES[data[0] - 1] if data[0] <= len(MESSAGE_TYPES) else f'#{data[0]}'
+    raise CodecError(f"Неизвестное расширение msgpack: {code}")
+
+
+class MsgpackCodec:
+    """Тот же компактный формат с упаковкой через msgpack (C-расширение, если установлено)"""
+
+    name = 'msgpack'
+    marker = MSGPACK_MARKER
+
+    def encode(self, message):
+        try:
+            return bytes((MSGPACK_MARKER,)) + msgpack.packb(_compact(message))
+        except (TypeError, ValueError, OverflowError) as e:
+            raise CodecError(f"Сообщение не сериализуется в msgpack: {e}")
+
+    def decode(self, payload):
+        try:
+            return msgpack.unpackb(memoryview(payload)[1:], object_hook=_field_names, ext_hook=_ext_hook,
+                                   strict_map_key=False)
+        except CodecError:
+            raise
+        except Exception as e:
+            raise CodecError(f"Поврежденное сообщение msgpack: {e}")
+
+    def with_version(self, payload, version):
+        """Номер версии добавляется первым полем (заголовок fixmap или map16 перезаписывается)"""
+        head = payload[1]
+        if 0x80 <= head < 0x8f:
+            prefix, rest = bytes((0x80 | (head - 0x80 + 1),)), 2
+        elif head == 0xde and payload[2:4] != b'\xff\xff':
+            prefix, rest = b'\xde' + struct.pack('>H', struct.unpack_from('>H', payload, 2)[0] + 1), 4
+        else:
+            # Редкий случай: словарь с 15 или 65535 полями - сериализуем заново
+            message = self.decode(payload)
+            return self.encode({'version': version, **message})
+        return (bytes((MSGPACK_MARKER,)) + prefix + msgpack.packb(FIELD_IDS['version']) +
+                msgpack.packb(version) + payload[rest:])
+
+
+JSON_CODEC = JsonCodec()
+CODECS = {codec.name: codec for codec in (
+    ([MsgpackCodec()] if msgpack is not None else []) + [BinaryCodec(), JSON_CODEC])}
+# Порядок предпочтения клиента при согласовании: сервер выбирает первый поддерживаемый
+CODEC_NAMES = tuple(CODECS)
+_BY_MARKER = {codec.marker: codec for codec in CODECS.values() if codec is not JSON_CODEC}
+
+
+def get_codec(name):
+    """Кодек по имени (JSON, если имя неизвестно или не задано)"""
+    return CODECS.get(name, JSON_CODEC)
+
+
+def detect_codec(payload):
+    """Кодек, которым сериализована полезная нагрузка (по первому байту; JSON начинается с '{')"""
+    if payload and payload[0] in _BY_MARKER:
+        return _BY_MARKER[payload[0]]
+    if payload and payload[0] in (BINARY_MARKER, MSGPACK_MARKER):
+        raise CodecError("Сообщение в кодеке, недоступном на этой стороне")
+    return JSON_CODEC
@@ -0,0 +1,240 @@
+import struct
+import threading
+import zlib
+
+from codec import JSON_CODEC, detect_codec
+
+
+# Каждый кадр: 4 байта длины (big-endian) + полезная нагрузка
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+# Старший бит длины - признак сжатого кадра (длина кадра не превышает MAX_FRAME_SIZE,
+# поэтому бит свободен). Сжатые кадры получает только клиент, согласовавший сжатие при входе
+COMPRESSED_FLAG = 0x80000000
+COMPRESSION_METHODS = ('zlib',)
+COMPRESSION_THRESHOLD = 1024  # кадры меньше этого размера не сжимаются
+COMPRESSION_LEVEL = 1  # для JSON истории почти то же сжатие, что и 6, но вдвое быстрее
+
+
+class FrameError(Exception):
+    """Ошибка разбора потока кадров"""
+
+
+def encode_frame(payload):
+    """Упаковка байтов в кадр с префиксом длины"""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"Слишком большой кадр: {len(payload)} байт")
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_payload(message, codec=JSON_CODEC):
+    """Сериализация сообщения в полезную нагрузку кадра (по умолчанию JSON в UTF-8)"""
+    return codec.encode(message)
+
+
+def encode_message(message, codec=JSON_CODEC):
+    """Сериализация сообщения в готовый к отправке кадр"""
+    return encode_frame(codec.encode(message))
+
+
+def decode_message(payload):
+    """Разбор полезной нагрузки кадра обратно в сообщение (кодек определяется по первому байту)"""
+    return detect_codec(payload).decode(payload)
+
+
+def decompress_payload(data):
+    """Распаковка сжатой полезной нагрузки с проверкой размера результата"""
+    decompressor = zlib.decompressobj()
+    try:
+        payload = decompressor.decompress(data, MAX_FRAME_SIZE)
+    except zlib.error as e:
+        raise FrameError(f"Поврежденный сжатый кадр: {e}")
+    if decompressor.unconsumed_tail:
+        raise FrameError(f"Слишком большой кадр после распаковки: больше {MAX_FRAME_SIZE} байт")
+    return payload
+
+
+def frame_payload(frame):
+    """Полезная нагрузка готового кадра (сжатого или нет)"""
+    (length,) = HEADER.unpack_from(frame)
+    if length & COMPRESSED_FLAG:
+        return decompress_payload(frame[HEADER.size:])
+    return frame[HEADER.size:]
+
+
+class FrameCompressor:
+    """Сжатие кадров для клиентов, согласовавших его при входе, и счетчики байт.
+
+    Кадры меньше threshold и кадры, которые сжатие не уменьшило, отправляются
+    как есть. Один объект общий для всех соединений сервера.
+    """
+
+    def __init__(self, threshold=COMPRESSION_THRESHOLD, level=COMPRESSION_LEVEL):
+        self.threshold = threshold
+        self.level = level
+        self.lock = threading.Lock()
+        self.frames = 0  # кадров отправлено клиентам со сжатием
+        self.compressed = 0  # из них сжато
+        self.bytes_in = 0  # байт до сжатия
+        self.bytes_out = 0  # байт после сжатия
+
+    def compress(self, frame):
+        """Кадр для отправки: сжатый, если это выгодно"""
+        result = self.pack(frame)
+        self.count(frame, result)
+        return result
+
+    def pack(self, frame):
+        """Сжатие кадра без учета в счетчиках (кадр без изменений, если сжатие не выгодно)"""
+        if len(frame) - HEADER.size >= self.threshold:
+            data = zlib.compress(memoryview(frame)[HEADER.size:], self.level)
+            if len(data) + HEADER.size < len(frame):
+                return HEADER.pack(len(data) | COMPRESSED_FLAG) + data
+        return frame
+
+    def count(self, frame, result):
+        """Учет отправки кадра frame в виде result"""
+        with self.lock:
+            self.frames += 1
+            self.compressed += result is not frame
+            self.bytes_in += len(frame)
+            self.bytes_out += len(result)
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {'frames': self.frames, 'compressed': self.compressed,
+                    'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+
+class SharedMessage:
+    """Сообщение для рассылки многим соединениям: сериализуется (и сжимается)
+    не больше одного раза на каждый кодек, сколько бы получателей его ни согласовали.
+
+    Может быть создано из готовой JSON-нагрузки (например, пришедшей по шине) -
+    тогда сообщение разбирается, только если понадобится другой кодек.
+    """
+
+    def __init__(self, message=None, payload=None):
+        self.message = message
+        self.payloads = {}
+        self.frames = {}
+        if payload is not None:
+            self.payloads[JSON_CODEC.name] = payload
+
+    def payload(self, codec=JSON_CODEC):
+        payload = self.payloads.get(codec.name)
+        if payload is None:
+            if self.message is None:
+                self.message = JSON_CODEC.decode(self.payloads[JSON_CODEC.name])
+            payload = self.payloads[codec.name] = codec.encode(self.message)
+        return payload
+
+    def frame(self, codec=JSON_CODEC, compressor=None):
+        """Кадр в кодеке codec; со сжатием compressor, если он передан"""
+        key = (codec.name, compressor is not None)
+        frame = self.frames.get(key)
+        if frame is None:
+            if compressor is None:
+                frame = encode_frame(self.payload(codec))
+            else:
+                frame = compressor.pack(self.frame(codec))
+            self.frames[key] = frame
+        return frame
+
+
+def send_message(sock, message, codec=JSON_CODEC):
+    """Отправка сообщения целым кадром"""
+    sock.sendall(encode_message(message, codec))
+
+
+class FrameReader:
+    """Сборка кадров из потока через переиспользуемый приемный буфер.
+
+    Данные принимаются прямо в буфер (recv_into), а из одного чтения
+    извлекается столько кадров, сколько в нем поместилось. Неполный кадр
+    остается в буфере до следующего чтения. Сжатые кадры распаковываются.
+    """
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # начало еще не разобранных данных
+        self.end = 0  # конец принятых данных
+        self.needed = 0  # полный размер ожидаемого кадра (с заголовком)
+
+    def pending(self):
+        """Количество принятых, но еще не разобранных байт"""
+        return self.end - self.start
+
+    def _make_room(self):
+        """Освобождение места под следующее чтение"""
+        pending = self.end - self.start
+        size = len(self.buffer)
+        if self.needed > size or pending == size:
+            # Кадр не помещается в буфер - расширяем его
+            new_size = max(size * 2, self.needed)
+            new_buffer = bytearray(new_size)
+            new_buffer[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer = new_buffer
+            self.view = memoryview(self.buffer)
+        elif self.start:
+            # Сдвигаем хвост неполного кадра в начало буфера
+            # (через копию: области источника и назначения могут перекрываться)
+            self.buffer[:pending] = bytes(self.view[self.start:self.end])
+        self.start = 0
+        self.end = pending
+
+    def recv_from(self, sock):
+        """Прием данных из сокета в буфер. Возвращает число байт (0 - соединение закрыто)"""
+        if self.end == len(self.buffer) or self.start + self.needed > len(self.buffer):
+            self._make_room()
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        """Добавление уже принятых байт (для источников без recv_into)"""
+        offset = 0
+        while offset < len(data):
+            if self.end == len(self.buffer):
+                self._make_room()
+            chunk = min(len(data) - offset, len(self.buffer) - self.end)
+            self.buffer[self.end:self.end + chunk] = data[offset:offset + chunk]
+            self.end += chunk
+            offset += chunk
+
+    def frames(self):
+        """Генератор полных кадров, уже находящихся в буфере"""
+        while self.end - self.start >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer, self.start)
+            compressed = length & COMPRESSED_FLAG
+            length &= ~COMPRESSED_FLAG
+            if length > MAX_FRAME_SIZE:
+                raise FrameError(f"Слишком большой кадр: {length} байт")
+
+            frame_end = self.start + HEADER.size + length
+            if frame_end > self.end:
+                # Кадр пришел не полностью - ждем следующего чтения
+                self.needed = HEADER.size + length
+                break
+
+            payload = bytes(self.view[self.start + HEADER.size:frame_end])
+            self.start = frame_end
+            self.needed = 0
+            yield decompress_payload(payload) if compressed else payload
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+
+def iter_messages(sock, reader=None):
+    """Чтение сообщений из блокирующего сокета до закрытия соединения"""
+    if reader is None:
+        reader = FrameReader()
+    while reader.recv_from(sock):
+        for payload in reader.frames():
+            yield decode_message(payload)
@@ -1,24 +1,291 @@
 import socket
+import selectors
 import threading
-import json
+import queue
+import collections
 import os
+import shutil
 import logging
+import time
 from datetime import datetime
 import sys
+import argparse
+
+from codec import CODEC_NAMES, JSON_CODEC, get_codec
+from protocol import (COMPRESSION_METHODS, COMPRESSION_THRESHOLD, FrameCompressor, FrameReader, SharedMessage,
+                      decode_message, encode_frame, encode_message, frame_payload, iter_messages)
+from storage import FSYNC_POLICIES, HISTORY_CACHE_SIZE, STORAGE_BACKENDS, open_storage
+
+
+SERVER_MODES = ('threaded', 'eventloop')
+HISTORY_PAGE_MAX = 500  # максимальный размер страницы истории за один запрос
+OUTBOX_SIZE = 1024  # кадров в очереди отправки одного клиента
+# Что делать с клиентом, очередь отправки которого заполнилась:
+#   drop       - отбрасывать новые кадры;
+#   disconnect - закрыть соединение;
+#   spill      - закрыть соединение и дослать неотправленное при следующем входе. Отдельного буфера
+#                нет: курсоры доставки сдвигаются только по записанным в сокет кадрам, поэтому сообщения
+#                из очереди досылаются из истории чатов (на любом процессе или узле с тем же хранилищем,
+#                в том числе после перезапуска). Так же досылаются сообщения и при disconnect
+SLOW_CLIENT_POLICIES = ('drop', 'disconnect', 'spill')
+MISSED_BATCH_SIZE = 100  # пропущенных сообщений в одном кадре missed_messages
+MISSED_CHAT_LIMIT = 500  # больше пропущенных из одного чата при входе не досылается (старые - через историю)
+MISSED_TOTAL_LIMIT = 5000  # и не больше этого за один вход, чтобы не переполнить очередь отправки
+HEARTBEAT_INTERVAL = 1.0  # секунды между сигналами "узел жив" в шину
+NODE_TIMEOUT = 5.0  # узел, молчащий дольше, считается потерянным
+
+
+class ClientConnection:
+    """Соединение с клиентом в режиме threaded: блокирующий сокет, поток чтения и поток записи.
+
+    Отправка только ставит кадр в ограниченную очередь, а в сокет его пишет
+    отдельный поток, поэтому медленный клиент не задерживает ни рассылку
+    остальным, ни отправителя. При переполнении очереди вызывается
+    on_overflow(conn, frame).
+    """
+
+    def __init__(self, sock, address, outbox_size=OUTBOX_SIZE, on_overflow=None):
+        self.sock = sock
+        self.address = address
+        self.username = None
+        self.outbox = queue.Queue(maxsize=outbox_size)
+        self.on_overflow = on_overflow
+        self.dropped = 0  # кадров отброшено из-за переполнения очереди
+        self.closed = False
+        self.version_lock = threading.Lock()
+        self.chats_version = 0  # версия списка чатов, известная клиенту
+        self.compressor = None  # FrameCompressor, если клиент согласовал сжатие
+        self.codec = JSON_CODEC  # кодек сообщений, согласованный с клиентом при входе
+        # Курсоры доставки: (вид чата, чат) -> seq последнего сообщения, переданного этому соединению
+        self.cursors = {}
+        self.saved_cursors = {}  # те же курсоры, уже записанные в хранилище
+        self.cursor_lock = threading.Lock()  # курсоры меняют поток записи и потоки обработки
+
+    def start_writer(self):
+        """Запуск потока записи"""
+        writer_thread = threading.Thread(target=self.write_loop)
+        writer_thread.daemon = True
+        writer_thread.start()
+
+    def write_loop(self):
+        """Запись кадров из очереди в сокет до закрытия соединения"""
+        try:
+            while True:
+                item = self.outbox.get()
+                if item is None or self.closed:
+                    break
+                frame, position = item
+                self.sock.sendall(frame)
+                if position is not None:
+                    self.delivered(*position)
+        except OSError:
+            pass
+        finally:
+            # Клиент перестал принимать данные - закрываем и чтение тоже
+            self.close()
+
+    def send(self, message, position=None):
+        """Отправка сообщения клиенту целым кадром"""
+        self.send_frame(encode_message(message, self.codec), position)
+
+    def send_frame(self, frame, position=None):
+        """Постановка готового кадра в очередь отправки.
+
+        position - (вид чата, чат, seq): курсор доставки сдвигается, когда кадр
+        записан в сокет, а не когда поставлен в очередь.
+        """
+        if self.compressor is not None:
+            frame = self.compressor.compress(frame)
+        self.queue_frame(frame, position)
+
+    def send_shared(self, shared, position=None):
+        """Отправка сообщения рассылки: кадр в кодеке соединения, сжатый один раз на всех получателей"""
+        frame = shared.frame(self.codec)
+        if self.compressor is not None:
+            result = shared.frame(self.codec, self.compressor)
+            self.compressor.count(frame, result)
+            frame = result
+        self.queue_frame(frame, position)
+
+    def queue_frame(self, frame, position=None):
+        """Постановка кадра, уже сжатого при необходимости, в очередь отправки"""
+        if self.closed:
+            raise ConnectionError("Соединение закрыто")
+        try:
+            self.outbox.put_nowait((frame, position))
+        except queue.Full:
+            self.overflow(frame)
+
+    def overflow(self, frame):
+        if self.on_overflow is not None:
+            self.on_overflow(self, frame)
+
+    def send_versioned(self, message):
+        """Отправка события списка чатов со следующим номером версии.
+
+        По разрыву в номерах клиент понимает, что событие потеряно, и
+        запрашивает полный список.
+        """
+        self.send_versioned_payload(self.codec.encode(message))
+
+    def send_versioned_payload(self, payload):
+        """Отправка уже сериализованного кодеком соединения события с номером версии.
+
+        Номер вставляется в готовую нагрузку, поэтому одно событие, рассылаемое
+        многим клиентам, сериализуется только один раз на каждый кодек.
+        """
+        with self.version_lock:
+            self.chats_version += 1
+            self.send_frame(encode_frame(self.codec.with_version(payload, self.chats_version)))
+
+    def delivered(self, kind, chat, seq):
+        """Сдвиг курсора доставки чата после записи в сокет сообщения seq"""
+        key = (kind, chat)
+        with self.cursor_lock:
+            if seq > self.cursors.get(key, 0):
+                self.cursors[key] = seq
+
+    def move_cursor(self, old_key, new_key):
+        """Перенос курсора доставки на новый ключ чата (после переименования группы)"""
+        with self.cursor_lock:
+            for cursors in (self.cursors, self.saved_cursors):
+                if old_key in cursors:
+                    cursors[new_key] = cursors.pop(old_key)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.outbox.put_nowait(None)  # будим поток записи
+        except queue.Full:
+            pass
+        self.close_socket()
+
+    def close_socket(self):
+        try:
+            # shutdown прерывает recv, заблокированный в потоке чтения
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class EventLoopConnection(ClientConnection):
+    """Соединение с клиентом в режиме eventloop: неблокирующий сокет и очередь отправки"""
+
+    def __init__(self, sock, address, selector, outbox_size=OUTBOX_SIZE, on_overflow=None):
+        super().__init__(sock, address, outbox_size, on_overflow)
+        self.selector = selector
+        self.reader = FrameReader()
+        self.outbox = collections.deque()
+        self.outbox_size = outbox_size
+        self.head_sent = 0  # сколько байт первого кадра очереди уже отправлено
+
+    def queue_frame(self, frame, position=None):
+        """Постановка кадра в очередь отправки; запись продолжится по готовности сокета"""
+        if self.closed:
+            raise ConnectionError("Соединение закрыто")
+        if len(self.outbox) >= self.outbox_size:
+            self.overflow(frame)
+            return
+        was_empty = not self.outbox
+        self.outbox.append((frame, position))
+        if was_empty:
+            self.flush()
+
+    def flush(self):
+        """Запись накопленных кадров без блокировки"""
+        try:
+            while self.outbox:
+                frame, position = self.outbox[0]
+                self.head_sent += self.sock.send(memoryview(frame)[self.head_sent:])
+                if self.head_sent < len(frame):
+                    break
+                self.outbox.popleft()
+                self.head_sent = 0
+                if position is not None:
+                    self.delivered(*position)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            # Соединение разорвано - оно будет закрыто при следующем чтении
+            self.outbox.clear()
+            self.head_sent = 0
+        events = selectors.EVENT_READ
+        if self.outbox:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(self.sock, events, self)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.selector.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+        self.outbox.clear()
+        self.close_socket()
 
 
 class MessengerServer:
-    def __init__(self, host='localhost', port=5000):
+    def __init__(self, host='localhost', port=5000, mode='threaded', backlog=128, fsync_policy='interval',
+                 checkpoint_interval=300, checkpoint_wal_size=64 * 1024 * 1024,
+                 outbox_size=OUTBOX_SIZE, slow_client_policy='disconnect', storage='json',
+                 history_cache_size=HISTORY_CACHE_SIZE, node_id=None, compression_threshold=COMPRESSION_THRESHOLD,
+                 codecs=None):
+        if mode not in SERVER_MODES:
+            raise ValueError(f"Неизвестный режим сервера: {mode}")
+        if slow_client_policy not in SLOW_CLIENT_POLICIES:
+            raise ValueError(f"Неизвестная политика для медленных клиентов: {slow_client_policy}")
         self.host = host
         self.port = port
+        self.mode = mode  # threaded - поток на клиента, eventloop - один поток с selectors
+        self.backlog = backlog
         self.clients = {}
-        self.private_chats = {}
-        self.group_chats = {}
-        self.user_data = {}
+        self.clients_lock = threading.Lock()
         self.running = True
 
+        # Работа одним из нескольких узлов (процессов или серверов, см. workers.py): клиенты
+        # других узлов доступны через шину, на которой каждый узел объявляет своих пользователей
+        self.node_id = node_id
+        self.bus = None
+        self.remote_users = {}  # username -> узел, к которому пользователь подключен (таблица маршрутов)
+        self.node_seen = {}  # узел -> время последнего сообщения от него
+        self.heartbeat_interval = HEARTBEAT_INTERVAL
+        self.node_timeout = NODE_TIMEOUT
+        self.loop_calls = collections.deque()  # вызовы из других потоков для цикла событий
+        self.loop_wakeup = None
+
+        # Сжатие кадров для клиентов, которые его поддерживают (None - не сжимать)
+        self.compressor = FrameCompressor(compression_threshold) if compression_threshold is not None else None
+        # Кодеки, которые сервер согласен использовать (JSON понимается всегда)
+        self.codecs = tuple(codecs) if codecs is not None else CODEC_NAMES
+        unknown = [name for name in self.codecs if name not in CODEC_NAMES]
+        if unknown:
+            raise ValueError(f"Неизвестные или недоступные кодеки: {', '.join(unknown)}")
+
+        # Очереди отправки клиентов
+        self.outbox_size = outbox_size
+        self.slow_client_policy = slow_client_policy
+
+        self.checkpoint_lock = threading.Lock()
+        self.checkpoint_event = threading.Event()
+        self.checkpoint_interval = checkpoint_interval  # секунды между контрольными точками
+
         self.setup_logging()
-        self.load_data()
+
+        # Все данные чатов - за интерфейсом хранилища: json (снимок, журнал изменений и
+        # файл истории, из которого истории загружаются в память в пределах history_cache_size)
+        # или sqlite (история в базе, память не растет с объемом истории)
+        self.storage = open_storage(storage, self.logger, fsync=fsync_policy,
+                                    checkpoint_wal_size=checkpoint_wal_size,
+                                    history_cache_size=history_cache_size, shared=node_id is not None)
+        self.storage.load()
 
     def setup_logging(self):
         """Настройка подробного логирования"""
@@ -32,447 +299,722 @@ class MessengerServer:
         )
         self.logger = logging.getLogger(__name__)
 
-    def load_data(self):
-        """Загрузка сохраненных данных с улучшенной обработкой ошибок"""
-        try:
-            if os.path.exists('server_data.json'):
-                with open('server_data.json', 'r', encoding='utf-8') as f:
-                    content = f.read().strip()
-
-                    # Проверяем, не пустой ли файл
-                    if not content:
-                        self.logger.warning("Файл данных пуст, используются значения по умолчанию")
-                        self.private_chats = {}
-                        self.group_chats = {}
-                        self.user_data = {}
-                        return
-
-                    data = json.loads(content)
-                    self.private_chats = data.get('private_chats', {})
-                    self.group_chats = data.get('group_chats', {})
-                    self.user_data = data.get('user_data', {})
-
-                self.logger.info("Данные успешно загружены")
-
-                # Конвертируем ключи private_chats обратно в tuple
-                private_chats_converted = {}
-                for key, value in self.private_chats.items():
-                    if isinstance(key, list):
-                        # Конвертируем list обратно в tuple
-                        private_chats_converted[tuple(key)] = value
-                    elif isinstance(key, str):
-                        # Обрабатываем строковые ключи (для обратной совместимости)
-                        try:
-                            key_data = json.loads(key.replace("'", '"'))
-                            private_chats_converted[tuple(key_data)] = value
-                        except:
-                            # Если не получается распарсить, пропускаем этот чат
-                            self.logger.warning(f"Не удалось восстановить ключ личного чата: {key}")
-                            continue
-                    else:
-                        private_chats_converted[key] = value
-
-                self.private_chats = private_chats_converted
-                self.logger.info(f"Загружено {len(self.private_chats)} личных чатов и {len(self.group_chats)} групп")
-
-        except json.JSONDecodeError as e:
-            self.logger.error(f"Ошибка декодирования JSON: {e}")
-            self.logger.info("Создаются новые данные по умолчанию")
-            # Создаем резервную копию поврежденного файлаh
-            if os.path.exists('server_data.json'):
-                backup_name = f"server_data_backup_{int(datetime.now().timestamp())}.json"
-                os.rename('server_data.json', backup_name)
-                self.logger.info(f"Создана резервная копия поврежденного файла: {backup_name}")
-
-            self.private_chats = {}
-            self.group_chats = {}
-            self.user_data = {}
-
-        except Exception as e:
-            self.logger.error(f"Неожиданная ошибка загрузки данных: {e}")
-            self.private_chats = {}
-            self.group_chats = {}
-            self.user_data = {}
+    def commit(self, record):
+        """Применение изменения через хранилище (результат - как у JsonStorage.commit)"""
+        result = self.storage.commit(record)
+        if self.storage.needs_checkpoint():
+            self.request_checkpoint()
+        return result
 
     def save_data(self):
-        """Сохранение данных с улучшенной обработкой ошибок"""
-        try:
-            # Создаем временную копию для безопасного сохранения
-            temp_data = {
-                'private_chats': {},
-                'group_chats': self.group_chats.copy(),
-                'user_data': self.user_data.copy()
-            }
-
-            # Конвертируем tuple ключи в строки для JSON сериализации
-            for key, value in self.private_chats.items():
-                if isinstance(key, tuple):
-                    # Сохраняем tuple как JSON строку для надежности
-                    temp_data['private_chats'][json.dumps(list(key))] = value
-                else:
-                    temp_data['private_chats'][str(key)] = value
-
-            # Сначала сохраняем во временный файл
-            temp_filename = 'server_data_temp.json'
-            with open(temp_filename, 'w', encoding='utf-8') as f:
-                json.dump(temp_data, f, indent=2, ensure_ascii=False, default=str)
-
-            # Затем заменяем старый файл новым
-            if os.path.exists('server_data.json'):
-                os.replace(temp_filename, 'server_data.json')
-            else:
-                os.rename(temp_filename, 'server_data.json')
+        """Синхронная контрольная точка (при остановке сервера)"""
+        self.checkpoint()
 
-            self.logger.info(
-                f"Данные успешно сохранены: {len(self.private_chats)} личных чатов, {len(self.group_chats)} групп")
+    def request_checkpoint(self):
+        """Запрос контрольной точки в фоновом потоке"""
+        self.checkpoint_event.set()
 
-        except Exception as e:
-            self.logger.error(f"Ошибка сохранения данных: {e}")
-            # Пытаемся удалить временный файл в случае ошибки
+    def checkpoint_loop(self):
+        """Фоновый поток контрольных точек: по интервалу или по запросу"""
+        while self.running:
+            requested = self.checkpoint_event.wait(self.checkpoint_interval)
+            self.checkpoint_event.clear()
+            if not self.running:
+                break
+            if requested or self.storage.has_changes():
+                self.checkpoint()
+
+    def checkpoint(self):
+        """Контрольная точка хранилища"""
+        with self.checkpoint_lock:
             try:
-                if os.path.exists('server_data_temp.json'):
-                    os.remove('server_data_temp.json')
-            except:
-                pass
+                self.storage.checkpoint()
+            except Exception as e:
+                self.logger.error(f"Ошибка сохранения данных: {e}")
 
     def get_user_local_ip(self, username):
         """Получение локального IP пользователя"""
-        return self.user_data.get(username, {}).get('local_ip', 'Неизвестно')
+        return (self.storage.get_user(username) or {}).get('local_ip', 'Неизвестно')
 
     def get_user_server_ip(self, username):
         """Получение серверного IP пользователя"""
-        return self.user_data.get(username, {}).get('server_ip', 'Неизвестно')
+        return (self.storage.get_user(username) or {}).get('server_ip', 'Неизвестно')
 
     def handle_client(self, client_socket, address):
-        user_ip = address[0]  # Серверный IP (который видит сервер)
-        username = None
+        """Обслуживание клиента в отдельном потоке (режим threaded)"""
+        conn = ClientConnection(client_socket, address, self.outbox_size, self.handle_slow_client)
+        conn.start_writer()
 
         try:
-            while self.running:
-                data = client_socket.recv(1024).decode('utf-8')
-                if not data:
+            for message in iter_messages(client_socket):
+                if not self.running:
                     break
-
-                message = json.loads(data)
-                msg_type = message.get('type')
-
-                if msg_type == 'register':
-                    username = message['username']
-                    local_ip = message.get('local_ip', 'Неизвестно')  # Локальный IP от клиента
-                    
-                    self.clients[username] = client_socket
-                    self.user_data[username] = {
-                        'local_ip': local_ip,      # Локальный IP компьютера
-                        'server_ip': user_ip,      # Серверный IP (который видит сервер)
-                        'last_seen': datetime.now().isoformat()
-                    }
-                    self.logger.info(f"Пользователь {username} зарегистрирован с локальным IP {local_ip} и серверным IP {user_ip}")
-
-                    # Отправляем клиенту его серверный IP
-                    server_ip_msg = {
-                        'type': 'server_ip_assigned',
-                        'server_ip': user_ip
-                    }
-                    client_socket.send(json.dumps(server_ip_msg).encode('utf-8'))
-
-                    # Сохраняем данные после регистрации нового пользователя
-                    self.save_data()
-
-                    # Отправляем историю чатов пользователю
-                    self.send_user_chats(username)
-
-                elif msg_type == 'private_message':
-                    from_user = message['from']
-                    to_user = message['to']
-                    text = message['text']
-                    timestamp = datetime.now().isoformat()
-                    local_ip = message.get('local_ip', self.get_user_local_ip(from_user))
-                    server_ip = message.get('server_ip', self.get_user_server_ip(from_user))
-
-                    chat_id = tuple(sorted([from_user, to_user]))
-                    if chat_id not in self.private_chats:
-                        self.private_chats[chat_id] = []
-
-                    msg_data = {
-                        'from': from_user,
-                        'local_ip': local_ip,
-                        'server_ip': server_ip,
-                        'text': text,
-                        'timestamp': timestamp
-                    }
-                    self.private_chats[chat_id].append(msg_data)
-
-                    self.logger.info(f"Личное сообщение от {from_user} к {to_user}: {text[:50]}...")
-
-                    # Отправляем сообщение получателю, если он онлайн
-                    if to_user in self.clients:
-                        forward_msg = {
-                            'type': 'private_message',
-                            'from': from_user,
-                            'local_ip': local_ip,
-                            'server_ip': server_ip,
-                            'text': text,
-                            'timestamp': timestamp
-                        }
-                        self.clients[to_user].send(
-                            json.dumps(forward_msg, ensure_ascii=False).encode('utf-8')
-                        )
-
-                        # Обновляем список чатов получателя
-                        self.send_user_chats(to_user)
-
-                    # Также отправляем сообщение обратно отправителю для подтверждения
-                    confirm_msg = {
-                        'type': 'message_sent',
-                        'message_id': message.get('message_id'),
-                        'timestamp': timestamp
-                    }
-                    if from_user in self.clients:
-                        self.clients[from_user].send(
-                            json.dumps(confirm_msg).encode('utf-8')
-                        )
-
-                    self.save_data()
-
-                elif msg_type == 'group_message':
-                    from_user = message['from']
-                    group_name = message['group']
-                    text = message['text']
-                    timestamp = datetime.now().isoformat()
-                    local_ip = message.get('local_ip', self.get_user_local_ip(from_user))
-                    server_ip = message.get('server_ip', self.get_user_server_ip(from_user))
-
-                    if group_name in self.group_chats and from_user in self.group_chats[group_name]['members']:
-                        msg_data = {
-                            'from': from_user,
-                            'local_ip': local_ip,
-                            'server_ip': server_ip,
-                            'text': text,
-                            'timestamp': timestamp
-                        }
-                        self.group_chats[group_name]['messages'].append(msg_data)
-
-                        self.logger.info(f"Групповое сообщение от {from_user} в {group_name}: {text[:50]}...")
-
-                        # Рассылаем сообщение всем участникам группы
-                        for member in self.group_chats[group_name]['members']:
-                            if member in self.clients:
-                                forward_msg = {
-                                    'type': 'group_message',
-                                    'from': from_user,
-                                    'local_ip': local_ip,
-                                    'server_ip': server_ip,
-                                    'group': group_name,
-                                    'text': text,
-                                    'timestamp': timestamp
-                                }
-                                try:
-                                    self.clients[member].send(
-                                        json.dumps(forward_msg, ensure_ascii=False).encode('utf-8')
-                                    )
-                                except Exception as e:
-                                    self.logger.error(f"Ошибка отправки сообщения пользователю {member}: {e}")
-
-                        self.save_data()
-
-                elif msg_type == 'create_group':
-                    group_name = message['group_name']
-                    creator = message['creator']
-
-                    if group_name not in self.group_chats:
-                        self.group_chats[group_name] = {
-                            'creator': creator,
-                            'members': [creator],
-                            'messages': []
-                        }
-                        self.save_data()
-                        self.logger.info(f"Создана группа {group_name} пользователем {creator}")
-
-                        response = {'type': 'group_created', 'group_name': group_name}
-                        client_socket.send(json.dumps(response).encode('utf-8'))
-
-                        # Обновляем чаты у создателя
-                        if creator in self.clients:
-                            self.send_user_chats(creator)
-
-                elif msg_type == 'join_group':
-                    group_name = message['group_name']
-                    username = message['username']
-
-                    if group_name in self.group_chats:
-                        if username not in self.group_chats[group_name]['members']:
-                            self.group_chats[group_name]['members'].append(username)
-                            self.save_data()
-                            self.logger.info(f"Пользователь {username} вступил в группу {group_name}")
-
-                            response = {'type': 'group_joined', 'group_name': group_name}
-                            client_socket.send(json.dumps(response).encode('utf-8'))
-
-                            # Обновляем чаты у пользователя
-                            if username in self.clients:
-                                self.send_user_chats(username)
-
-                elif msg_type == 'get_chat_history':
-                    chat_type = message['chat_type']
-                    chat_id = message['chat_id']
-                    username = message['username']
-
-                    history = []
-                    if chat_type == 'private':
-                        chat_key = tuple(sorted([username, chat_id]))
-                        if chat_key in self.private_chats:
-                            history = self.private_chats[chat_key]
-                    elif chat_type == 'group':
-                        if chat_id in self.group_chats and username in self.group_chats[chat_id]['members']:
-                            history = self.group_chats[chat_id]['messages']
-
-                    response = {
-                        'type': 'chat_history',
-                        'chat_type': chat_type,
-                        'chat_id': chat_id,
-                        'history': history
-                    }
-                    client_socket.send(json.dumps(response, ensure_ascii=False).encode('utf-8'))
-
-                elif msg_type == 'get_group_members':
-                    """Обработка запроса списка участников группы"""
-                    group_name = message['group_name']
-                    username = message['username']
-
-                    if group_name in self.group_chats and username in self.group_chats[group_name]['members']:
-                        members = self.group_chats[group_name]['members']
-                        # Создаем список участников с их IP-адресами
-                        members_with_ip = []
-                        for member in members:
-                            # Получаем оба IP пользователя
-                            member_local_ip = self.get_user_local_ip(member)
-                            member_server_ip = self.get_user_server_ip(member)
-                            
-                            members_with_ip.append({
-                                'username': member,
-                                'local_ip': member_local_ip,
-                                'server_ip': member_server_ip
-                            })
-                        
-                        response = {
-                            'type': 'group_members',
-                            'group_name': group_name,
-                            'members': members_with_ip
-                        }
-                        client_socket.send(json.dumps(response, ensure_ascii=False).encode('utf-8'))
-                        self.logger.info(f"Пользователь {username} запросил список участников группы {group_name}")
-
-                elif msg_type == 'rename_group':
-                    group_name = message['group_name']
-                    new_name = message['new_name']
-                    username = message['username']
-
-                    if (group_name in self.group_chats and
-                            self.group_chats[group_name]['creator'] == username):
-
-                        # Сохраняем данные группы под новым именем
-                        self.group_chats[new_name] = self.group_chats.pop(group_name)
-                        self.save_data()
-                        self.logger.info(f"Группа {group_name} переименована в {new_name} пользователем {username}")
-
-                        # Уведомляем всех участников группы
-                        for member in self.group_chats[new_name]['members']:
-                            if member in self.clients:
-                                self.send_user_chats(member)
-
-                elif msg_type == 'delete_group':
-                    group_name = message['group_name']
-                    username = message['username']
-
-                    if (group_name in self.group_chats and
-                            self.group_chats[group_name]['creator'] == username):
-
-                        # Сохраняем список участников для уведомления
-                        members = self.group_chats[group_name]['members'].copy()
-
-                        # Удаляем группу
-                        del self.group_chats[group_name]
-                        self.save_data()
-                        self.logger.info(f"Группа {group_name} удалена пользователем {username}")
-
-                        # Уведомляем всех участников группы
-                        for member in members:
-                            if member in self.clients:
-                                self.send_user_chats(member)
-
-                elif msg_type == 'leave_group':
-                    group_name = message['group_name']
-                    username = message['username']
-
-                    if (group_name in self.group_chats and
-                            username in self.group_chats[group_name]['members']):
-
-                        # Удаляем пользователя из группы
-                        self.group_chats[group_name]['members'].remove(username)
-                        self.save_data()
-                        self.logger.info(f"Пользователь {username} покинул группу {group_name}")
-
-                        # Обновляем чаты пользователя
-                        if username in self.clients:
-                            self.send_user_chats(username)
+                self.process_message(conn, message)
 
         except Exception as e:
-            self.logger.error(f"Ошибка обработки клиента {address}: {e}")
+            # Соединение, закрытое сервером (медленный клиент), завершается без ошибки
+            if not conn.closed:
+                self.logger.error(f"Ошибка обработки клиента {address}: {e}")
         finally:
-            if username and username in self.clients:
+            self.disconnect_client(conn)
+
+    def disconnect_client(self, conn):
+        """Снятие регистрации и закрытие соединения клиента"""
+        username = conn.username
+        with self.clients_lock:
+            # Пользователь мог уже войти заново с другого соединения
+            removed = username and self.clients.get(username) is conn
+            if removed:
                 del self.clients[username]
-                self.logger.info(f"Пользователь {username} отключился")
-            client_socket.close()
+        if removed:
+            self.logger.info(f"Пользователь {username} отключился")
+            self.publish({'kind': 'offline', 'user': username})
+        self.save_delivery_cursors(conn)
+        conn.close()
+
+    def save_delivery_cursors(self, conn):
+        """Запись изменившихся курсоров доставки соединения (при отключении) одной записью"""
+        username = conn.username
+        with conn.cursor_lock:
+            changed = {key: seq for key, seq in conn.cursors.items() if seq != conn.saved_cursors.get(key)}
+        if not username or not changed:
+            return
+        record = {'op': 'delivery_cursors', 'username': username, 'private': {}, 'groups': {}}
+        for (kind, chat), seq in changed.items():
+            if kind == 'private':
+                record['private'][chat[1] if chat[0] == username else chat[0]] = seq
+            else:
+                record['groups'][chat] = seq
+        try:
+            self.commit(record)
+            with conn.cursor_lock:
+                conn.saved_cursors.update(changed)
+        except Exception as e:
+            self.logger.error(f"Ошибка сохранения курсоров доставки {username}: {e}")
+
+    def handle_slow_client(self, conn, frame):
+        """Реакция на переполнение очереди отправки клиента"""
+        name = conn.username or conn.address
+        if self.slow_client_policy == 'drop':
+            conn.dropped += 1
+            if conn.dropped % 100 == 1:
+                self.logger.warning(f"Очередь отправки {name} переполнена, отброшено кадров: {conn.dropped}")
+            return
+
+        if self.slow_client_policy == 'spill':
+            # Курсоры доставки сдвинуты только до записанных в сокет кадров: остальное дошлет вход
+            self.logger.warning(f"Клиент {name} не успевает принимать данные, соединение закрыто; "
+                                f"неотправленные сообщения будут досланы при следующем входе")
+        else:
+            self.logger.warning(f"Клиент {name} не успевает принимать данные, соединение закрыто")
+        self.disconnect_client(conn)
+
+    def send_missed_messages(self, conn):
+        """Досылка при входе сообщений, пропущенных с прошлого подключения, пачками.
+
+        Пропущенные - сообщения чата новее курсора доставки пользователя. Из
+        одного чата досылается не больше MISSED_CHAT_LIMIT последних, за вход -
+        не больше MISSED_TOTAL_LIMIT; более старые клиент загрузит страницами
+        истории (skipped в первом кадре чата - сколько их).
+        """
+        username = conn.username
+        budget = MISSED_TOTAL_LIMIT
+        chats = 0
+        left = 0  # пропущенных, оставленных для загрузки через историю
+        for kind, chat, last_seq, cursor in self.storage.delivery_state(username):
+            with conn.cursor_lock:
+                conn.saved_cursors[(kind, chat)] = cursor
+            if last_seq > cursor:
+                if budget <= 0:
+                    left += last_seq - cursor
+                    continue  # не поместились в этот вход - курсор не двигаем
+                start = max(cursor, last_seq - min(MISSED_CHAT_LIMIT, budget))
+                chat_id = chat if kind == 'group' else (chat[1] if chat[0] == username else chat[0])
+                skipped = start - cursor
+                left += skipped
+                while start < last_seq:
+                    page = self.storage.history_page(kind, chat, min(MISSED_BATCH_SIZE, last_seq - start), after=start)[0]
+                    if not page:
+                        break
+                    conn.send({'type': 'missed_messages', 'chat_type': kind, 'chat_id': chat_id,
+                               'messages': page, 'skipped': skipped}, (kind, chat, page[-1]['seq']))
+                    start = page[-1]['seq']
+                    budget -= len(page)
+                    skipped = 0
+                chats += 1
+        sent = MISSED_TOTAL_LIMIT - budget
+        if sent:
+            self.logger.info(f"Пользователю {username} досланы пропущенные сообщения: {sent} в {chats} чатах")
+        if left:
+            self.logger.info(f"Пользователю {username} не досланы старые пропущенные сообщения: {left} "
+                             f"(сверх ограничений досылки, доступны в истории чатов)")
+
+    def negotiate_compression(self, methods):
+        """Выбор способа сжатия из предложенных клиентом при входе (None - без сжатия)"""
+        if self.compressor is None or not methods:
+            return None
+        for method in methods:
+            if method in COMPRESSION_METHODS:
+                return method
+        return None
+
+    def negotiate_codec(self, names):
+        """Выбор кодека из предложенных клиентом при входе (в порядке его предпочтения)"""
+        for name in names or ():
+            if name in self.codecs:
+                return name
+        return JSON_CODEC.name
+
+    def process_message(self, conn, message):
+        """Обработка одного сообщения клиента (общая для обоих режимов сервера)"""
+        user_ip = conn.address[0]  # Серверный IP (который видит сервер)
+        msg_type = message.get('type')
+
+        if msg_type == 'register':
+            username = message['username']
+            local_ip = message.get('local_ip', 'Неизвестно')  # Локальный IP от клиента
+
+            conn.username = username
+            with self.clients_lock:
+                self.clients[username] = conn
+            self.publish({'kind': 'online', 'user': username})
+            self.commit({
+                'op': 'register',
+                'username': username,
+                'user': {
+                    'local_ip': local_ip,      # Локальный IP компьютера
+                    'server_ip': user_ip,      # Серверный IP (который видит сервер)
+                    'last_seen': datetime.now().isoformat()
+                }
+            })
+            self.logger.info(f"Пользователь {username} зарегистрирован с локальным IP {local_ip} и серверным IP {user_ip}")
+
+            # Отправляем клиенту его серверный IP
+            server_ip_msg = {
+                'type': 'server_ip_assigned',
+                'server_ip': user_ip
+            }
+            # Сжатие больших ответов (история, список чатов, участники групп), если клиент его поддерживает
+            method = self.negotiate_compression(message.get('compression'))
+            if method is not None:
+                server_ip_msg['compression'] = method
+            # Кодек следующих сообщений; клиенты, не предлагавшие кодеков, остаются на JSON
+            codec_name = self.negotiate_codec(message.get('codecs'))
+            if 'codecs' in message:
+                server_ip_msg['codec'] = codec_name
+            conn.send(server_ip_msg)
+            if method is not None:
+                conn.compressor = self.compressor
+            conn.codec = get_codec(codec_name)
+
+            # Отправляем историю чатов пользователю
+            self.send_user_chats(username)
+            self.send_missed_messages(conn)
+
+        elif msg_type == 'private_message':
+            from_user = message['from']
+            to_user = message['to']
+            text = message['text']
+            timestamp = datetime.now().isoformat()
+            local_ip = message.get('local_ip', self.get_user_local_ip(from_user))
+            server_ip = message.get('server_ip', self.get_user_server_ip(from_user))
+
+            chat_id = tuple(sorted([from_user, to_user]))
+            msg_data = {
+                'from': from_user,
+                'local_ip': local_ip,
+                'server_ip': server_ip,
+                'text': text,
+                'timestamp': timestamp
+            }
+            seq = self.commit({'op': 'private_message', 'chat': list(chat_id), 'message': msg_data})
+
+            self.logger.info(f"Личное сообщение от {from_user} к {to_user}: {text[:50]}...")
+
+            # Отправляем сообщение получателю, если он онлайн (на этом или другом процессе)
+            if self.is_online(to_user):
+                position = ('private', chat_id, seq)
+                self.deliver_message([to_user], {
+                    'type': 'private_message',
+                    'from': from_user,
+                    'local_ip': local_ip,
+                    'server_ip': server_ip,
+                    'text': text,
+                    'timestamp': timestamp,
+                    'seq': seq
+                }, position)
+
+                # Обновляем список чатов получателя: новый чат или только последнее сообщение
+                if seq == 1:
+                    self.send_chat_event(to_user, {
+                        'type': 'chat_added',
+                        'kind': 'private',
+                        'chat': self.private_chat_entry(to_user, from_user)
+                    })
+                else:
+                    self.send_chat_event(to_user, {
+                        'type': 'last_message_changed',
+                        'kind': 'private',
+                        'user': from_user,
+                        'last_message': msg_data
+                    })
+
+            # Также отправляем сообщение обратно отправителю для подтверждения
+            confirm_msg = {
+                'type': 'message_sent',
+                'message_id': message.get('message_id'),
+                'timestamp': timestamp,
+                'seq': seq
+            }
+            from_conn = self.clients.get(from_user)
+            if from_conn is not None:
+                from_conn.send(confirm_msg, ('private', chat_id, seq))
+
+        elif msg_type == 'group_message':
+            from_user = message['from']
+            group_name = message['group']
+            text = message['text']
+            timestamp = datetime.now().isoformat()
+            local_ip = message.get('local_ip', self.get_user_local_ip(from_user))
+            server_ip = message.get('server_ip', self.get_user_server_ip(from_user))
+
+            if self.storage.is_member(group_name, from_user):
+                msg_data = {
+                    'from': from_user,
+                    'local_ip': local_ip,
+                    'server_ip': server_ip,
+                    'text': text,
+                    'timestamp': timestamp
+                }
+                seq = self.commit({'op': 'group_message', 'group': group_name, 'message': msg_data})
+                if seq is None:
+                    # Группу удалили, пока сообщение обрабатывалось
+                    return
+
+                self.logger.info(f"Групповое сообщение от {from_user} в {group_name}: {text[:50]}...")
+
+                # Рассылаем сообщение всем участникам группы: кадр один на всех клиентов с одним кодеком
+                group_msg = {
+                    'type': 'group_message',
+                    'from': from_user,
+                    'local_ip': local_ip,
+                    'server_ip': server_ip,
+                    'group': group_name,
+                    'text': text,
+                    'timestamp': timestamp,
+                    'seq': seq
+                }
+                self.deliver_message(self.storage.group_members(group_name), group_msg, ('group', group_name, seq))
+
+        elif msg_type == 'create_group':
+            group_name = message['group_name']
+            creator = message['creator']
+
+            if self.storage.group_info(group_name) is None and \
+                    self.commit({'op': 'create_group', 'group': group_name, 'creator': creator}):
+                self.logger.info(f"Создана группа {group_name} пользователем {creator}")
+
+                response = {'type': 'group_created', 'group_name': group_name}
+                conn.send(response)
+
+                # Обновляем чаты у создателя (если группу еще не успели удалить)
+                entry = self.group_chat_entry(group_name)
+                if entry is not None:
+                    self.send_chat_event(creator, {'type': 'chat_added', 'kind': 'group', 'chat': entry})
+
+        elif msg_type == 'join_group':
+            group_name = message['group_name']
+            username = message['username']
+
+            if self.storage.group_info(group_name) is not None:
+                if not self.storage.is_member(group_name, username) and \
+                        self.commit({'op': 'join_group', 'group': group_name, 'username': username}):
+                    self.logger.info(f"Пользователь {username} вступил в группу {group_name}")
+
+                    response = {'type': 'group_joined', 'group_name': group_name}
+                    # Сообщения до вступления пропущенными не считаются
+                    last = self.storage.history_page('group', group_name, 1)[0]
+                    conn.send(response, ('group', group_name, last[-1]['seq']) if last else None)
+
+                    # Обновляем чаты у пользователя (если группу еще не успели удалить)
+                    entry = self.group_chat_entry(group_name)
+                    if entry is not None:
+                        self.send_chat_event(username, {'type': 'chat_added', 'kind': 'group', 'chat': entry})
+
+        elif msg_type == 'get_chat_history':
+            chat_type = message['chat_type']
+            chat_id = message['chat_id']
+            username = message['username']
+
+            # Страница истории по курсорам before/after (номера сообщений seq)
+            before = message.get('before')
+            after = message.get('after')
+            limit = message.get('limit')
+            if limit is not None:
+                limit = max(1, min(int(limit), HISTORY_PAGE_MAX))
+
+            page, next_before, next_after = [], None, None
+            chat_key = None
+            if chat_type == 'private':
+                chat_key = tuple(sorted([username, chat_id]))
+                page, next_before, next_after = self.storage.history_page('private', chat_key, limit, before, after)
+            elif chat_type == 'group':
+                if self.storage.is_member(chat_id, username):
+                    chat_key = chat_id
+                    page, next_before, next_after = self.storage.history_page('group', chat_id, limit, before, after)
+
+            response = {
+                'type': 'chat_history',
+                'chat_type': chat_type,
+                'chat_id': chat_id,
+                'history': page,
+                'before': before,
+                'after': after,
+                'next_before': next_before,  # курсор для следующей, более старой страницы
+                'next_after': next_after  # курсор для продолжения вперед, если страница не последняя
+            }
+            conn.send(response, (chat_type, chat_key, page[-1]['seq']) if page else None)
+
+        elif msg_type == 'get_group_members':
+            """Обработка запроса списка участников группы"""
+            group_name = message['group_name']
+            username = message['username']
+
+            if self.storage.is_member(group_name, username):
+                members = self.storage.group_members(group_name)
+                # Создаем список участников с их IP-адресами
+                members_with_ip = []
+                for member in members:
+                    # Получаем оба IP пользователя
+                    member_local_ip = self.get_user_local_ip(member)
+                    member_server_ip = self.get_user_server_ip(member)
+
+                    members_with_ip.append({
+                        'username': member,
+                        'local_ip': member_local_ip,
+                        'server_ip': member_server_ip
+                    })
+
+                response = {
+                    'type': 'group_members',
+                    'group_name': group_name,
+                    'members': members_with_ip
+                }
+                conn.send(response)
+                self.logger.info(f"Пользователь {username} запросил список участников группы {group_name}")
+
+        elif msg_type == 'rename_group':
+            group_name = message['group_name']
+            new_name = message['new_name']
+            username = message['username']
+
+            group_info = self.storage.group_info(group_name)
+            if (group_info is not None and group_info['creator'] == username and
+                    self.commit({'op': 'rename_group', 'group': group_name, 'new_name': new_name})):
+
+                # Данные группы сохранены под новым именем
+                self.logger.info(f"Группа {group_name} переименована в {new_name} пользователем {username}")
+
+                # Уведомляем всех участников группы
+                self.broadcast_chat_event(self.storage.group_members(new_name), {
+                    'type': 'chat_renamed',
+                    'kind': 'group',
+                    'old_name': group_name,
+                    'new_name': new_name
+                })
+
+        elif msg_type == 'delete_group':
+            group_name = message['group_name']
+            username = message['username']
+
+            group_info = self.storage.group_info(group_name)
+            if group_info is not None and group_info['creator'] == username:
+
+                # Удаляем группу; commit возвращает ее данные со списком участников на момент удаления
+                group_data = self.commit({'op': 'delete_group', 'group': group_name})
+                if group_data:
+                    self.logger.info(f"Группа {group_name} удалена пользователем {username}")
+
+                    # Уведомляем всех участников группы
+                    self.broadcast_chat_event(group_data['members'],
+                                              {'type': 'chat_removed', 'kind': 'group', 'group_name': group_name})
+
+        elif msg_type == 'leave_group':
+            group_name = message['group_name']
+            username = message['username']
+
+            if self.storage.is_member(group_name, username):
+
+                # Удаляем пользователя из группы
+                if self.commit({'op': 'leave_group', 'group': group_name, 'username': username}):
+                    self.logger.info(f"Пользователь {username} покинул группу {group_name}")
+
+                    # Обновляем чаты пользователя
+                    self.send_chat_event(username, {'type': 'chat_removed', 'kind': 'group', 'group_name': group_name})
+
+        elif msg_type == 'get_chats':
+            # Клиент заметил пропуск в версиях событий и просит полный список
+            if conn.username:
+                self.send_user_chats(conn.username)
+
+    def private_chat_entry(self, username, other_user):
+        """Описание личного чата для списка чатов пользователя"""
+        return {
+            'user': other_user,
+            'local_ip': self.get_user_local_ip(other_user),
+            'server_ip': self.get_user_server_ip(other_user),
+            'last_message': self.storage.last_message('private', tuple(sorted([username, other_user])))
+        }
+
+    def group_chat_entry(self, group_name):
+        """Описание группы для списка чатов пользователя (None, если группы уже нет)"""
+        group_info = self.storage.group_info(group_name)
+        if group_info is None:
+            return None
+        return {
+            'group_name': group_name,
+            'creator': group_info['creator'],
+            'last_message': self.storage.last_message('group', group_name)
+        }
+
+    def send_chat_event(self, username, event):
+        """Отправка пользователю одного изменения его списка чатов"""
+        # Офлайн-пользователь получит полный список при регистрации
+        self.broadcast_chat_event([username], event)
+
+    def broadcast_chat_event(self, usernames, event):
+        """Рассылка одного изменения списка чатов нескольким пользователям"""
+        shared = SharedMessage(event)
+        self.apply_chat_event(usernames, event)
+        remote = self.send_local(usernames, shared, versioned=True)
+        self.route_remote('chat_event', remote, shared.payload())
+
+    def apply_chat_event(self, usernames, event):
+        """Учет изменения списка чатов в состоянии соединений этого узла"""
+        if event['type'] == 'chat_renamed' and event['kind'] == 'group':
+            # Курсоры доставки хранилища уже перенесены на новое имя, переносим и курсоры соединений
+            for username in usernames:
+                conn = self.clients.get(username)
+                if conn is not None:
+                    conn.move_cursor(('group', event['old_name']), ('group', event['new_name']))
+
+    def is_online(self, username):
+        """Подключен ли пользователь к этому или другому узлу"""
+        return username in self.clients or username in self.remote_users
+
+    def deliver_message(self, usernames, message, position=None):
+        """Доставка сообщения пользователям: своим - напрямую, подключенным
+        к другим узлам - одним сообщением шины на каждый такой узел.
+
+        position - (вид чата, чат, seq) сообщения для курсоров доставки.
+        """
+        shared = SharedMessage(message)
+        remote = self.send_local(usernames, shared, position=position)
+        # По шине сообщения идут в JSON: кодек выбирает узел получателя
+        self.route_remote('frame', remote, shared.frame(), position)
+
+    def send_local(self, usernames, shared, versioned=False, position=None):
+        """Отправка сообщения (или события списка чатов) подключенным к этому узлу
+        в кодеке каждого соединения (SharedMessage сериализует его один раз на кодек).
+
+        Возвращает тех, кто подключен к другим узлам.
+        """
+        remote = []
+        for username in list(usernames):
+            conn = self.clients.get(username)
+            if conn is None:
+                if username in self.remote_users:
+                    remote.append(username)
+                continue
+            try:
+                if versioned:
+                    conn.send_versioned_payload(shared.payload(conn.codec))
+                else:
+                    # Курсор доставки сдвинется после записи кадра в сокет
+                    conn.send_shared(shared, position)
+            except Exception as e:
+                self.logger.error(f"Ошибка отправки пользователю {username}: {e}")
+        return remote
+
+    def route_remote(self, kind, usernames, body, position=None):
+        """Пересылка кадра узлам, к которым подключены пользователи (по таблице маршрутов)"""
+        by_node = {}
+        for username in usernames:
+            node = self.remote_users.get(username)
+            if node is not None:
+                by_node.setdefault(node, []).append(username)
+        for node, users in by_node.items():
+            meta = {'kind': kind, 'to': node, 'users': users}
+            if position is not None:
+                meta['position'] = position
+            self.publish(meta, body)
+
+    def publish(self, meta, body=b''):
+        """Сообщение другим узлам: всем или одному (ключ 'to'). Без шины ничего не делает"""
+        if self.bus is None or not self.bus.connected:
+            return
+        meta['node'] = self.node_id
+        try:
+            self.bus.publish(meta, body)
+        except OSError as e:
+            self.logger.error(f"Ошибка отправки в шину: {e}")
+
+    def on_bus_message(self, meta, body):
+        """Сообщение шины (вызывается потоком чтения шины)"""
+        self.call_in_loop(self.handle_bus_message, meta, body)
+
+    def handle_bus_message(self, meta, body):
+        """Обработка сообщения другого узла или посредника шины"""
+        kind = meta['kind']
+        node = meta.get('node')
+        if node is not None:
+            self.note_node(node)
+
+        if kind == 'frame':
+            position = meta.get('position')
+            if position is not None:
+                chat_kind, chat, seq = position
+                position = (chat_kind, tuple(chat) if chat_kind == 'private' else chat, seq)
+            self.send_local(meta['users'], SharedMessage(payload=frame_payload(body)), position=position)
+        elif kind == 'chat_event':
+            event = JSON_CODEC.decode(body)
+            self.apply_chat_event(meta['users'], event)
+            self.send_local(meta['users'], SharedMessage(event, body), versioned=True)
+        elif kind == 'online':
+            self.route_user(meta['user'], node)
+        elif kind == 'offline':
+            # Пользователь мог уже войти через другой узел
+            if self.remote_users.get(meta['user']) == node:
+                del self.remote_users[meta['user']]
+        elif kind == 'sync_request':
+            # Новый или вернувшийся после разделения сети узел запрашивает наших пользователей
+            self.publish({'kind': 'sync', 'to': node, 'users': list(self.clients)})
+        elif kind == 'sync':
+            for username in meta['users']:
+                if username not in self.clients:
+                    self.remote_users[username] = node
+        elif kind == 'node_down':
+            # Посредник потерял соединение с узлом
+            self.drop_node(meta['down'], "отключился от шины")
+        elif kind == 'command':
+            if meta['command'] == 'stop':
+                self.running = False
+            else:
+                self.handle_command(meta['command'])
+
+    def route_user(self, username, node):
+        """Пользователь вошел через другой узел"""
+        self.remote_users[username] = node
+        conn = self.clients.get(username)
+        if conn is None:
+            return
+        # Старое соединение на этом узле больше не получает сообщений
+        with self.clients_lock:
+            if self.clients.get(username) is conn:
+                del self.clients[username]
+        self.logger.info(f"Пользователь {username} вошел через узел {node}, старое соединение закрыто")
+        self.save_delivery_cursors(conn)
+        conn.close()
+
+    def note_node(self, node):
+        """Учет сообщения от узла; у незнакомого узла запрашиваем список его пользователей"""
+        if node == self.node_id:
+            return
+        known = node in self.node_seen
+        self.node_seen[node] = time.monotonic()
+        if not known:
+            self.logger.info(f"Узел {node} в сети")
+            self.publish({'kind': 'sync_request', 'to': node})
+
+    def drop_node(self, node, reason):
+        """Узел потерян: его пользователи считаются не в сети, пока не войдут снова (возможно, через другой узел)"""
+        known = self.node_seen.pop(node, None) is not None
+        lost = [username for username, user_node in list(self.remote_users.items()) if user_node == node]
+        for username in lost:
+            if self.remote_users.get(username) == node:
+                del self.remote_users[username]
+        if known or lost:
+            self.logger.warning(f"Узел {node} {reason}, его пользователей больше не в сети: {len(lost)}")
+
+    def heartbeat(self):
+        """Сигнал другим узлам, что этот узел жив, и поиск замолчавших узлов"""
+        self.publish({'kind': 'heartbeat'})
+        deadline = time.monotonic() - self.node_timeout
+        for node, seen in list(self.node_seen.items()):
+            if seen < deadline:
+                self.call_in_loop(self.drop_node, node, f"не отвечает дольше {self.node_timeout} с")
+
+    def heartbeat_loop(self):
+        """Фоновый поток сигналов "узел жив" """
+        while self.running:
+            self.heartbeat()
+            time.sleep(self.heartbeat_interval)
+
+    def on_bus_connected(self):
+        """Связь с шиной (вновь) установлена"""
+        self.logger.info("Подключение к шине узлов установлено")
+        self.publish({'kind': 'heartbeat'})
+
+    def on_bus_closed(self):
+        """Связь с шиной потеряна: другие узлы недоступны, их пользователи считаются не в сети"""
+        if not self.running:
+            return
+        self.logger.warning("Потеряна связь с шиной узлов, сообщения на другие узлы не доставляются")
+        self.call_in_loop(self.forget_nodes)
+
+    def forget_nodes(self):
+        self.remote_users.clear()
+        self.node_seen.clear()
+
+    def call_in_loop(self, func, *args):
+        """Вызов в потоке цикла событий (режим eventloop) или сразу (режим threaded)"""
+        if self.loop_wakeup is None:
+            func(*args)
+            return
+        self.loop_calls.append((func, args))
+        try:
+            self.loop_wakeup.send(b'\0')
+        except OSError:
+            pass  # буфер полон - цикл и так уже разбужен
 
     def send_user_chats(self, username):
-        """Отправляем пользователю список его чатов"""
+        """Отправляем пользователю полный список его чатов (при регистрации или по запросу)"""
         user_chats = {
             'type': 'chats_update',
             'private_chats': [],
             'group_chats': []
         }
 
+        # Берем из индекса только чаты самого пользователя, не просматривая все чаты сервера
+        private_peers, group_names = self.storage.user_chat_list(username)
+
         # Личные чаты
-        for chat_id, messages in self.private_chats.items():
-            if username in chat_id:
-                other_user = chat_id[0] if chat_id[1] == username else chat_id[1]
-                user_chats['private_chats'].append({
-                    'user': other_user,
-                    'local_ip': self.get_user_local_ip(other_user),
-                    'server_ip': self.get_user_server_ip(other_user),
-                    'last_message': messages[-1] if messages else None
-                })
+        for other_user in private_peers:
+            user_chats['private_chats'].append(self.private_chat_entry(username, other_user))
 
         # Групповые чаты
-        for group_name, group_data in self.group_chats.items():
-            if username in group_data['members']:
-                user_chats['group_chats'].append({
-                    'group_name': group_name,
-                    'creator': group_data['creator'],
-                    'last_message': group_data['messages'][-1] if group_data['messages'] else None
-                })
+        for group_name in group_names:
+            entry = self.group_chat_entry(group_name)
+            if entry is not None:
+                user_chats['group_chats'].append(entry)
 
-        if username in self.clients:
-            try:
-                self.clients[username].send(
-                    json.dumps(user_chats, ensure_ascii=False).encode('utf-8')
-                )
-            except Exception as e:
-                self.logger.error(f"Ошибка отправки чатов пользователю {username}: {e}")
+        self.send_chat_event(username, user_chats)
 
     def stop_server(self):
         """Остановка сервера"""
         self.logger.info("Остановка сервера...")
         self.running = False
+        self.checkpoint_event.set()
 
-        # Закрываем все клиентские соединения
-        for username, sock in self.clients.items():
-            try:
-                sock.close()
-            except:
-                pass
+        # Закрываем все клиентские соединения, сохранив их курсоры доставки
+        for conn in list(self.clients.values()):
+            self.save_delivery_cursors(conn)
+            conn.close()
 
         self.save_data()
+        self.storage.close()
+        if self.bus is not None:
+            self.bus.close()
         self.logger.info("Сервер остановлен")
 
     def console_handler(self):
@@ -483,75 +1025,111 @@ class MessengerServer:
                 if command == 'stop':
                     self.stop_server()
                     os._exit(0)
-                elif command == 'status':
-                    self.logger.info(f"Статус: {len(self.clients)} подключенных пользователей")
-                    self.logger.info(f"Личные чаты: {len(self.private_chats)}")
-                    self.logger.info(f"Группы: {list(self.group_chats.keys())}")
-                    self.logger.info(f"Пользователи: {list(self.user_data.keys())}")
-                elif command == 'save':
-                    self.save_data()
-                    self.logger.info("Данные сохранены вручную")
-                elif command == 'repair_data':
-                    self.repair_data()
-                else:
-                    self.logger.info("Доступные команды: stop, status, save, repair_data")
+                self.handle_command(command)
             except Exception as e:
                 self.logger.error(f"Ошибка в обработчике консоли: {e}")
 
+    def handle_command(self, command):
+        """Выполнение консольной команды (кроме stop)"""
+        try:
+            if command == 'status':
+                stats = self.storage.stats()
+                self.logger.info(f"Статус: {len(self.clients)} подключенных пользователей")
+                if self.node_id is not None:
+                    self.logger.info(f"Узел {self.node_id}: узлов в сети {len(self.node_seen)}, "
+                                     f"пользователей на них {len(self.remote_users)}")
+                self.logger.info(f"Личные чаты: {stats['private_chats']}")
+                self.logger.info(f"Группы: {stats['groups']}")
+                self.logger.info(f"Пользователи: {stats['users']}")
+                cache = stats.get('cache')
+                if cache is not None:
+                    self.logger.info(
+                        f"Кэш историй: {cache['chats']} чатов, {cache['size'] // 1024} из "
+                        f"{cache['budget'] // 1024} КБ, попаданий {cache['hits']}, промахов {cache['misses']}, "
+                        f"выгружено {cache['evictions']}")
+                if self.compressor is not None:
+                    compression = self.compressor.stats()
+                    saved = 1 - compression['bytes_out'] / compression['bytes_in'] if compression['bytes_in'] else 0
+                    self.logger.info(
+                        f"Сжатие: сжато кадров {compression['compressed']} из {compression['frames']}, "
+                        f"{compression['bytes_in'] // 1024} КБ -> {compression['bytes_out'] // 1024} КБ "
+                        f"(экономия {saved:.0%})")
+                codecs = collections.Counter(conn.codec.name for conn in list(self.clients.values()))
+                if codecs:
+                    self.logger.info("Кодеки клиентов: " + ", ".join(f"{name} {count}" for name, count in codecs.items()))
+            elif command == 'save':
+                self.request_checkpoint()
+                self.logger.info("Запрошена контрольная точка")
+            elif command == 'repair_data':
+                self.repair_data()
+            else:
+                self.logger.info("Доступные команды: stop, status, save, repair_data")
+        except Exception as e:
+            self.logger.error(f"Ошибка выполнения команды {command}: {e}")
+
     def repair_data(self):
-        """Восстановление поврежденных данных"""
-        self.logger.info("Попытка восстановления данных...")
+        """Проверка сохраненных данных на диске; при повреждении - новая контрольная точка"""
+        self.logger.info("Проверка сохраненных данных...")
         try:
-            # Создаем резервную копию текущего файла
-            if os.path.exists('server_data.json'):
-                backup_name = f"server_data_repair_backup_{int(datetime.now().timestamp())}.json"
-                os.rename('server_data.json', backup_name)
-                self.logger.info(f"Создана резервная копия: {backup_name}")
+            damaged = self.storage.verify()
 
-            # Сбрасываем данные
-            self.private_chats = {}
-            self.group_chats = {}
-            self.user_data = {}
+            if not damaged:
+                self.logger.info("Сохраненные данные в порядке")
+                return
 
-            # Сохраняем новые данные
-            self.save_data()
-            self.logger.info("Данные успешно восстановлены")
+            # Создаем резервные копии поврежденных файлов
+            for path in damaged:
+                name, ext = os.path.splitext(path)
+                backup_name = f"{name}_repair_backup_{int(datetime.now().timestamp())}{ext}"
+                shutil.copy2(path, backup_name)
+                self.logger.info(f"Поврежден {path}, создана резервная копия: {backup_name}")
+
+            # Данные в памяти целы - новая контрольная точка заменит поврежденные файлы
+            self.request_checkpoint()
+            self.logger.info("Запрошена новая контрольная точка")
 
         except Exception as e:
             self.logger.error(f"Ошибка восстановления данных: {e}")
 
-    def start(self):
-        """Запуск сервера"""
+    def start(self, reuse_port=False, console=True):
+        """Запуск сервера.
+
+        reuse_port - порт слушают несколько процессов сразу (SO_REUSEPORT), ядро
+        распределяет между ними подключения; console - читать команды с консоли.
+        """
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         try:
             server_socket.bind((self.host, self.port))
-            server_socket.listen(5)
-            server_socket.settimeout(1)
-
-            self.logger.info(f"Сервер запущен на {self.host}:{self.port}")
-            self.logger.info("Доступные команды: stop, status, save, repair_data")
-
-            # Запускаем обработчик консольных команд
-            console_thread = threading.Thread(target=self.console_handler)
-            console_thread.daemon = True
-            console_thread.start()
-
-            while self.running:
-                try:
-                    client_socket, address = server_socket.accept()
-                    client_thread = threading.Thread(
-                        target=self.handle_client,
-                        args=(client_socket, address)
-                    )
-                    client_thread.daemon = True
-                    client_thread.start()
-                except socket.timeout:
-                    continue
-                except Exception as e:
-                    if self.running:
-                        self.logger.error(f"Ошибка accept: {e}")
+            server_socket.listen(self.backlog)
+
+            node = f", узел {self.node_id}" if self.node_id is not None else ""
+            self.logger.info(f"Сервер запущен на {self.host}:{self.port} (режим {self.mode}, backlog {self.backlog}{node})")
+
+            if console:
+                # Запускаем обработчик консольных команд
+                self.logger.info("Доступные команды: stop, status, save, repair_data")
+                console_thread = threading.Thread(target=self.console_handler)
+                console_thread.daemon = True
+                console_thread.start()
+
+            # Фоновые контрольные точки
+            checkpoint_thread = threading.Thread(target=self.checkpoint_loop)
+            checkpoint_thread.daemon = True
+            checkpoint_thread.start()
+
+            if self.bus is not None:
+                heartbeat_thread = threading.Thread(target=self.heartbeat_loop)
+                heartbeat_thread.daemon = True
+                heartbeat_thread.start()
+
+            if self.mode == 'eventloop':
+                self.run_event_loop(server_socket)
+            else:
+                self.run_threaded(server_socket)
 
         except Exception as e:
             self.logger.error(f"Ошибка сервера: {e}")
@@ -559,9 +1137,154 @@ class MessengerServer:
             server_socket.close()
             self.stop_server()
 
+    def run_threaded(self, server_socket):
+        """Режим threaded: отдельный поток на каждое соединение"""
+        server_socket.settimeout(1)
+
+        while self.running:
+            try:
+                client_socket, address = server_socket.accept()
+                client_thread = threading.Thread(
+                    target=self.handle_client,
+                    args=(client_socket, address)
+                )
+                client_thread.daemon = True
+                client_thread.start()
+            except socket.timeout:
+                continue
+            except Exception as e:
+                if self.running:
+                    self.logger.error(f"Ошибка accept: {e}")
+
+    def run_event_loop(self, server_socket):
+        """Режим eventloop: все соединения обслуживаются одним потоком через selectors"""
+        selector = selectors.DefaultSelector()
+        server_socket.setblocking(False)
+        selector.register(server_socket, selectors.EVENT_READ, None)
+
+        # Другие потоки (чтение шины) передают работу в цикл через call_in_loop
+        wakeup_reader, wakeup_writer = socket.socketpair()
+        wakeup_reader.setblocking(False)
+        wakeup_writer.setblocking(False)
+        selector.register(wakeup_reader, selectors.EVENT_READ, self.loop_calls)
+        self.loop_wakeup = wakeup_writer
+
+        try:
+            while self.running:
+                for key, events in selector.select(timeout=1):
+                    if key.data is None:
+                        self.accept_connections(server_socket, selector)
+                        continue
+                    if key.data is self.loop_calls:
+                        self.run_loop_calls(wakeup_reader)
+                        continue
+
+                    conn = key.data
+                    if events & selectors.EVENT_WRITE and not conn.closed:
+                        conn.flush()
+                    if events & selectors.EVENT_READ and not conn.closed:
+                        self.read_connection(conn)
+        finally:
+            self.loop_wakeup = None
+            selector.close()
+            wakeup_reader.close()
+            wakeup_writer.close()
+            self.loop_calls.clear()
+
+    def run_loop_calls(self, wakeup_reader):
+        """Выполнение вызовов, переданных в цикл событий из других потоков"""
+        try:
+            while wakeup_reader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self.loop_calls:
+            func, args = self.loop_calls.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                self.logger.error(f"Ошибка обработки сообщения шины: {e}")
+
+    def accept_connections(self, server_socket, selector):
+        """Прием всех ожидающих подключений из очереди backlog"""
+        while True:
+            try:
+                client_socket, address = server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if self.running:
+                    self.logger.error(f"Ошибка accept: {e}")
+                return
+
+            client_socket.setblocking(False)
+            conn = EventLoopConnection(client_socket, address, selector, self.outbox_size, self.handle_slow_client)
+            selector.register(client_socket, selectors.EVENT_READ, conn)
+
+    def read_connection(self, conn):
+        """Чтение доступных данных соединения и обработка всех полных кадров"""
+        try:
+            if not conn.reader.recv_from(conn.sock):
+                self.disconnect_client(conn)
+                return
+            for payload in conn.reader.frames():
+                self.process_message(conn, decode_message(payload))
+                if conn.closed:
+                    return
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as e:
+            self.logger.error(f"Ошибка обработки клиента {conn.address}: {e}")
+            self.disconnect_client(conn)
 
 if __name__ == "__main__":
-    server = MessengerServer()
+    parser = argparse.ArgumentParser(description="Сервер мессенджера")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--mode', choices=SERVER_MODES, default='threaded',
+                        help="threaded - поток на клиента, eventloop - один поток на все соединения")
+    parser.add_argument('--backlog', type=int, default=128, help="Размер очереди ожидающих подключений")
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES, default='interval',
+                        help="Когда сбрасывать журнал изменений на диск: always, interval, never")
+    parser.add_argument('--storage', choices=STORAGE_BACKENDS, default='json',
+                        help="Хранилище данных: json (снимок и журнал) или sqlite (база server_data.db)")
+    parser.add_argument('--checkpoint-interval', type=int, default=300,
+                        help="Период фоновой контрольной точки в секундах")
+    parser.add_argument('--outbox-size', type=int, default=OUTBOX_SIZE,
+                        help="Размер очереди отправки одного клиента в кадрах")
+    parser.add_argument('--slow-client', choices=SLOW_CLIENT_POLICIES, default='disconnect',
+                        help="Что делать при переполнении очереди клиента: drop, disconnect, "
+                             "spill (закрыть и дослать неотправленное при следующем входе)")
+    parser.add_argument('--history-cache-mb', type=int, default=HISTORY_CACHE_SIZE // (1024 * 1024),
+                        help="Объем историй чатов в памяти для хранилища json, МБ")
+    parser.add_argument('--compress-threshold', type=int, default=COMPRESSION_THRESHOLD,
+                        help="Сжимать кадры от этого размера в байтах для клиентов, поддерживающих сжатие")
+    parser.add_argument('--no-compression', action='store_true', help="Не сжимать кадры")
+    parser.add_argument('--codecs', nargs='+', choices=CODEC_NAMES, default=CODEC_NAMES,
+                        help="Кодеки сообщений, которые клиент может выбрать при входе (JSON доступен всегда)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Число процессов сервера на одном порту (SO_REUSEPORT, нужно --storage sqlite)")
+    parser.add_argument('--node', help="Имя узла: сервер подключается к внешней шине --bus (нужно --storage sqlite)")
+    parser.add_argument('--bus', help="Шина между процессами или узлами: путь Unix-сокета или host:port "
+                                      "(по умолчанию для --workers - server_bus_<порт>.sock)")
+    args = parser.parse_args()
+
+    options = dict(host=args.host, port=args.port, mode=args.mode, backlog=args.backlog,
+                   fsync_policy=args.fsync, checkpoint_interval=args.checkpoint_interval,
+                   outbox_size=args.outbox_size, slow_client_policy=args.slow_client,
+                   storage=args.storage, history_cache_size=args.history_cache_mb * 1024 * 1024,
+                   compression_threshold=None if args.no_compression else args.compress_threshold,
+                   codecs=args.codecs)
+    if args.workers > 1:
+        from workers import run_workers
+        run_workers(args.workers, args.bus or f"server_bus_{args.port}.sock", options)
+        sys.exit(0)
+    if args.node:
+        from workers import run_node
+        run_node(args.node, args.bus, options)
+        sys.exit(0)
+
+    server = MessengerServer(**options)
     try:
         server.start()
     except KeyboardInterrupt:
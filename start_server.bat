@@ -29,8 +29,8 @@ echo.
 echo Доступные команды в консоли сервера:
 echo   - stop     : Остановить сервер
 echo   - status   : Показать статус
-echo   - save     : Сохранить данные вручную
-echo   - repair_data : Восстановить данные
+echo   - save     : Контрольная точка (снимок данных в фоне)
+echo   - repair_data : Проверить снимок и журнал, при повреждении пересоздать
 echo.
 echo Для остановки сервера используйте команду 'stop' в консоли
 echo или закройте это окно.
@@ -0,0 +1,1483 @@
+import collections
+import contextlib
+import json
+import mmap
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows: несколько процессов сервера там не запускаются
+    fcntl = None
+
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+class WalCorruptedError(Exception):
+    """Поврежденная запись в середине журнала"""
+
+    def __init__(self, path, line_number):
+        super().__init__(f"Поврежденная запись в {path}, строка {line_number}")
+        self.path = path
+        self.line_number = line_number
+
+
+def read_wal_file(path, after_lsn=0):
+    """Чтение записей одного файла журнала с номером больше after_lsn.
+
+    Недописанная последняя строка (сбой во время записи) пропускается.
+    Размер целой части файла возвращается как значение генератора.
+    """
+    valid_size = 0
+    torn_line = None
+    with open(path, 'rb') as f:
+        for line_number, raw in enumerate(f, 1):
+            if not raw.strip():
+                if torn_line is None:
+                    valid_size += len(raw)
+                continue
+            if torn_line is not None:
+                # За поврежденной строкой есть еще записи - это не обрыв хвоста
+                raise WalCorruptedError(path, torn_line)
+            try:
+                record = json.loads(raw)
+            except ValueError:
+                torn_line = line_number
+                continue
+            if not raw.endswith(b'\n'):
+                torn_line = line_number
+                continue
+
+            valid_size += len(raw)
+            if record.get('lsn', 0) > after_lsn:
+                yield record
+
+    return valid_size
+
+
+def write_snapshot(path, data):
+    """Атомарная запись снимка: временный файл, fsync и замена старого"""
+    temp_filename = f"{path}.tmp"
+    try:
+        with open(temp_filename, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'), default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, path)
+    except Exception:
+        # Пытаемся удалить временный файл в случае ошибки
+        try:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+        except OSError:
+            pass
+        raise
+
+
+class WriteAheadLog:
+    """Журнал изменений сервера.
+
+    Каждое изменение состояния дописывается в конец файла одной строкой JSON
+    с возрастающим номером записи (lsn), поэтому стоимость записи не зависит
+    от объема накопленной истории. Политика fsync:
+      always   - fsync после каждой записи;
+      interval - fsync не чаще, чем раз в fsync_interval секунд;
+      never    - только flush, сброс на диск остается за ОС.
+
+    Перед контрольной точкой активный файл закрывается и переименовывается
+    в сегмент "<path>.<lsn последней записи>"; после записи снимка сегменты,
+    вошедшие в него, удаляются.
+    """
+
+    def __init__(self, path='server_data.wal', fsync='interval', fsync_interval=1.0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Неизвестная политика fsync: {fsync}")
+        self.path = path
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.lsn = 0  # номер последней записи
+        self.size = 0  # объем активного файла в байтах
+        self.valid_size = None  # размер целой части активного файла после replay
+        self.quarantined = []  # (ошибка, новый путь) поврежденных файлов, убранных в сторону при replay
+        self.file = None
+        self.last_fsync = time.monotonic()
+        self.lock = threading.Lock()
+
+    def segments(self):
+        """Закрытые сегменты журнала в порядке записи: список (lsn, путь)"""
+        directory = os.path.dirname(self.path) or '.'
+        prefix = os.path.basename(self.path) + '.'
+        result = []
+        for name in os.listdir(directory):
+            suffix = name[len(prefix):]
+            if name.startswith(prefix) and suffix.isdigit():
+                result.append((int(suffix), os.path.join(directory, name)))
+        return sorted(result)
+
+    def replay(self, after_lsn=0):
+        """Чтение записей всех сегментов и активного файла с номером больше after_lsn.
+
+        Файл, поврежденный в середине, отдает записи до повреждения и
+        переименовывается (см. quarantine), чтобы не мешать следующим запускам;
+        чтение продолжается со следующего файла.
+        """
+        self.lsn = max(self.lsn, after_lsn)
+        self.valid_size = None
+
+        paths = [path for _, path in self.segments()]
+        if os.path.exists(self.path):
+            paths.append(self.path)
+
+        for path in paths:
+            try:
+                valid_size = yield from self._replay_file(path, after_lsn)
+            except WalCorruptedError as e:
+                self.quarantined.append((e, self.quarantine(path)))
+                continue
+            if path == self.path:
+                self.valid_size = valid_size
+
+    def quarantine(self, path):
+        """Перенос поврежденного файла журнала под именем, которое не считается сегментом"""
+        backup_path = f"{path}_backup_{int(time.time())}"
+        os.replace(path, backup_path)
+        return backup_path
+
+    def _replay_file(self, path, after_lsn):
+        reader = read_wal_file(path, after_lsn)
+        while True:
+            try:
+                record = next(reader)
+            except StopIteration as stop:
+                return stop.value
+            self.lsn = max(self.lsn, record['lsn'])
+            yield record
+
+    def verify(self):
+        """Проверка всех файлов журнала. Возвращает список поврежденных файлов"""
+        damaged = []
+        paths = [path for _, path in self.segments()] + [self.path]
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            try:
+                for _ in read_wal_file(path):
+                    pass
+            except (WalCorruptedError, OSError):
+                damaged.append(path)
+        return damaged
+
+    def open(self):
+        """Открытие журнала на дозапись"""
+        if self.valid_size is not None and os.path.exists(self.path):
+            if os.path.getsize(self.path) > self.valid_size:
+                # Отрезаем недописанный хвост, чтобы новые записи не склеились с ним
+                with open(self.path, 'rb+') as f:
+                    f.truncate(self.valid_size)
+        self.file = open(self.path, 'ab')
+        self.size = self.file.tell()
+
+    def append(self, record):
+        """Добавление записи в конец журнала. Возвращает присвоенный номер"""
+        with self.lock:
+            self.lsn += 1
+            record['lsn'] = self.lsn
+            line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+            self.file.write(line)
+            self.file.flush()
+            self.size += len(line)
+
+            if self.fsync == 'always':
+                os.fsync(self.file.fileno())
+            elif self.fsync == 'interval':
+                now = time.monotonic()
+                if now - self.last_fsync >= self.fsync_interval:
+                    os.fsync(self.file.fileno())
+                    self.last_fsync = now
+            return self.lsn
+
+    def rotate(self):
+        """Закрытие активного файла в сегмент и начало нового. Возвращает lsn границы"""
+        with self.lock:
+            if self.file is not None and (self.size or os.path.getsize(self.path)):
+                self.file.flush()
+                if self.fsync != 'never':
+                    os.fsync(self.file.fileno())
+                self.file.close()
+                os.replace(self.path, f"{self.path}.{self.lsn}")
+                self.file = open(self.path, 'ab')
+                self.size = 0
+            return self.lsn
+
+    def remove_segments(self, upto_lsn):
+        """Удаление сегментов, полностью вошедших в снимок"""
+        for lsn, path in self.segments():
+            if lsn <= upto_lsn:
+                os.remove(path)
+
+    def has_changes(self):
+        """Есть ли записи, еще не вошедшие в снимок"""
+        return bool(self.size or self.segments())
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.flush()
+            if self.fsync != 'never':
+                os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+
+STORAGE_BACKENDS = ('json', 'sqlite')
+LOCK_STRIPES = 64  # число блокировок, между которыми распределяются чаты
+HISTORY_CACHE_SIZE = 256 * 1024 * 1024  # объем загруженных в память историй по умолчанию
+HISTORY_MAX_EXTENTS = 32  # кусков истории одного чата в файле, после которых они склеиваются в один
+HISTORY_COMPACT_MIN_SIZE = 1024 * 1024  # файл истории меньше этого размера не уплотняется
+
+
+def page_bounds(total, limit=None, before=None, after=None):
+    """Границы страницы истории из total сообщений.
+
+    seq сообщения - его номер в чате начиная с 1. before - сообщения старше
+    указанного seq, after - новее; без курсоров - последние limit сообщений.
+    Без limit возвращается вся подходящая часть истории. Результат:
+    (start, end, next_before, next_after), где [start, end) - срез списка.
+    """
+    if after is not None:
+        start = max(0, min(int(after), total))
+        end = total if limit is None else min(total, start + limit)
+    else:
+        end = total if before is None else max(0, min(int(before) - 1, total))
+        start = 0 if limit is None else max(0, end - limit)
+
+    next_before = start + 1 if start > 0 else None
+    next_after = end if end < total else None
+    return start, end, next_before, next_after
+
+
+def private_chat_name(chat_id):
+    """Строковый ключ личного чата, как он хранится в снимке"""
+    return json.dumps(list(chat_id), ensure_ascii=False)
+
+
+MESSAGE_FIELDS = ('from', 'local_ip', 'server_ip', 'text', 'timestamp')  # поля сообщения в протоколе
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+class StoredMessage:
+    """Сообщение в памяти сервера.
+
+    Вместо словаря - поля в __slots__, имя отправителя и IP-адреса - общие
+    для всех сообщений строки (sys.intern), время - целое число микросекунд
+    от 1970-01-01 (по тем же часам, что и исходная строка ISO). В словарь
+    протокола сообщение превращается только при выдаче из хранилища.
+    """
+
+    __slots__ = ('sender', 'local_ip', 'server_ip', 'text', 'timestamp')
+
+    def __init__(self, sender, local_ip, server_ip, text, timestamp):
+        self.sender = sender
+        self.local_ip = local_ip
+        self.server_ip = server_ip
+        self.text = text
+        self.timestamp = timestamp
+
+    def to_dict(self):
+        return {
+            'from': self.sender,
+            'local_ip': self.local_ip,
+            'server_ip': self.server_ip,
+            'text': self.text,
+            'timestamp': (EPOCH + self.timestamp * MICROSECOND).isoformat()
+        }
+
+
+def pack_timestamp(value):
+    """Строка ISO в микросекунды от 1970-01-01 или None, если обратно она не восстановится один в один"""
+    try:
+        moment = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is not None or moment.isoformat() != value:
+        return None
+    return (moment - EPOCH) // MICROSECOND
+
+
+def pack_message(message):
+    """Компактная запись сообщения; сообщения другого вида остаются словарями"""
+    if tuple(message) != MESSAGE_FIELDS:
+        return message
+    sender, local_ip, server_ip = message['from'], message['local_ip'], message['server_ip']
+    if type(sender) is not str or type(local_ip) is not str or type(server_ip) is not str:
+        return message
+    timestamp = pack_timestamp(message['timestamp'])
+    if timestamp is None:
+        return message
+    return StoredMessage(sys.intern(sender), sys.intern(local_ip), sys.intern(server_ip),
+                         message['text'], timestamp)
+
+
+def unpack_message(message):
+    """Сообщение в виде словаря протокола (всегда новый словарь)"""
+    if message is None:
+        return None
+    if isinstance(message, StoredMessage):
+        return message.to_dict()
+    return dict(message)
+
+
+class ChatHistory:
+    """История одного чата.
+
+    Сообщения, вошедшие в контрольную точку, лежат в файле истории кусками
+    (extents - смещение и длина, по одному JSON в строке) и читаются в память
+    только по требованию. Сообщения после последней контрольной точки
+    (хвост) всегда в памяти, поэтому новое сообщение не требует загрузки истории.
+    """
+
+    def __init__(self, extents=(), stored=0, last_message=None, tail=None):
+        self.extents = [tuple(extent) for extent in extents]
+        self.stored = stored  # сообщений в файле истории
+        self.loaded = None  # сообщения из файла, если загружены
+        self.size = 0  # объем загруженной части в байтах
+        self.tail = tail if tail is not None else []
+        self.last_message = self.tail[-1] if self.tail else last_message
+
+    def __len__(self):
+        return self.stored + len(self.tail)
+
+    def append(self, message):
+        """Добавление сообщения (в компактном виде). Возвращает его порядковый номер в чате"""
+        self.tail.append(message)
+        self.last_message = message
+        return len(self)
+
+
+class HistoryCache:
+    """Загруженные в память истории чатов в порядке последнего обращения (LRU).
+
+    Когда объем загруженного превышает бюджет, дольше всех не читавшиеся
+    истории выгружаются; в памяти у них остаются только хвост и последнее сообщение.
+    """
+
+    def __init__(self, budget=HISTORY_CACHE_SIZE):
+        self.budget = budget
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def touch(self, history):
+        """Обращение к истории без чтения файла"""
+        with self.lock:
+            self.hits += 1
+            if history in self.entries:
+                self.entries.move_to_end(history)
+
+    def add(self, history):
+        """Учет только что загруженной из файла истории"""
+        with self.lock:
+            self.misses += 1
+            self.entries[history] = None
+            self.size += history.size
+            self.evict()
+
+    def grow(self, history, size):
+        """Учет сообщений, перенесенных в уже загруженную историю"""
+        with self.lock:
+            if history in self.entries:
+                history.size += size
+                self.size += size
+                self.evict()
+
+    def discard(self, history):
+        """Удаление истории удаленного чата"""
+        with self.lock:
+            if history in self.entries:
+                del self.entries[history]
+                self.size -= history.size
+
+    def evict(self):
+        # Только что загруженная история не выгружается, даже если одна больше бюджета
+        while self.size > self.budget and len(self.entries) > 1:
+            history, _ = self.entries.popitem(last=False)
+            self.size -= history.size
+            history.loaded = None
+            history.size = 0
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'chats': len(self.entries),
+                'size': self.size,
+                'budget': self.budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+class HistoryFile:
+    """Файл истории, отображенный в память (mmap) только для чтения.
+
+    Кусок истории читается срезом отображения, без открытия файла и
+    системных вызовов на каждое чтение. Когда контрольная точка дописывает
+    в файл новые куски, отображение пересоздается по новому размеру.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.map = None
+        self.lock = threading.Lock()
+
+    def read(self, offset, length):
+        with self.lock:
+            if self.map is None or offset + length > len(self.map):
+                self.remap()
+            return self.map[offset:offset + length]
+
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        # До удаления или переименования файла: в Windows отображенный файл занят
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_history(history_file, extents):
+    """Чтение сообщений из кусков файла истории. Возвращает (сообщения, объем в байтах)"""
+    messages = []
+    size = 0
+    for offset, length in extents:
+        data = history_file.read(offset, length)
+        size += len(data)
+        messages.extend(pack_message(json.loads(line)) for line in data.splitlines())
+    return messages, size
+
+
+class HistoryWriter:
+    """Дозапись кусков истории в конец файла истории"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        self.offset = self.file.tell()
+
+    def write(self, data):
+        extent = (self.offset, len(data))
+        self.file.write(data)
+        self.offset += len(data)
+        return extent
+
+    def append_messages(self, messages):
+        """Запись сообщений новым куском (по одному JSON в строке)"""
+        return self.write(b''.join(
+            (json.dumps(unpack_message(msg), ensure_ascii=False) + '\n').encode('utf-8') for msg in messages))
+
+    def copy_extents(self, source_path, extents):
+        """Склейка кусков истории (из этого или другого файла) в один новый кусок"""
+        self.file.flush()
+        with open(source_path, 'rb') as source:
+            chunks = []
+            for offset, length in extents:
+                source.seek(offset)
+                chunks.append(source.read(length))
+        return self.write(b''.join(chunks))
+
+    def close(self, sync=True):
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+
+class JsonStorage:
+    """Хранение всех данных в памяти: снимок server_data.json и журнал изменений.
+
+    Каждое изменение дописывается в журнал, а снимок пишется на
+    контрольных точках. Снимок содержит только описание чатов и последние
+    сообщения, сама история - в файле server_data.history, откуда
+    она загружается по требованию и выгружается по LRU (HistoryCache). Изменения разных чатов идут параллельно: каждый чат
+    (группа, личный чат, пользователь) защищен одной из LOCK_STRIPES
+    блокировок по хешу своего ключа.
+    """
+
+    def __init__(self, logger, path='server_data.json', wal_path='server_data.wal', fsync='interval',
+                 checkpoint_wal_size=64 * 1024 * 1024, history_cache_size=HISTORY_CACHE_SIZE):
+        self.logger = logger
+        self.path = path
+        self.history_base = os.path.splitext(path)[0] + '.history'
+        self.history_path = None  # текущий файл истории (из снимка)
+        self.history_file = None  # он же, отображенный в память
+        self.cache = HistoryCache(history_cache_size)
+        self.wal = WriteAheadLog(wal_path, fsync=fsync)
+        self.checkpoint_wal_size = checkpoint_wal_size  # объем журнала, после которого точка делается раньше
+        self.private_chats = {}
+        self.group_chats = {}
+        self.user_data = {}
+        # Индекс чатов пользователя: username -> {'private': {собеседник: None}, 'groups': {группа: None}}
+        # (словари вместо множеств сохраняют порядок появления чатов)
+        self.user_chats = {}
+        # Курсоры доставки: username -> {'private': {собеседник: seq}, 'groups': {группа: seq}} -
+        # номер последнего сообщения чата, переданного пользователю
+        self.delivery_cursors = {}
+        self.legacy_cursors = False  # снимок сделан до появления курсоров доставки
+        self.chat_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def load(self):
+        """Загрузка данных и открытие журнала на дозапись"""
+        self.read()
+        self.wal.open()
+        if self.wal.quarantined:
+            # Записи, прочитанные из убранных в сторону файлов, есть только в памяти - сохраняем их снимком
+            self.checkpoint()
+
+    def read(self):
+        """Загрузка снимка данных и применение журнала изменений поверх него"""
+        snapshot_lsn = self.load_snapshot()
+        if self.history_path is not None:
+            self.history_file = HistoryFile(self.history_path)
+        self.rebuild_user_index()
+        self.replay_wal(snapshot_lsn)
+        if self.legacy_cursors:
+            self.init_delivery_cursors()
+
+    def rebuild_user_index(self):
+        """Построение индекса чатов пользователей по загруженному снимку"""
+        self.user_chats = {}
+        for chat_id in self.private_chats:
+            self.index_private_chat(chat_id)
+        for group_name, group_data in self.group_chats.items():
+            for member in group_data['members']:
+                self.index_user_chat(member, 'groups', group_name)
+
+    def index_user_chat(self, username, kind, name):
+        """Добавление чата в индекс пользователя (kind - 'private' или 'groups')"""
+        entry = self.user_chats.get(username)
+        if entry is None:
+            # setdefault атомарен: изменения разных чатов одного пользователя идут параллельно
+            entry = self.user_chats.setdefault(username, {'private': {}, 'groups': {}})
+        entry[kind][name] = None
+
+    def unindex_user_chat(self, username, kind, name):
+        """Удаление чата из индекса пользователя"""
+        entry = self.user_chats.get(username)
+        if entry is not None:
+            entry[kind].pop(name, None)
+
+    def index_private_chat(self, chat_id):
+        """Индексация личного чата у обоих собеседников"""
+        first, second = chat_id
+        self.index_user_chat(first, 'private', second)
+        self.index_user_chat(second, 'private', first)
+
+    def load_snapshot(self):
+        """Загрузка сохраненных данных с улучшенной обработкой ошибок"""
+        snapshot_lsn = 0
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    content = f.read().strip()
+
+                    # Проверяем, не пустой ли файл
+                    if not content:
+                        self.logger.warning("Файл данных пуст, используются значения по умолчанию")
+                        self.private_chats = {}
+                        self.group_chats = {}
+                        self.user_data = {}
+                        return 0
+
+                    data = json.loads(content)
+                    self.private_chats = data.get('private_chats', {})
+                    self.group_chats = data.get('group_chats', {})
+                    self.user_data = data.get('user_data', {})
+                    self.delivery_cursors = data.get('delivery_cursors', {})
+                    self.legacy_cursors = 'delivery_cursors' not in data
+                    self.history_path = data.get('history_file')
+                    snapshot_lsn = data.get('wal_lsn', 0)
+
+                self.logger.info("Данные успешно загружены")
+
+                # Конвертируем ключи private_chats обратно в tuple
+                private_chats_converted = {}
+                if isinstance(self.private_chats, list):
+                    # Формат 3: список чатов с парой имен в каждом, ключи разбирать не нужно
+                    for entry in self.private_chats:
+                        private_chats_converted[tuple(entry['chat'])] = self.make_history(entry)
+                    self.private_chats = {}
+                for key, value in self.private_chats.items():
+                    if isinstance(key, list):
+                        # Конвертируем list обратно в tuple
+                        private_chats_converted[tuple(key)] = self.make_history(value)
+                    elif isinstance(key, str):
+                        # Обрабатываем строковые ключи (для обратной совместимости)
+                        try:
+                            key_data = json.loads(key.replace("'", '"'))
+                            private_chats_converted[tuple(key_data)] = self.make_history(value)
+                        except:
+                            # Если не получается распарсить, пропускаем этот чат
+                            self.logger.warning(f"Не удалось восстановить ключ личного чата: {key}")
+                            continue
+                    else:
+                        private_chats_converted[key] = self.make_history(value)
+
+                self.private_chats = private_chats_converted
+
+                # Участники групп хранятся в памяти как упорядоченное множество
+                # (словарь с ключами-именами): проверка членства за O(1), порядок вступления сохраняется
+                for group_data in self.group_chats.values():
+                    group_data['members'] = dict.fromkeys(group_data['members'])
+                    group_data['messages'] = self.make_history(group_data['messages'])
+                self.logger.info(f"Загружено {len(self.private_chats)} личных чатов и {len(self.group_chats)} групп")
+                return snapshot_lsn
+
+        except json.JSONDecodeError as e:
+            self.logger.error(f"Ошибка декодирования JSON: {e}")
+            self.logger.info("Создаются новые данные по умолчанию")
+            # Создаем резервную копию поврежденного файла
+            if os.path.exists(self.path):
+                name, ext = os.path.splitext(self.path)
+                backup_name = f"{name}_backup_{int(datetime.now().timestamp())}{ext}"
+                os.rename(self.path, backup_name)
+                self.logger.info(f"Создана резервная копия поврежденного файла: {backup_name}")
+
+            self.private_chats = {}
+            self.group_chats = {}
+            self.user_data = {}
+
+        except Exception as e:
+            self.logger.error(f"Неожиданная ошибка загрузки данных: {e}")
+            self.private_chats = {}
+            self.group_chats = {}
+            self.user_data = {}
+
+        return 0
+
+    def make_history(self, value):
+        """История чата из снимка: описание кусков файла истории или (старый формат) список сообщений"""
+        if isinstance(value, list):
+            return ChatHistory(tail=[pack_message(msg) for msg in value])
+        last_message = value.get('last_message')
+        if last_message is not None:
+            last_message = pack_message(last_message)
+        return ChatHistory(value['extents'], value['count'], last_message)
+
+    def replay_wal(self, snapshot_lsn):
+        """Применение записей журнала, сделанных после снимка"""
+        replayed = 0
+        try:
+            for record in self.wal.replay(after_lsn=snapshot_lsn):
+                self.apply_record(record)
+                replayed += 1
+        except Exception as e:
+            self.logger.error(f"Ошибка применения журнала изменений: {e}")
+
+        for error, backup_path in self.wal.quarantined:
+            # Записи после поврежденной строки этого файла потеряны, остальные файлы применены
+            self.logger.error(f"Журнал изменений поврежден: {error}. Записи после строки "
+                              f"{error.line_number} не применены, файл перенесен в {backup_path}")
+
+        if replayed:
+            self.logger.info(f"Из журнала изменений применено {replayed} записей")
+
+    def record_stripes(self, record):
+        """Номера блокировок чатов, которые затрагивает запись"""
+        op = record['op']
+        if op in ('register', 'delivery_cursors'):
+            return [hash(('user', record['username'])) % LOCK_STRIPES]
+        elif op == 'private_message':
+            return [self.chat_stripe('private', record['chat'])]
+        elif op == 'rename_group':
+            return sorted({self.chat_stripe('group', record['group']), self.chat_stripe('group', record['new_name'])})
+        return [self.chat_stripe('group', record['group'])]
+
+    def chat_stripe(self, kind, chat):
+        """Номер блокировки чата"""
+        key = ('private', tuple(chat)) if kind == 'private' else ('group', chat)
+        return hash(key) % LOCK_STRIPES
+
+    @contextlib.contextmanager
+    def locked(self, stripes):
+        """Захват блокировок чатов строго по возрастанию номеров, чтобы не было взаимных блокировок"""
+        for stripe in stripes:
+            self.chat_locks[stripe].acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self.chat_locks[stripe].release()
+
+    def commit(self, record):
+        """Применение изменения к данным и запись его в журнал.
+
+        Для сообщений возвращает их порядковый номер (seq) в чате, для удаления
+        группы - ее данные, для остальных изменений - True. Если изменение
+        неприменимо (группа уже существует, удалена и т.п.), возвращает None
+        и в журнал ничего не пишется.
+        """
+        # Под блокировкой чата, чтобы порядок в журнале совпадал с порядком применения
+        with self.locked(self.record_stripes(record)):
+            result = self.apply_record(record)
+            if result is None:
+                return None
+            self.wal.append(record)
+        return result
+
+    def apply_record(self, record):
+        """Применение одной записи журнала к данным в памяти.
+
+        Возвращает None, если запись не изменила данные.
+        """
+        op = record['op']
+
+        if op == 'register':
+            self.user_data[record['username']] = record['user']
+            return True
+
+        elif op == 'delivery_cursors':
+            cursors = self.delivery_cursors.get(record['username'])
+            if cursors is None:
+                cursors = self.delivery_cursors.setdefault(record['username'], {'private': {}, 'groups': {}})
+            # Курсор только растет: сохранения с разных соединений пользователя могут прийти не по порядку
+            for kind in ('private', 'groups'):
+                for name, seq in record[kind].items():
+                    if seq > cursors[kind].get(name, 0):
+                        cursors[kind][name] = seq
+            return True
+
+        elif op == 'private_message':
+            chat_id = tuple(record['chat'])
+            messages = self.private_chats.get(chat_id)
+            if messages is None:
+                messages = self.private_chats[chat_id] = ChatHistory()
+                self.index_private_chat(chat_id)
+            return messages.append(pack_message(record['message']))
+
+        elif op == 'group_message':
+            if record['group'] in self.group_chats:
+                return self.group_chats[record['group']]['messages'].append(pack_message(record['message']))
+
+        elif op == 'create_group':
+            if record['group'] not in self.group_chats:
+                self.group_chats[record['group']] = {
+                    'creator': record['creator'],
+                    'members': {record['creator']: None},
+                    'messages': ChatHistory()
+                }
+                self.index_user_chat(record['creator'], 'groups', record['group'])
+                return True
+
+        elif op == 'join_group':
+            group = self.group_chats.get(record['group'])
+            if group is not None and record['username'] not in group['members']:
+                group['members'][record['username']] = None
+                self.index_user_chat(record['username'], 'groups', record['group'])
+                return True
+
+        elif op == 'leave_group':
+            group = self.group_chats.get(record['group'])
+            if group is not None and record['username'] in group['members']:
+                del group['members'][record['username']]
+                self.unindex_user_chat(record['username'], 'groups', record['group'])
+                self.move_group_cursor(record['username'], record['group'], None)
+                return True
+
+        elif op == 'rename_group':
+            if record['group'] in self.group_chats and record['new_name'] not in self.group_chats:
+                group = self.group_chats[record['new_name']] = self.group_chats.pop(record['group'])
+                for member in group['members']:
+                    self.unindex_user_chat(member, 'groups', record['group'])
+                    self.index_user_chat(member, 'groups', record['new_name'])
+                    self.move_group_cursor(member, record['group'], record['new_name'])
+                return True
+
+        elif op == 'delete_group':
+            group = self.group_chats.pop(record['group'], None)
+            if group is not None:
+                for member in group['members']:
+                    self.unindex_user_chat(member, 'groups', record['group'])
+                    self.move_group_cursor(member, record['group'], None)
+                self.cache.discard(group['messages'])
+                return group
+
+        else:
+            self.logger.warning(f"Неизвестная запись журнала: {op}")
+
+    def init_delivery_cursors(self):
+        """Курсоры для данных без них: считаем, что все сообщения уже доставлены.
+
+        Иначе при первом входе после обновления сервер дослал бы каждому
+        пользователю историю всех чатов как пропущенную.
+        """
+        for username, entry in self.user_chats.items():
+            if username in self.delivery_cursors:
+                continue
+            self.delivery_cursors[username] = {
+                'private': {peer: len(self.private_chats[tuple(sorted([username, peer]))]) for peer in entry['private']},
+                'groups': {name: len(self.group_chats[name]['messages']) for name in entry['groups']}
+            }
+        self.legacy_cursors = False
+
+    def move_group_cursor(self, username, group_name, new_name):
+        """Перенос курсора доставки группы на новое имя (None - удаление курсора)"""
+        cursors = self.delivery_cursors.get(username)
+        if cursors is None:
+            return
+        seq = cursors['groups'].pop(group_name, None)
+        if seq is not None and new_name is not None:
+            cursors['groups'][new_name] = seq
+
+    def needs_checkpoint(self):
+        """Журнал вырос настолько, что контрольную точку стоит сделать раньше срока"""
+        return self.wal.size >= self.checkpoint_wal_size
+
+    def has_changes(self):
+        """Есть ли изменения, еще не вошедшие в снимок"""
+        return self.wal.has_changes()
+
+    def capture_state(self):
+        """Согласованный срез данных для снимка (вызывается под блокировками всех чатов).
+
+        Сообщения только дописываются в хвост истории, поэтому вместо копии
+        запоминается длина хвоста каждого чата; в файл истории хвосты пишет
+        write_histories уже после снятия блокировок. Возвращает (снимок, чаты),
+        где чаты - [история, длина хвоста, куски в файле, описание в снимке].
+        """
+        chats = []
+        # Пара имен - внутри описания чата: при загрузке не нужно разбирать строковые ключи
+        private_chats = [self.describe_history(history, chats, {'chat': list(key)})
+                         for key, history in self.private_chats.items()]
+
+        group_chats = {}
+        for group_name, group_data in self.group_chats.items():
+            group_chats[group_name] = {
+                'creator': group_data['creator'],
+                'members': list(group_data['members']),
+                'messages': self.describe_history(group_data['messages'], chats)
+            }
+
+        return {
+            'format': 3,
+            'private_chats': private_chats,
+            'group_chats': group_chats,
+            'user_data': dict(self.user_data),
+            'delivery_cursors': {username: {'private': dict(cursors['private']), 'groups': dict(cursors['groups'])}
+                                 for username, cursors in self.delivery_cursors.items()}
+        }, chats
+
+    def describe_history(self, history, chats, entry=None):
+        entry = entry if entry is not None else {}
+        entry.update(count=len(history), extents=None, last_message=unpack_message(history.last_message))
+        chats.append([history, len(history.tail), list(history.extents), entry])
+        return entry
+
+    def write_histories(self, chats, lsn):
+        """Дозапись хвостов историй в файл истории. Возвращает имя файла для снимка.
+
+        Если в файле больше половины занимают куски удаленных чатов и старые
+        копии, живые куски переписываются в новый файл.
+        """
+        path = self.history_path or self.history_base
+        sync = self.wal.fsync != 'never'
+        writer = HistoryWriter(path)
+        try:
+            for chat in chats:
+                history, tail_length, extents, entry = chat
+                written = 0
+                if tail_length:
+                    extent = writer.append_messages(history.tail[:tail_length])
+                    extents.append(extent)
+                    written = extent[1]
+                if len(extents) > HISTORY_MAX_EXTENTS:
+                    extents = [writer.copy_extents(path, extents)]
+                entry['extents'] = extents
+                chat.append(written)
+        finally:
+            writer.close(sync)
+
+        live = sum(length for chat in chats for _, length in chat[3]['extents'])
+        compact_path = f"{self.history_base}.{lsn}"
+        if writer.offset > HISTORY_COMPACT_MIN_SIZE and writer.offset > 2 * live and compact_path != path:
+            writer = HistoryWriter(compact_path)
+            try:
+                for _, _, _, entry, _ in chats:
+                    if entry['extents']:
+                        entry['extents'] = [writer.copy_extents(path, entry['extents'])]
+            finally:
+                writer.close(sync)
+            self.logger.info(f"Файл истории уплотнен: {path} -> {compact_path}")
+            path = compact_path
+        return path
+
+    def promote(self, history, tail_length, extents, written):
+        """Перенос записанной в файл части хвоста в сохраненную историю (под блокировкой чата)"""
+        part = history.tail[:tail_length]
+        del history.tail[:tail_length]
+        history.extents = [tuple(extent) for extent in extents]
+        history.stored += tail_length
+        loaded = history.loaded
+        if loaded is not None:
+            loaded.extend(part)
+            self.cache.grow(history, written)
+
+    def checkpoint(self):
+        """Контрольная точка: запись новых сообщений и снимка, удаление вошедшей в него части журнала"""
+        # Срез данных и граница журнала фиксируются вместе под всеми блокировками
+        # (это только длины хвостов), а запись истории и снимка на диск идет
+        # уже без блокировок - сообщения продолжают обрабатываться
+        with self.locked(range(LOCK_STRIPES)):
+            data, chats = self.capture_state()
+            data['wal_lsn'] = self.wal.rotate()
+
+        data['history_file'] = self.write_histories(chats, data['wal_lsn'])
+        write_snapshot(self.path, data)
+
+        # Записанные хвосты становятся частью истории в файле и могут выгружаться
+        with self.locked(range(LOCK_STRIPES)):
+            for history, tail_length, _, entry, written in chats:
+                self.promote(history, tail_length, entry['extents'], written)
+            old_path, self.history_path = self.history_path, data['history_file']
+            old_file = self.history_file
+            if old_path != self.history_path:
+                self.history_file = HistoryFile(self.history_path)
+
+        self.wal.remove_segments(data['wal_lsn'])
+        if old_file is not None and old_file is not self.history_file:
+            old_file.close()
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+        self.logger.info(
+            f"Данные успешно сохранены: {len(data['private_chats'])} личных чатов, "
+            f"{len(data['group_chats'])} групп (lsn {data['wal_lsn']})")
+
+    def verify(self):
+        """Проверка снимка и журнала на диске. Возвращает список поврежденных файлов"""
+        damaged = self.wal.verify()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    json.load(f)
+            except ValueError:
+                damaged.insert(0, self.path)
+        # Файл истории должен вмещать все куски, на которые ссылается снимок
+        if self.history_path is not None and os.path.exists(self.history_path):
+            histories = list(self.private_chats.values()) + [group['messages'] for group in self.group_chats.values()]
+            needed = max((offset + length for history in histories for offset, length in history.extents), default=0)
+            if os.path.getsize(self.history_path) < needed:
+                damaged.append(self.history_path)
+        return damaged
+
+    def close(self):
+        self.wal.close()
+        if self.history_file is not None:
+            self.history_file.close()
+
+    def get_user(self, username):
+        """Данные пользователя (IP-адреса, время входа) или None"""
+        return self.user_data.get(username)
+
+    def group_info(self, group_name):
+        """Описание группы без истории и участников или None"""
+        group = self.group_chats.get(group_name)
+        if group is None:
+            return None
+        return {'creator': group['creator']}
+
+    def is_member(self, group_name, username):
+        group = self.group_chats.get(group_name)
+        return group is not None and username in group['members']
+
+    def group_members(self, group_name):
+        """Участники группы в порядке вступления"""
+        group = self.group_chats.get(group_name)
+        return list(group['members']) if group is not None else []
+
+    def user_chat_list(self, username):
+        """Чаты пользователя: (собеседники в личных чатах, группы)"""
+        entry = self.user_chats.get(username)
+        if entry is None:
+            return [], []
+        groups = [name for name in list(entry['groups']) if name in self.group_chats]
+        return list(entry['private']), groups
+
+    def chat_history(self, kind, chat):
+        """История чата (kind - 'private' с парой имен или 'group' с именем группы) или None"""
+        if kind == 'private':
+            return self.private_chats.get(tuple(chat))
+        group = self.group_chats.get(chat)
+        return group['messages'] if group is not None else None
+
+    def last_message(self, kind, chat):
+        history = self.chat_history(kind, chat)
+        return unpack_message(history.last_message) if history is not None else None
+
+    def history_slice(self, history, start, end):
+        """Сообщения истории с номерами [start, end); сохраненная часть при необходимости читается из файла"""
+        stored = history.stored
+        if start >= stored:
+            self.cache.touch(history)
+            return history.tail[start - stored:end - stored]
+
+        # Ссылка берется один раз: параллельная выгрузка обнуляет только history.loaded
+        loaded = history.loaded
+        if loaded is None:
+            loaded, size = read_history(self.history_file, history.extents)
+            history.loaded, history.size = loaded, size
+            self.cache.add(history)
+        else:
+            self.cache.touch(history)
+
+        messages = loaded[start:min(end, stored)]
+        if end > stored:
+            messages += history.tail[:end - stored]
+        return messages
+
+    def history_page(self, kind, chat, limit=None, before=None, after=None):
+        """Страница истории чата: (сообщения с seq, next_before, next_after)"""
+        # Под блокировкой чата: контрольная точка не переносит хвост, пока читается страница
+        with self.locked([self.chat_stripe(kind, chat)]):
+            history = self.chat_history(kind, chat)
+            if history is None:
+                return [], None, None
+            start, end, next_before, next_after = page_bounds(len(history), limit, before, after)
+            messages = self.history_slice(history, start, end)
+        page = []
+        for seq, msg in enumerate(messages, start + 1):
+            msg = unpack_message(msg)
+            msg['seq'] = seq
+            page.append(msg)
+        return page, next_before, next_after
+
+    def delivery_state(self, username):
+        """Чаты пользователя с позицией доставки: [(вид, чат, seq последнего сообщения, курсор)].
+
+        Чат личного чата - пара имен, группы - имя. У чата, сообщения которого
+        пользователю еще не передавались, курсор 0.
+        """
+        entry = self.user_chats.get(username)
+        if entry is None:
+            return []
+        cursors = self.delivery_cursors.get(username, {'private': {}, 'groups': {}})
+        state = []
+        for peer in list(entry['private']):
+            chat = tuple(sorted([username, peer]))
+            history = self.private_chats.get(chat)
+            if history is not None:
+                state.append(('private', chat, len(history), cursors['private'].get(peer, 0)))
+        for group_name in list(entry['groups']):
+            group = self.group_chats.get(group_name)
+            if group is not None:
+                state.append(('group', group_name, len(group['messages']), cursors['groups'].get(group_name, 0)))
+        return state
+
+    def stats(self):
+        """Сводка для команды status"""
+        return {
+            'private_chats': len(self.private_chats),
+            'groups': list(self.group_chats),
+            'users': list(self.user_data),
+            'cache': self.cache.stats()
+        }
+
+
+class SqliteStorage:
+    """Хранение данных в SQLite: в памяти сервера нет ни истории, ни списков участников.
+
+    История лежит в таблице messages с первичным ключом (chat_id, seq),
+    участие пользователей в чатах - в chat_members с уникальным ключом
+    (username, chat_id), поэтому страницы истории, последние сообщения и
+    проверки членства выполняются по индексам. Каждое изменение - одна
+    транзакция; записи сериализуются блокировкой, чтение идет параллельно
+    через пул соединений (режим журнала WAL).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            name TEXT NOT NULL,
+            creator TEXT,
+            last_seq INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (kind, name)
+        );
+        CREATE TABLE IF NOT EXISTS chat_members (
+            username TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            delivered_seq INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (username, chat_id)
+        );
+        CREATE INDEX IF NOT EXISTS chat_members_by_chat ON chat_members (chat_id);
+        CREATE TABLE IF NOT EXISTS messages (
+            chat_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (chat_id, seq)
+        ) WITHOUT ROWID;
+    """
+
+    # Политика fsync журнала соответствует режиму synchronous SQLite
+    SYNCHRONOUS = {'always': 'FULL', 'interval': 'NORMAL', 'never': 'OFF'}
+
+    def __init__(self, logger, path='server_data.db', fsync='interval',
+                 json_path='server_data.json', wal_path='server_data.wal', shared=False):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Неизвестная политика fsync: {fsync}")
+        self.logger = logger
+        self.path = path
+        self.synchronous = self.SYNCHRONOUS[fsync]
+        self.json_path = json_path  # старые файлы для однократной миграции
+        self.wal_path = wal_path
+        self.pool = queue.LifoQueue()  # свободные соединения
+        self.write_lock = threading.Lock()
+        self.changes = 0  # изменений после последней контрольной точки
+        # База общая для нескольких процессов сервера: записи разных процессов встают
+        # в очередь на блокировке файла, а не ждут друг друга паузами внутри SQLite
+        self.lock_file = open(f"{path}.lock", 'a') if shared and fcntl is not None else None
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute(f'PRAGMA synchronous={self.synchronous}')
+        return db
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Соединение из пула на время одной операции"""
+        try:
+            db = self.pool.get_nowait()
+        except queue.Empty:
+            db = self.connect()
+        try:
+            yield db
+        finally:
+            self.pool.put(db)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Транзакция записи; записи выполняются строго по одной"""
+        with self.write_lock, self.connection() as db, self.process_lock():
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    @contextlib.contextmanager
+    def process_lock(self):
+        """Блокировка записи между процессами (только для общей базы)"""
+        if self.lock_file is None:
+            yield
+            return
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def load(self):
+        """Создание схемы и однократный перенос данных из server_data.json"""
+        with self.connection() as db:
+            db.executescript(self.SCHEMA)
+            # Курсор доставки (seq последнего переданного пользователю сообщения) - в строке участия
+            # в чате. В базе без курсоров считаем, что все уже доставлено (как JsonStorage.init_delivery_cursors)
+            columns = [row[1] for row in db.execute('PRAGMA table_info(chat_members)')]
+            if 'delivered_seq' not in columns:
+                db.execute('BEGIN IMMEDIATE')
+                db.execute('ALTER TABLE chat_members ADD COLUMN delivered_seq INTEGER NOT NULL DEFAULT 0')
+                db.execute('UPDATE chat_members SET delivered_seq = '
+                           '(SELECT last_seq FROM chats WHERE chats.chat_id = chat_members.chat_id)')
+                db.execute('COMMIT')
+            migrated = db.execute("SELECT value FROM meta WHERE key = 'migrated_from'").fetchone()
+
+        legacy_files = [path for path in (self.json_path, self.wal_path) if os.path.exists(path)]
+        if migrated is None and legacy_files:
+            self.migrate_json()
+
+        stats = self.stats()
+        self.logger.info(f"База {self.path}: {stats['private_chats']} личных чатов и {len(stats['groups'])} групп")
+
+    def migrate_json(self):
+        """Перенос снимка и журнала изменений JSON-хранилища в базу одной транзакцией"""
+        source = JsonStorage(self.logger, self.json_path, self.wal_path, fsync='never')
+        source.read()
+
+        with self.transaction() as db:
+            db.executemany('INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)',
+                           [(username, json.dumps(user, ensure_ascii=False))
+                            for username, user in source.user_data.items()])
+
+            for chat_id, history in source.private_chats.items():
+                messages = [unpack_message(msg) for msg in source.history_slice(history, 0, len(history))]
+                self.insert_chat(db, 'private', private_chat_name(chat_id), None, chat_id, messages)
+            for group_name, group in source.group_chats.items():
+                history = group['messages']
+                messages = [unpack_message(msg) for msg in source.history_slice(history, 0, len(history))]
+                self.insert_chat(db, 'group', group_name, group['creator'], group['members'], messages)
+            for username, cursors in source.delivery_cursors.items():
+                self.apply_record(db, dict(cursors, op='delivery_cursors', username=username))
+
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from', ?)", (self.json_path,))
+
+        # Старые файлы не удаляются, а переименовываются: повторной миграции не будет
+        source.close()
+        legacy_files = [self.json_path, self.wal_path, source.history_path]
+        for path in legacy_files + [path for _, path in source.wal.segments()]:
+            if path is not None and os.path.exists(path):
+                os.replace(path, f"{path}.migrated")
+        self.logger.info(
+            f"Данные перенесены из {self.json_path} в {self.path}: {len(source.private_chats)} личных чатов, "
+            f"{len(source.group_chats)} групп, {len(source.user_data)} пользователей")
+
+    def insert_chat(self, db, kind, name, creator, members, messages):
+        cursor = db.execute('INSERT INTO chats (kind, name, creator, last_seq) VALUES (?, ?, ?, ?)',
+                            (kind, name, creator, len(messages)))
+        chat_id = cursor.lastrowid
+        db.executemany('INSERT OR IGNORE INTO chat_members (username, chat_id) VALUES (?, ?)',
+                       [(username, chat_id) for username in members])
+        db.executemany('INSERT INTO messages (chat_id, seq, data) VALUES (?, ?, ?)',
+                       [(chat_id, seq, json.dumps(msg, ensure_ascii=False))
+                        for seq, msg in enumerate(messages, 1)])
+        return chat_id
+
+    def find_chat(self, db, kind, name):
+        """(chat_id, creator, last_seq) чата или None"""
+        return db.execute('SELECT chat_id, creator, last_seq FROM chats WHERE kind = ? AND name = ?',
+                          (kind, name)).fetchone()
+
+    def append_message(self, db, chat_id, last_seq, message):
+        seq = last_seq + 1
+        db.execute('INSERT INTO messages (chat_id, seq, data) VALUES (?, ?, ?)',
+                   (chat_id, seq, json.dumps(message, ensure_ascii=False)))
+        db.execute('UPDATE chats SET last_seq = ? WHERE chat_id = ?', (seq, chat_id))
+        return seq
+
+    def commit(self, record):
+        """Применение изменения одной транзакцией. Результат - как у JsonStorage.commit"""
+        with self.transaction() as db:
+            result = self.apply_record(db, record)
+        if result is not None:
+            self.changes += 1
+        return result
+
+    def apply_record(self, db, record):
+        op = record['op']
+
+        if op == 'register':
+            db.execute('INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)',
+                       (record['username'], json.dumps(record['user'], ensure_ascii=False)))
+            return True
+
+        elif op == 'delivery_cursors':
+            username = record['username']
+            chats = [(seq, 'private', private_chat_name(tuple(sorted([username, peer]))))
+                     for peer, seq in record['private'].items()]
+            chats += [(seq, 'group', group_name) for group_name, seq in record['groups'].items()]
+            db.executemany(
+                'UPDATE chat_members SET delivered_seq = MAX(delivered_seq, ?) '
+                'WHERE username = ? AND chat_id = (SELECT chat_id FROM chats WHERE kind = ? AND name = ?)',
+                [(seq, username, kind, name) for seq, kind, name in chats])
+            return True
+
+        elif op == 'private_message':
+            chat_id = tuple(record['chat'])
+            row = self.find_chat(db, 'private', private_chat_name(chat_id))
+            if row is None:
+                row = (self.insert_chat(db, 'private', private_chat_name(chat_id), None, chat_id, []), None, 0)
+            return self.append_message(db, row[0], row[2], record['message'])
+
+        elif op == 'group_message':
+            row = self.find_chat(db, 'group', record['group'])
+            if row is not None:
+                return self.append_message(db, row[0], row[2], record['message'])
+
+        elif op == 'create_group':
+            if self.find_chat(db, 'group', record['group']) is None:
+                self.insert_chat(db, 'group', record['group'], record['creator'], [record['creator']], [])
+                return True
+
+        elif op == 'join_group':
+            row = self.find_chat(db, 'group', record['group'])
+            if row is not None:
+                cursor = db.execute('INSERT OR IGNORE INTO chat_members (username, chat_id) VALUES (?, ?)',
+                                    (record['username'], row[0]))
+                if cursor.rowcount:
+                    return True
+
+        elif op == 'leave_group':
+            row = self.find_chat(db, 'group', record['group'])
+            if row is not None:
+                cursor = db.execute('DELETE FROM chat_members WHERE username = ? AND chat_id = ?',
+                                    (record['username'], row[0]))
+                if cursor.rowcount:
+                    return True
+
+        elif op == 'rename_group':
+            row = self.find_chat(db, 'group', record['group'])
+            if row is not None and self.find_chat(db, 'group', record['new_name']) is None:
+                db.execute('UPDATE chats SET name = ? WHERE chat_id = ?', (record['new_name'], row[0]))
+                return True
+
+        elif op == 'delete_group':
+            row = self.find_chat(db, 'group', record['group'])
+            if row is not None:
+                members = [username for (username,) in db.execute(
+                    'SELECT username FROM chat_members WHERE chat_id = ? ORDER BY rowid', (row[0],))]
+                db.execute('DELETE FROM messages WHERE chat_id = ?', (row[0],))
+                db.execute('DELETE FROM chat_members WHERE chat_id = ?', (row[0],))
+                db.execute('DELETE FROM chats WHERE chat_id = ?', (row[0],))
+                return {'creator': row[1], 'members': members}
+
+        else:
+            self.logger.warning(f"Неизвестная запись журнала: {op}")
+
+    def needs_checkpoint(self):
+        # Журнал WAL самой SQLite переносится в базу автоматически
+        return False
+
+    def has_changes(self):
+        return self.changes > 0
+
+    def checkpoint(self):
+        """Перенос журнала SQLite в основной файл базы"""
+        with self.connection() as db:
+            busy, pages, moved = db.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        self.changes = 0
+        self.logger.info(f"Журнал базы {self.path} перенесен в основной файл ({moved} страниц)")
+
+    def verify(self):
+        """Проверка целостности базы. Возвращает список поврежденных файлов"""
+        with self.connection() as db:
+            result = db.execute('PRAGMA integrity_check').fetchone()[0]
+        return [] if result == 'ok' else [self.path]
+
+    def close(self):
+        while True:
+            try:
+                db = self.pool.get_nowait()
+            except queue.Empty:
+                return
+            db.close()
+
+    def get_user(self, username):
+        with self.connection() as db:
+            row = db.execute('SELECT data FROM users WHERE username = ?', (username,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def group_info(self, group_name):
+        with self.connection() as db:
+            row = self.find_chat(db, 'group', group_name)
+        return {'creator': row[1]} if row else None
+
+    def is_member(self, group_name, username):
+        with self.connection() as db:
+            row = db.execute(
+                'SELECT 1 FROM chats c JOIN chat_members m ON m.chat_id = c.chat_id '
+                "WHERE c.kind = 'group' AND c.name = ? AND m.username = ?", (group_name, username)).fetchone()
+        return row is not None
+
+    def group_members(self, group_name):
+        with self.connection() as db:
+            rows = db.execute(
+                'SELECT m.username FROM chats c JOIN chat_members m ON m.chat_id = c.chat_id '
+                "WHERE c.kind = 'group' AND c.name = ? ORDER BY m.rowid", (group_name,)).fetchall()
+        return [username for (username,) in rows]
+
+    def user_chat_list(self, username):
+        with self.connection() as db:
+            rows = db.execute(
+                'SELECT c.kind, c.name FROM chat_members m JOIN chats c ON c.chat_id = m.chat_id '
+                'WHERE m.username = ? ORDER BY m.rowid', (username,)).fetchall()
+        private, groups = [], []
+        for kind, name in rows:
+            if kind == 'group':
+                groups.append(name)
+            else:
+                first, second = json.loads(name)
+                private.append(second if first == username else first)
+        return private, groups
+
+    def chat_name(self, kind, chat):
+        return private_chat_name(tuple(chat)) if kind == 'private' else chat
+
+    def delivery_state(self, username):
+        """Чаты пользователя с позицией доставки - как у JsonStorage.delivery_state"""
+        with self.connection() as db:
+            rows = db.execute(
+                'SELECT c.kind, c.name, c.last_seq, m.delivered_seq FROM chat_members m '
+                'JOIN chats c ON c.chat_id = m.chat_id WHERE m.username = ? ORDER BY m.rowid', (username,)).fetchall()
+        return [(kind, tuple(json.loads(name)) if kind == 'private' else name, last_seq, cursor)
+                for kind, name, last_seq, cursor in rows]
+
+    def last_message(self, kind, chat):
+        with self.connection() as db:
+            row = db.execute(
+                'SELECT data FROM messages WHERE chat_id = (SELECT chat_id FROM chats WHERE kind = ? AND name = ?) '
+                'ORDER BY seq DESC LIMIT 1', (kind, self.chat_name(kind, chat))).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def history_page(self, kind, chat, limit=None, before=None, after=None):
+        """Страница истории чата: (сообщения с seq, next_before, next_after)"""
+        with self.connection() as db:
+            row = self.find_chat(db, kind, self.chat_name(kind, chat))
+            if row is None:
+                return [], None, None
+            start, end, next_before, next_after = page_bounds(row[2], limit, before, after)
+            rows = db.execute('SELECT seq, data FROM messages WHERE chat_id = ? AND seq > ? AND seq <= ? ORDER BY seq',
+                              (row[0], start, end)).fetchall()
+        page = [dict(json.loads(data), seq=seq) for seq, data in rows]
+        return page, next_before, next_after
+
+    def stats(self):
+        with self.connection() as db:
+            private_chats = db.execute("SELECT COUNT(*) FROM chats WHERE kind = 'private'").fetchone()[0]
+            groups = [name for (name,) in db.execute("SELECT name FROM chats WHERE kind = 'group' ORDER BY chat_id")]
+            users = [name for (name,) in db.execute('SELECT username FROM users')]
+        return {'private_chats': private_chats, 'groups': groups, 'users': users}
+
+
+def open_storage(backend, logger, fsync='interval', checkpoint_wal_size=64 * 1024 * 1024,
+                 history_cache_size=HISTORY_CACHE_SIZE, shared=False):
+    """Создание хранилища выбранного типа (json или sqlite).
+
+    shared - данные открыты сразу несколькими процессами сервера (только sqlite).
+    """
+    if backend == 'json':
+        return JsonStorage(logger, fsync=fsync, checkpoint_wal_size=checkpoint_wal_size,
+                           history_cache_size=history_cache_size)
+    if backend == 'sqlite':
+        return SqliteStorage(logger, fsync=fsync, shared=shared)
+    raise ValueError(f"Неизвестное хранилище: {backend}")
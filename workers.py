@@ -0,0 +1,507 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import selectors
+import socket
+import sys
+import threading
+import time
+
+from protocol import HEADER, FrameReader, encode_frame
+from server import EventLoopConnection, MessengerServer
+
+
+BUS_OUTBOX_SIZE = 64 * 1024  # кадров в очереди посредника к одному узлу
+BUS_RECONNECT_INTERVAL = 1.0  # секунды между попытками вернуться на шину
+
+
+def encode_envelope(meta, body=b''):
+    """Кадр шины: длина заголовка, заголовок JSON и тело (обычно готовый кадр для клиентов)"""
+    header = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+    return encode_frame(HEADER.pack(len(header)) + header + body)
+
+
+def decode_envelope(payload):
+    """Разбор кадра шины на (заголовок, тело)"""
+    (length,) = HEADER.unpack_from(payload)
+    meta = json.loads(payload[HEADER.size:HEADER.size + length])
+    return meta, payload[HEADER.size + length:]
+
+
+def bus_endpoint(address):
+    """Адрес шины: host:port - TCP (узлы на разных машинах), иначе путь Unix-сокета"""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, address
+
+
+class Broker:
+    """Посредник шины между узлами сервера (процессами или отдельными серверами).
+
+    Узел подключается к посреднику и представляется своим именем. Сообщение
+    с адресатом ('to') пересылается только этому узлу, остальные (присутствие,
+    сигналы "жив", команды) - всем узлам, кроме отправителя. Когда соединение
+    с узлом рвется, остальные получают node_down.
+    """
+
+    def __init__(self, address, logger):
+        self.address = address
+        self.logger = logger
+        self.selector = selectors.DefaultSelector()
+        self.peers = {}  # соединение -> имя узла (None - соединение только отправляет)
+        self.nodes = {}  # имя узла -> соединение
+        self.running = False
+        self.listener = None
+
+    def listen(self):
+        """Открытие сокета шины (до запуска рабочих процессов, чтобы им было куда подключаться)"""
+        family, endpoint = bus_endpoint(self.address)
+        if family == socket.AF_UNIX and os.path.exists(endpoint):
+            os.remove(endpoint)
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(endpoint)
+        self.listener.listen(128)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, None)
+
+    def start(self):
+        """Запуск потока посредника"""
+        self.running = True
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        try:
+            while self.running:
+                for key, events in self.selector.select(timeout=1):
+                    if key.data is None:
+                        self.accept()
+                        continue
+                    peer = key.data
+                    if events & selectors.EVENT_WRITE and not peer.closed:
+                        peer.flush()
+                    if events & selectors.EVENT_READ and not peer.closed:
+                        self.read(peer)
+        except Exception as e:
+            self.logger.error(f"Ошибка шины узлов: {e}")
+        finally:
+            for peer in list(self.peers):
+                peer.close()
+            self.selector.close()
+            self.listener.close()
+            family, endpoint = bus_endpoint(self.address)
+            if family == socket.AF_UNIX and os.path.exists(endpoint):
+                os.remove(endpoint)
+
+    def accept(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            peer = EventLoopConnection(sock, self.address, self.selector, BUS_OUTBOX_SIZE, self.handle_overflow)
+            self.peers[peer] = None
+            self.selector.register(sock, selectors.EVENT_READ, peer)
+
+    def read(self, peer):
+        try:
+            if not peer.reader.recv_from(peer.sock):
+                self.drop_peer(peer)
+                return
+            for payload in peer.reader.frames():
+                meta, _ = decode_envelope(payload)
+                if meta['kind'] == 'hello':
+                    self.register_peer(peer, meta)
+                else:
+                    self.route(peer, meta, encode_frame(payload))
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as e:
+            self.logger.error(f"Ошибка чтения из шины: {e}")
+            self.drop_peer(peer)
+
+    def register_peer(self, peer, meta):
+        """Приветствие узла: с этого момента он получает сообщения шины"""
+        if not meta['listen']:
+            return
+        node = meta['node']
+        self.peers[peer] = node
+        # Узел, вернувшийся по новому соединению, заменяет старое
+        self.nodes[node] = peer
+        self.logger.info(f"Узел {node} подключился к шине")
+
+    def route(self, sender, meta, frame):
+        """Пересылка кадра адресату ('to') или всем узлам, кроме отправителя"""
+        target = meta.get('to')
+        if target is None:
+            for peer, node in list(self.peers.items()):
+                if node is not None and peer is not sender and not peer.closed:
+                    peer.send_frame(frame)
+            return
+        peer = self.nodes.get(target)
+        if peer is not None and not peer.closed:
+            peer.send_frame(frame)
+        elif self.peers.get(sender) is not None:
+            # Адресата нет на шине - отправитель перестанет направлять ему сообщения
+            sender.send_frame(encode_envelope({'kind': 'node_down', 'down': target}))
+
+    def drop_peer(self, peer):
+        node = self.peers.pop(peer, None)
+        peer.close()
+        if node is not None and self.nodes.get(node) is peer:
+            del self.nodes[node]
+            self.logger.warning(f"Узел {node} отключился от шины")
+            self.route(peer, {}, encode_envelope({'kind': 'node_down', 'down': node}))
+
+    def handle_overflow(self, peer, frame):
+        # Узел не успевает разбирать шину: его сообщения теряются, но остальные не ждут
+        peer.dropped += 1
+        if peer.dropped % 1000 == 1:
+            self.logger.warning(f"Очередь шины к узлу {self.peers.get(peer)} переполнена, "
+                                f"отброшено кадров: {peer.dropped}")
+
+    def stop(self):
+        self.running = False
+
+
+class BusClient:
+    """Подключение узла к шине: публикация сообщений и поток их приема.
+
+    handler(meta, body) вызывается потоком приема для каждого сообщения
+    других узлов, on_close() - когда связь с посредником потеряна,
+    on_connect() - когда она восстановлена. С reconnect=True клиент
+    переподключается, пока его не закроют.
+    """
+
+    def __init__(self, address, handler, logger, node=None, listen=True, on_close=None, on_connect=None,
+                 reconnect=False):
+        self.address = address
+        self.handler = handler
+        self.logger = logger
+        self.node = node
+        self.listen = listen
+        self.on_close = on_close
+        self.on_connect = on_connect
+        self.reconnect = reconnect
+        self.lock = threading.Lock()
+        self.sock = None
+        self.connected = False
+        self.closed = False
+        self.connect()
+
+    def connect(self):
+        family, endpoint = bus_endpoint(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(endpoint)
+            # Узел, который только отправляет (главный процесс), не получает чужой трафик
+            sock.sendall(encode_envelope({'kind': 'hello', 'node': self.node, 'listen': self.listen}))
+        except OSError:
+            sock.close()
+            raise
+        with self.lock:
+            self.sock = sock
+            self.connected = True
+
+    def start(self):
+        """Запуск потока приема"""
+        thread = threading.Thread(target=self.read_loop)
+        thread.daemon = True
+        thread.start()
+
+    def publish(self, meta, body=b''):
+        frame = encode_envelope(meta, body)
+        with self.lock:
+            if not self.connected:
+                raise ConnectionError("Нет связи с шиной")
+            self.sock.sendall(frame)
+
+    def read_loop(self):
+        while True:
+            self.receive()
+            with self.lock:
+                self.connected = False
+            if self.closed:
+                return
+            if self.on_close is not None:
+                self.on_close()
+            if not self.reconnect or not self.wait_reconnect():
+                return
+            if self.on_connect is not None:
+                self.on_connect()
+
+    def receive(self):
+        """Прием сообщений до разрыва соединения"""
+        reader = FrameReader()
+        try:
+            while reader.recv_from(self.sock):
+                for payload in reader.frames():
+                    meta, body = decode_envelope(payload)
+                    try:
+                        self.handler(meta, body)
+                    except Exception as e:
+                        self.logger.error(f"Ошибка обработки сообщения шины {meta.get('kind')}: {e}")
+        except OSError:
+            pass
+
+    def wait_reconnect(self):
+        """Попытки вернуться на шину; False - клиент закрыт раньше"""
+        while not self.closed:
+            time.sleep(BUS_RECONNECT_INTERVAL)
+            try:
+                self.connect()
+                return True
+            except OSError:
+                continue
+        return False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        with self.lock:
+            self.connected = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class LocalBroker:
+    """Шина внутри одного процесса: несколько узлов-серверов в одной программе (проверки, отладка).
+
+    Правила пересылки те же, что у Broker. Дополнительно можно уронить узел
+    (disconnect - остальные сразу получают node_down), вернуть его (reconnect)
+    и разделить сеть (partition - сообщения к узлу и от него молча теряются,
+    узлы замечают это только по пропавшим сигналам "жив"; heal - восстановить).
+    """
+
+    def __init__(self):
+        self.clients = {}  # имя узла -> LocalBusClient
+        self.partitioned = set()
+        self.lock = threading.Lock()
+
+    def connect(self, node, handler, logger, on_close=None, on_connect=None):
+        client = LocalBusClient(self, node, handler, logger, on_close, on_connect)
+        with self.lock:
+            self.clients[node] = client
+        return client
+
+    def route(self, sender, meta, body):
+        if sender in self.partitioned:
+            return
+        with self.lock:
+            target = meta.get('to')
+            if target is None:
+                peers = [client for node, client in self.clients.items() if node != sender]
+            elif target in self.clients:
+                peers = [self.clients[target]]
+            else:
+                peers = []
+                if sender in self.clients:
+                    self.clients[sender].deliver({'kind': 'node_down', 'down': target}, b'')
+        for peer in peers:
+            if peer.node not in self.partitioned:
+                peer.deliver(meta, body)
+
+    def disconnect(self, node):
+        """Падение узла: его связь с шиной рвется, остальные узнают об этом сразу"""
+        with self.lock:
+            client = self.clients.pop(node)
+            others = list(self.clients.values())
+        client.connected = False
+        if client.on_close is not None:
+            client.on_close()
+        for peer in others:
+            peer.deliver({'kind': 'node_down', 'down': node}, b'')
+
+    def reconnect(self, node, client):
+        """Возвращение узла на шину с тем же клиентом"""
+        with self.lock:
+            self.clients[node] = client
+        client.connected = True
+        if client.on_connect is not None:
+            client.on_connect()
+
+    def partition(self, node):
+        self.partitioned.add(node)
+
+    def heal(self, node):
+        self.partitioned.discard(node)
+
+
+class LocalBusClient:
+    """Подключение узла к LocalBroker; как и BusClient, принимает сообщения в отдельном потоке"""
+
+    def __init__(self, broker, node, handler, logger, on_close=None, on_connect=None):
+        self.broker = broker
+        self.node = node
+        self.handler = handler
+        self.logger = logger
+        self.on_close = on_close
+        self.on_connect = on_connect
+        self.connected = True
+        self.inbox = queue.Queue()
+        thread = threading.Thread(target=self.read_loop)
+        thread.daemon = True
+        thread.start()
+
+    def publish(self, meta, body=b''):
+        if not self.connected:
+            raise ConnectionError("Нет связи с шиной")
+        # Получатели видят копию заголовка, как после передачи по сокету
+        self.broker.route(self.node, json.loads(json.dumps(meta)), body)
+
+    def deliver(self, meta, body):
+        self.inbox.put((meta, body))
+
+    def read_loop(self):
+        while True:
+            item = self.inbox.get()
+            if item is None:
+                return
+            meta, body = item
+            if not self.connected:
+                continue
+            try:
+                self.handler(meta, body)
+            except Exception as e:
+                self.logger.error(f"Ошибка обработки сообщения шины {meta.get('kind')}: {e}")
+
+    def close(self):
+        self.connected = False
+        self.inbox.put(None)
+
+
+def run_worker(worker_id, bus_address, options):
+    """Рабочий процесс: обычный сервер на общем порту, подключенный к шине"""
+    server = MessengerServer(node_id=worker_id, **options)
+
+    def master_lost():
+        # Шина рабочих процессов живет в главном процессе: без него рабочий останавливается
+        server.on_bus_closed()
+        if server.running:
+            server.logger.error("Потеряна связь с главным процессом, рабочий процесс останавливается")
+            server.running = False
+
+    server.bus = BusClient(bus_address, server.on_bus_message, server.logger, node=worker_id,
+                           on_close=master_lost)
+    server.bus.start()
+    try:
+        server.start(reuse_port=True, console=False)
+    except KeyboardInterrupt:
+        server.stop_server()
+
+
+def run_workers(count, bus_address, options):
+    """Сервер из нескольких процессов на одном порту.
+
+    Каждый рабочий процесс сам принимает подключения (SO_REUSEPORT) и
+    обслуживает своих клиентов. Личные и групповые сообщения, события списка
+    чатов и присутствие пользователей передаются между процессами через шину
+    (Unix-сокет и посредник в главном процессе). Данные общие - в базе SQLite.
+    Главный процесс читает консольные команды и передает их рабочим.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+        raise RuntimeError("Несколько процессов сервера требуют SO_REUSEPORT и Unix-сокетов (Linux, BSD, macOS)")
+    if options.get('storage') != 'sqlite':
+        raise ValueError("Несколько процессов сервера работают только с хранилищем sqlite")
+
+    # Главный процесс готовит базу (в том числе перенос из JSON) до запуска рабочих
+    master = MessengerServer(**options)
+    master.storage.close()
+    logger = master.logger
+
+    broker = Broker(bus_address, logger)
+    broker.listen()
+    processes = [multiprocessing.Process(target=run_worker, args=(worker_id, bus_address, options),
+                                         name=f"worker-{worker_id}")
+                 for worker_id in range(1, count + 1)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+    # Поток посредника запускается после рабочих процессов: fork не копирует работающие потоки
+    broker.start()
+    control = BusClient(bus_address, None, logger, listen=False)
+    logger.info(f"Запущено процессов сервера: {count}, шина {bus_address}")
+    logger.info("Доступные команды: stop, status, save, repair_data")
+
+    try:
+        while any(process.is_alive() for process in processes):
+            try:
+                command = input().strip().lower()
+            except EOFError:
+                # Консоли нет - работаем до остановки рабочих процессов
+                for process in processes:
+                    process.join()
+                break
+            if command == 'stop':
+                break
+            if command in ('status', 'save', 'repair_data'):
+                control.publish({'kind': 'command', 'command': command})
+            else:
+                logger.info("Доступные команды: stop, status, save, repair_data")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Остановка процессов сервера...")
+        try:
+            control.publish({'kind': 'command', 'command': 'stop'})
+        except OSError:
+            pass
+        for process in processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+        control.close()
+        broker.stop()
+        logger.info("Все процессы сервера остановлены")
+
+
+def run_node(node, bus_address, options):
+    """Узел федерации: отдельный сервер (свой адрес и консоль), подключенный к общей шине.
+
+    Узлы работают с одной базой SQLite и пересылают друг другу сообщения
+    по таблице маршрутов. Потеряв шину, узел продолжает обслуживать своих
+    клиентов и переподключается; пользователи других узлов до этого не в сети.
+    """
+    if not bus_address:
+        raise ValueError("Для узла нужен адрес шины (--bus)")
+    if options.get('storage') != 'sqlite':
+        raise ValueError("Узлы работают только с общим хранилищем sqlite")
+
+    server = MessengerServer(node_id=node, **options)
+    server.bus = BusClient(bus_address, server.on_bus_message, server.logger, node=node,
+                           on_close=server.on_bus_closed, on_connect=server.on_bus_connected, reconnect=True)
+    server.bus.start()
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop_server()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Шина узлов сервера мессенджера")
+    parser.add_argument('--broker', required=True, help="Адрес шины: host:port или путь Unix-сокета")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                        handlers=[logging.StreamHandler(sys.stdout)])
+    broker = Broker(args.broker, logging.getLogger(__name__))
+    broker.listen()
+    broker.start()
+    broker.logger.info(f"Шина узлов запущена на {args.broker}")
+    try:
+        while broker.running:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        broker.stop()